@@ -0,0 +1,40 @@
+"""
+Measure the per-emit cost of Emitter.emit as the number of distinct events
+grows.  With bounded de-duplication the cost per block should stay flat.
+
+    $ PYTHONPATH=. python bench/emit.py [total] [block]
+"""
+
+import sys
+import time
+
+from simplebb.report import Emitter
+
+
+
+class NullObserver:
+
+    def buildReceived(self, buildDict):
+        pass
+
+
+
+def main(total=1000000, block=100000):
+    e = Emitter()
+    e.addObserver(NullObserver())
+
+    print '%10s %10s %12s' % ('events', 'handled', 'usec/emit')
+    n = 0
+    while n < total:
+        start = time.time()
+        for i in xrange(n, n + block):
+            e.emit(dict(uid=str(i), status=0, project='bench'))
+        elapsed = time.time() - start
+        n += block
+        print '%10d %10d %12.3f' % (n, len(e._handled),
+                                    elapsed / block * 1000000)
+
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
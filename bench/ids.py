@@ -0,0 +1,46 @@
+"""
+Compare the cost of the current generateId with the SHA-256 based one it
+replaced.
+
+    $ PYTHONPATH=. python bench/ids.py [count]
+"""
+
+import sys
+import time
+import random
+import hashlib
+import datetime
+
+from simplebb.util import generateId
+
+
+
+_idcount = 0
+
+def oldGenerateId():
+    global _idcount
+    _idcount += 1
+    random_part = hashlib.sha256(str(random.getrandbits(256))).hexdigest()
+    time_part = datetime.datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    num_part = str(_idcount)
+    return hashlib.sha256(num_part + time_part + random_part).hexdigest()
+
+
+
+def measure(func, count):
+    start = time.time()
+    for i in xrange(count):
+        func()
+    return (time.time() - start) / count * 1000000
+
+
+
+def main(count=200000):
+    print '%-15s %10s %6s' % ('generator', 'usec/id', 'length')
+    for name, func in [('sha256', oldGenerateId), ('generateId', generateId)]:
+        print '%-15s %10.3f %6d' % (name, measure(func, count), len(func()))
+
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
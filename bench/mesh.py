@@ -0,0 +1,129 @@
+"""
+Simulate meshes of hubs in one process and count the build messages sent
+between hubs for each broadcast request, with and without the hop count
+and visited list.
+
+Each hub is linked to its neighbours on a ring and to random other hubs
+until it has about C{degree} links, and has one local builder.
+
+    $ PYTHONPATH=. python bench/mesh.py [requests] [degree]
+"""
+
+import sys
+import random
+from collections import deque
+
+from twisted.internet import defer
+
+from simplebb.builder import Builder
+from simplebb.hub import Hub, RemoteHub
+
+
+
+class NullBuilder(Builder):
+
+    def __init__(self):
+        Builder.__init__(self)
+        self.built = 0
+
+    def getProjects(self):
+        return ['bench']
+
+    def _build(self, request):
+        self.built += 1
+
+
+
+class FloodHub(Hub):
+    """
+    I send every request on to all my builders, like hubs did before
+    requests carried hops and visited hubs.
+    """
+
+    def _broadcast(self, request, builders):
+        for builder in builders:
+            builder.build(request)
+
+
+
+class Link:
+    """
+    I am one direction of a link between two hubs.  Requests are queued so
+    that they are delivered breadth first, the way they would spread over a
+    network.
+    """
+
+    def __init__(self, hub, pending, counts):
+        self.hub = hub
+        self.pending = pending
+        self.counts = counts
+
+    def callRemote(self, name, *args):
+        if name == 'build':
+            self.counts['messages'] += 1
+            self.counts['hops'] = max(self.counts['hops'],
+                                      args[0].get('hops', 0))
+            self.pending.append((self.hub, args[0]))
+            return defer.succeed(None)
+        return defer.succeed(getattr(self.hub, 'remote_' + name)(*args))
+
+
+
+def edges(size, degree, rand):
+    links = set()
+    for i in range(size):
+        links.add(tuple(sorted([i, (i + 1) % size])))
+    while len(links) < min(size * degree // 2, size * (size - 1) // 2):
+        a, b = rand.sample(range(size), 2)
+        links.add(tuple(sorted([a, b])))
+    return sorted(links)
+
+
+
+def mesh(factory, size, degree, pending, counts):
+    hubs = [factory() for i in range(size)]
+    builders = []
+    for h in hubs:
+        b = NullBuilder()
+        h.addBuilder(b)
+        builders.append(b)
+    links = edges(size, degree, random.Random(size))
+    for a, b in links:
+        for x, y in ((a, b), (b, a)):
+            remote = RemoteHub(Link(hubs[y], pending, counts))
+            remote.hub = hubs[x]
+            remote.uid = hubs[y].uid
+            hubs[x].addBuilder(remote)
+    return hubs, builders, len(links)
+
+
+
+def run(factory, size, degree, requests):
+    pending = deque()
+    counts = dict(messages=0, hops=0)
+    hubs, builders, links = mesh(factory, size, degree, pending, counts)
+    rand = random.Random(0)
+    for i in range(requests):
+        rand.choice(hubs).build(dict(project='bench', version=str(i)))
+        while pending:
+            hub, request = pending.popleft()
+            hub.remote_build(request)
+    reached = min(x.built for x in builders) == requests
+    return links, float(counts['messages']) / requests, counts['hops'], reached
+
+
+
+def main(requests=100, degree=4):
+    print '%6s %6s %14s %14s %8s %8s' % ('hubs', 'links', 'flood msgs/req',
+                                         'msgs/req', 'max hops', 'reached')
+    for size in (10, 50, 100):
+        links, flood, ign, floodReached = run(FloodHub, size, degree,
+                                              requests)
+        links, msgs, hops, reached = run(Hub, size, degree, requests)
+        print '%6d %6d %14.1f %14.1f %8d %8s' % (
+            size, links, flood, msgs, hops, reached and floodReached)
+
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
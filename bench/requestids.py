@@ -0,0 +1,44 @@
+"""
+Push request ids through Builder.build and watch the size of its memory
+of past requests and the process's maximum RSS, which should level off.
+
+    $ PYTHONPATH=. python bench/requestids.py [total] [block]
+"""
+
+import sys
+import time
+import resource
+
+from simplebb.builder import Builder
+
+
+
+class NullBuilder(Builder):
+
+    def _build(self, request):
+        pass
+
+
+
+def main(total=10000000, block=1000000):
+    b = NullBuilder()
+    request = dict(project='bench', version='1', time='now')
+
+    print '%10s %10s %12s %10s' % ('requests', 'remembered', 'usec/build',
+                                   'maxrss')
+    n = 0
+    while n < total:
+        start = time.time()
+        for i in xrange(n, n + block):
+            request['uid'] = '%040x' % i
+            b.build(request)
+        elapsed = time.time() - start
+        n += block
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print '%10d %10d %12.3f %10d' % (n, len(b._pastRequestIds),
+                                         elapsed / block * 1000000, maxrss)
+
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,144 @@
+import os
+
+from simplebb.util import monotonic
+
+
+
+def loadAverage():
+    """
+    Returns the 1-minute load average, or C{None} if it isn't known here.
+    """
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return None
+
+
+
+def freeMemory(meminfo='/proc/meminfo'):
+    """
+    Returns the kilobytes of memory available for new processes according
+    to C{meminfo}, or C{None} if it isn't known here.
+    """
+    try:
+        fh = open(meminfo)
+    except IOError:
+        return None
+    fields = {}
+    try:
+        for line in fh:
+            name, value = line.split(':', 1)
+            value = value.split()
+            if value:
+                fields[name] = int(value[0])
+    finally:
+        fh.close()
+    if 'MemAvailable' in fields:
+        return fields['MemAvailable']
+    if 'MemFree' in fields:
+        # kernels before 3.14
+        return (fields['MemFree'] + fields.get('Buffers', 0) +
+                fields.get('Cached', 0))
+    return None
+
+
+
+def freeDisk(path):
+    """
+    Returns the kilobytes free for unprivileged users on the filesystem
+    holding C{path}, or C{None} if it isn't known.
+    """
+    try:
+        st = os.statvfs(path)
+    except (OSError, AttributeError):
+        return None
+    return st.f_bavail * st.f_frsize // 1024
+
+
+
+class Admission:
+    """
+    I decide whether this host has room for another build.
+
+    It doesn't while the 1-minute load average is over C{maxLoad}, or there
+    are fewer than C{minFreeMemory} kilobytes of memory or C{minFreeDisk}
+    kilobytes of disk (on the filesystem holding C{path}) free.  Thresholds
+    that are C{None}, or that can't be measured here, aren't checked.
+
+    Measurements are reused for C{interval} seconds so that checking before
+    every build is cheap.
+    """
+
+    maxLoad = None
+    minFreeMemory = None
+    minFreeDisk = None
+
+    interval = 1.0
+
+    def __init__(self, path='.', maxLoad=None, minFreeMemory=None,
+                 minFreeDisk=None, clock=monotonic):
+        self.path = path
+        if maxLoad is not None:
+            self.maxLoad = maxLoad
+        if minFreeMemory is not None:
+            self.minFreeMemory = minFreeMemory
+        if minFreeDisk is not None:
+            self.minFreeDisk = minFreeDisk
+        self.clock = clock
+        self._measured = None
+        self._measuredAt = None
+
+
+    def measure(self):
+        """
+        Returns a dictionary of the current C{load}, C{free_memory} and
+        C{free_disk}.
+        """
+        now = self.clock()
+        if self._measured is None or now - self._measuredAt >= self.interval:
+            self._measured = dict(
+                load=loadAverage(),
+                free_memory=freeMemory(),
+                free_disk=freeDisk(self.path))
+            self._measuredAt = now
+        return self._measured
+
+
+    def blocked(self):
+        """
+        Returns the sorted names of the measurements past their thresholds.
+        """
+        m = self.measure()
+        ret = []
+        if self._over(m['load'], self.maxLoad):
+            ret.append('load')
+        if self._over(self.minFreeMemory, m['free_memory']):
+            ret.append('free_memory')
+        if self._over(self.minFreeDisk, m['free_disk']):
+            ret.append('free_disk')
+        return ret
+
+
+    def _over(self, a, b):
+        return a is not None and b is not None and a > b
+
+
+    def admits(self):
+        """
+        Returns True if there is room for another build.
+        """
+        return not self.blocked()
+
+
+    def getMetrics(self):
+        """
+        Returns a dictionary of my measurements, thresholds and which of
+        them are blocking builds.
+        """
+        d = dict(self.measure())
+        d.update(
+            max_load=self.maxLoad,
+            min_free_memory=self.minFreeMemory,
+            min_free_disk=self.minFreeDisk,
+            blocked=self.blocked())
+        return d
@@ -1,15 +1,60 @@
-from twisted.internet import defer, utils
+from twisted.internet import defer, protocol, reactor
 from twisted.python.filepath import FilePath
+from twisted.python import log
 from zope.interface import Interface, implements
 
+from collections import deque
+import os
+import sys
+import signal
+import errno
+import re
+
 
 from simplebb.interface import IBuild
-from simplebb.util import generateId
+from simplebb.util import generateId, monotonic
 
 
 
 FILE_NOT_FOUND = 404
 MISSING_VERSION = 400
+TIMEOUT = 408
+SKIPPED = 424
+SUPERSEDED = 410
+ERROR = 500
+
+
+# names of the output streams of a build process, by file descriptor
+STREAMS = {1: 'stdout', 2: 'stderr'}
+
+
+# script that runs a build file and reports its resource usage on USAGE_FD
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runner.py')
+USAGE_FD = 3
+
+
+# header lines in build files look like "# simplebb-timeout: 30"
+HEADER_RE = re.compile(r'^#\s*simplebb-([\w-]+)\s*:\s*(.*?)\s*$')
+
+
+
+def readHeaders(filepath, lines=20):
+    """
+    Return a dictionary of the C{simplebb-} header comments found in the
+    first C{lines} lines of the file at C{filepath}.
+    """
+    headers = {}
+    fh = filepath.open()
+    try:
+        for i, line in enumerate(fh):
+            if i >= lines:
+                break
+            m = HEADER_RE.match(line)
+            if m:
+                headers[m.group(1)] = m.group(2)
+    finally:
+        fh.close()
+    return headers
 
 
 
@@ -23,18 +68,31 @@ class Build:
     
     uid = None
     status = None
+    state = None
     project = None
     version = None
     test_path = None
     
     builder = None
     
+    # True if I was only found because a requested build depends on me
+    dependency = False
+    
     done = None
     runtime = None
     
+    # callable given each log chunk dictionary as it is received
+    emitLog = None
+    
+    # the log keeps the last logChunks chunks of at most logChunkSize bytes
+    logChunks = 64
+    logChunkSize = 4096
+    
     def __init__(self):
         self.done = defer.Deferred()
         self.uid = generateId()
+        self.log = deque(maxlen=self.logChunks)
+        self._logSeq = 0
     
     
     def _finish(self, status):
@@ -42,9 +100,33 @@ class Build:
         Mark this build as done with the given integer status
         """
         self.status = status
+        self.state = 'done'
         self.done.callback(self)
 
     
+    def prepare(self):
+        """
+        Do any slow work (such as disk I/O) needed before running.  This may
+        be called in a thread other than the reactor's.
+        """
+    
+    
+    def runCached(self):
+        """
+        Finish right away with a result kept from an earlier run, if
+        L{prepare} found one.  Returns C{True} if I did.
+        """
+        return False
+    
+    
+    def getDepends(self):
+        """
+        Return the names of the builds I must wait for (see
+        L{simplebb.dag.BuildGraph}).
+        """
+        return []
+    
+    
     def run(self):
         """
         Start this Build (whatever that means) with the given version
@@ -52,6 +134,47 @@ class Build:
         self._finish(self.status)
     
     
+    def outputReceived(self, stream, data):
+        """
+        Called with output written by this Build to the named C{stream}.
+        
+        The output is kept in my log, a ring buffer of the most recent
+        chunks, and each chunk is passed to C{emitLog} as a dictionary.
+        """
+        size = self.logChunkSize
+        for i in xrange(0, len(data), size):
+            chunk = data[i:i+size]
+            self.log.append((stream, chunk))
+            self._logSeq += 1
+            if self.emitLog is not None:
+                self.emitLog(self.logDict(stream, chunk, self._logSeq))
+    
+    
+    def logDict(self, stream, data, seq):
+        """
+        Return a dictionary representation of a chunk of my output.
+        
+        C{seq} numbers the chunks of a Build in the order they were written.
+        """
+        return dict(
+            uid=self.uid,
+            event='log',
+            status=None,
+            project=self.project,
+            version=self.version,
+            test_path=self.test_path,
+            stream=stream,
+            seq=seq,
+            data=data)
+    
+    
+    def getLog(self):
+        """
+        Return what's left in my log as a string.
+        """
+        return ''.join([x[1] for x in self.log])
+    
+    
     def toDict(self):
         """
         Return a dictionary representation of this Build
@@ -59,6 +182,7 @@ class Build:
         return dict(
             uid=self.uid,
             status=self.status,
+            state=self.state,
             project=self.project,
             version=self.version,
             test_path=self.test_path,
@@ -66,17 +190,225 @@ class Build:
 
 
 
+class BuildProtocol(protocol.ProcessProtocol):
+    """
+    I pass the output of a L{Build}'s process on to the build as it arrives
+    and finish the build with the process's exit code.
+    
+    The resource usage line written by L{RUNNER} on L{USAGE_FD} is given to
+    the build's usageReceived.
+    """
+    
+    def __init__(self, build):
+        self.build = build
+        self._usage = ''
+    
+    
+    def connectionMade(self):
+        self.transport.closeStdin()
+    
+    
+    def childDataReceived(self, childFD, data):
+        if childFD == USAGE_FD:
+            self._usage += data
+            return
+        self.build.outputReceived(STREAMS.get(childFD, str(childFD)), data)
+    
+    
+    def processEnded(self, reason):
+        try:
+            if self._usage:
+                self.build.usageReceived(self._usage)
+        finally:
+            self.build._finish(reason.value.exitCode)
+
+
+
 class FileBuild(Build):
     """
     I am a build of a single file.
+    
+    The file is run with the version as its only argument, in the
+    environment C{env}.
+    
+    Besides C{runtime} I record how long I waited between being created and
+    being run (C{queue_wait}), and the user and system CPU seconds and
+    maximum resident set size (in kilobytes) of my process.
+    
+    If I run for longer than C{timeout} seconds, or than the file's
+    C{simplebb-timeout} header says, whichever is less, my whole process
+    group is killed and I finish with L{TIMEOUT}.
+    
+    If I have a C{cache} (a L{simplebb.cache.ResultCache}) and it holds a
+    result for the same file content, version and environment, I finish
+    with that result right away instead of running, and C{cached} is
+    C{True}.  Successful results are stored in the cache.
+    
+    If I have C{workers} (a L{simplebb.worker.WorkerPool}) and my file has
+    a C{simplebb-runner: python} header, it is run by one of the workers
+    instead of in a new interpreter.
     """
     
+    env = {}
+    
+    reactor = reactor
+    
+    timeout = None
+    
+    cache = None
+    cached = False
+    
+    workers = None
+    
+    queue_wait = None
+    cpu_user = None
+    cpu_system = None
+    max_rss = None
+    
     def __init__(self, path):
         Build.__init__(self)
         if isinstance(path, FilePath):
             self._filepath = path
         else:
             self._filepath = FilePath(path)
+        self._createdAt = monotonic()
+        self._startedAt = None
+        self._process = None
+        self._timeoutCall = None
+        self._killStatus = None
+        self._cacheKey = None
+        self._cacheResult = None
+        self._headers = None
+    
+    
+    def _finish(self, status):
+        if self._startedAt is not None:
+            self.runtime = monotonic() - self._startedAt
+        if self._timeoutCall is not None and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        if self._killStatus is not None:
+            status = self._killStatus
+        self.status = status
+        if status == 0 and self.cache is not None and not self.cached:
+            self.cache.put(self._cacheKey, self.cacheDict())
+        Build._finish(self, status)
+    
+    
+    def prepare(self):
+        """
+        Read my file's headers and look for my result in my cache, so that
+        run doesn't have to.
+        """
+        if self._headers is not None:
+            return
+        if not self._filepath.exists():
+            return
+        self._headers = readHeaders(self._filepath)
+        if self.cache is not None and self.version:
+            self._cacheKey = self.cache.key(self._filepath, self.version,
+                                            self.env)
+            self._cacheResult = self.cache.get(self._cacheKey)
+    
+    
+    def getHeaders(self):
+        """
+        Return the headers of my file (see L{readHeaders}).
+        """
+        if self._headers is not None:
+            return self._headers
+        return readHeaders(self._filepath)
+    
+    
+    def getDepends(self):
+        """
+        Return the test_paths named by my file's C{simplebb-depends} header,
+        which separates them with spaces or commas.
+        """
+        if not self._filepath.exists():
+            return []
+        header = self.getHeaders().get('depends', '')
+        return header.replace(',', ' ').split()
+    
+    
+    def getTimeout(self):
+        """
+        Return the number of seconds I may run for, or C{None} for no limit.
+        
+        A simplebb-timeout header that isn't a number is logged and ignored.
+        """
+        timeouts = []
+        if self.timeout is not None:
+            timeouts.append(float(self.timeout))
+        header = self.getHeaders().get('timeout')
+        if header:
+            try:
+                timeouts.append(float(header))
+            except ValueError:
+                log.msg('Ignoring bad simplebb-timeout %r in %s' % (
+                        header, self._filepath.path))
+        if timeouts:
+            return min(timeouts)
+        return None
+    
+    
+    def isPython(self):
+        """
+        Return True if my file is tagged as a Python script that can be run
+        by a worker.
+        """
+        return self.getHeaders().get('runner') == 'python'
+    
+    
+    def kill(self, status):
+        """
+        Kill my process group and finish with C{status} once it's dead.
+        
+        If my script is still waiting for a worker it is never run, and if
+        a worker is just starting it, it is killed once it has started.
+        """
+        if self._process is None or self._killStatus is not None:
+            return
+        if self.workers is not None and self.workers.cancel(self._process):
+            self._killStatus = status
+            self._finish(status)
+            return
+        pid = self._process.pid
+        if pid is None:
+            if getattr(self._process, 'starting', False):
+                # killed when the worker says it has started
+                self._killStatus = status
+            # otherwise already dead
+            return
+        self._killStatus = status
+        self._killPid(pid)
+    
+    
+    def _killPid(self, pid):
+        for kill in (os.killpg, os.kill):
+            # the runner might not have made its process group yet
+            try:
+                kill(pid, signal.SIGKILL)
+                return
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+    
+    
+    def usageReceived(self, line):
+        """
+        Called with the resource usage line written by L{RUNNER}.  A line
+        that can't be parsed is logged and ignored.
+        """
+        try:
+            utime, stime, maxrss = line.split()
+            utime, stime, maxrss = float(utime), float(stime), int(maxrss)
+        except ValueError:
+            log.msg('Ignoring bad usage line %r from %s' % (
+                    line, self._filepath.path))
+            return
+        self.cpu_user = utime
+        self.cpu_system = stime
+        self.max_rss = maxrss
 
     
     def run(self):
@@ -87,7 +419,75 @@ class FileBuild(Build):
             return self._finish(MISSING_VERSION)
         if not self._filepath.exists():
             return self._finish(FILE_NOT_FOUND)
-        d = utils.getProcessValue(self._filepath.path, args=(self.version,))
-        d.addCallback(self._finish)
+        self.prepare()
+        if self.runCached():
+            return
+        timeout = self.getTimeout()
+        self._startedAt = monotonic()
+        self.queue_wait = self._startedAt - self._createdAt
+        if self.workers is not None and self.isPython():
+            self._process = self.workers.run(self, self._filepath.path,
+                                             [self.version], self.env)
+        else:
+            args = (sys.executable, RUNNER, self._filepath.path, self.version)
+            childFDs = {0: 'w', 1: 'r', 2: 'r', USAGE_FD: 'r'}
+            self._process = self.reactor.spawnProcess(BuildProtocol(self),
+                sys.executable, args, self.env, childFDs=childFDs)
+        if timeout is not None:
+            self._timeoutCall = self.reactor.callLater(timeout, self.kill,
+                                                       TIMEOUT)
+    
+    
+    def cacheDict(self):
+        """
+        Return what is stored in my cache about a successful run.
+        """
+        return dict(
+            status=self.status,
+            runtime=self.runtime,
+            cpu_user=self.cpu_user,
+            cpu_system=self.cpu_system,
+            max_rss=self.max_rss,
+            log=[(x[0], x[1].decode('latin-1')) for x in self.log])
+    
+    
+    def runCached(self):
+        """
+        Finish with the result L{prepare} found in my cache, if any.
+        Returns C{True} if I did.
+        """
+        if self._cacheResult is None:
+            return False
+        self._finishFromCache(self._cacheResult)
+        return True
+    
+    
+    def _finishFromCache(self, result):
+        """
+        Finish with a result from my cache.
+        """
+        self.cached = True
+        self.runtime = result['runtime']
+        self.cpu_user = result['cpu_user']
+        self.cpu_system = result['cpu_system']
+        self.max_rss = result['max_rss']
+        for stream, data in result['log']:
+            self.outputReceived(str(stream), data.encode('latin-1'))
+        self._finish(result['status'])
+    
+    
+    def toDict(self):
+        """
+        Return a dictionary representation of this Build, including its
+        resource usage and whether it came from the cache.
+        """
+        d = Build.toDict(self)
+        d.update(
+            queue_wait=self.queue_wait,
+            cpu_user=self.cpu_user,
+            cpu_system=self.cpu_system,
+            max_rss=self.max_rss,
+            cached=self.cached)
+        return d
 
 
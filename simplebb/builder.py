@@ -1,12 +1,19 @@
 import datetime
+import itertools
+import os
 
 from zope.interface import implements
 from twisted.python.filepath import FilePath
+from twisted.internet import reactor, threads
+from twisted.python import log, threadable
 
 from simplebb.interface import IBuilder, IEmitter
-from simplebb.build import FileBuild
+from simplebb.build import FileBuild, SUPERSEDED
 from simplebb.report import Emitter
-from simplebb.util import generateId
+from simplebb.scheduler import Scheduler
+from simplebb.index import ScriptIndex, getNotifier
+from simplebb.dag import BuildGraph, provides
+from simplebb.util import generateId, RotatingSet
 
 
 
@@ -15,6 +22,12 @@ class Builder:
     I am an abstract Builder that can't actually build anything.
     
     I set my uid on initialization.  My name can be chosen.
+    
+    I remember the uids of the requests I've seen so that I don't build a
+    request twice when it comes back around: each one until
+    C{requestIdWindow} seconds have passed or C{requestIdLimit} more
+    requests have come in, whichever is first.  I never remember more than
+    C{2 * requestIdLimit} of them.
     """
     
     implements(IBuilder)
@@ -23,9 +36,13 @@ class Builder:
     
     name = 'Builder'
     
+    requestIdWindow = 60 * 60
+    requestIdLimit = 100000
+    
     def __init__(self):
         self.uid = generateId()
-        self._pastRequestIds = set([])
+        self._pastRequestIds = RotatingSet(self.requestIdWindow,
+                                           self.requestIdLimit)
 
 
     def build(self, request):
@@ -48,12 +65,58 @@ class Builder:
         """
         Actually do the build
         """
+    
+    
+    def getLoad(self, project):
+        """
+        I can't build anything.
+        """
+        return None
+    
+    
+    def getProjects(self):
+        """
+        I can't build anything.
+        """
+        return []
 
 
 
 class FileBuilder(Builder, Emitter):
     """
     I create and run FileBuilds found from my root directory.
+    
+    My L{Scheduler} decides when each build runs; builds waiting for a
+    free slot are emitted with a state of 'queued'.  Requests may have a
+    C{priority} (higher goes first, 0 by default) and a C{submitter}, who
+    gets a fair share of the slots with the other submitters of the same
+    project; see L{queuePosition}.
+    
+    For the projects in C{supersede}, a build replaces the builds of the
+    same file from earlier requests that haven't started yet, which finish
+    with L{SUPERSEDED} instead.  If C{supersede[project]} is C{'running'}
+    builds that have started are killed as well.  Builds found only as the
+    dependencies of a request's builds neither supersede nor are
+    superseded, since other builds of their request wait on them.
+    
+    If I have an C{admission} (a L{simplebb.admission.Admission}), builds
+    wait in the queue while it says this host is too busy.  See
+    L{getMetrics}.
+    
+    The files in each project are kept in a L{ScriptIndex} so that the
+    project directory isn't walked for every request.  If C{watchFiles} is
+    True and inotify is available it is used to notice changes.
+    
+    Builds are found (and prepared) in a thread so that the reactor doesn't
+    wait on the disk, and are started in batches of C{discoveryBatch} as
+    they are found.
+    
+    A build file can name other builds of its project that must succeed
+    before it runs in a C{simplebb-depends} header; see L{BuildGraph}.
+    Those are built too, even if they don't match the request's test_path.
+    
+    If C{workers} is a L{simplebb.worker.WorkerPool}, build files tagged
+    with a C{simplebb-runner: python} header are run by its workers.
     """
     
     implements(IBuilder)
@@ -63,6 +126,25 @@ class FileBuilder(Builder, Emitter):
     uid = None
     
     path = None
+    
+    # seconds a build may run for, unless the request says otherwise
+    timeout = None
+    
+    # simplebb.cache.ResultCache used to skip builds that already succeeded
+    resultCache = None
+    
+    # simplebb.worker.WorkerPool used to run Python build files
+    workers = None
+    
+    # project -> 'queued' or 'running'
+    supersede = {}
+    
+    # simplebb.admission.Admission that holds builds back when overloaded
+    admission = None
+    
+    watchFiles = False
+    
+    discoveryBatch = 50
 
     
     def __init__(self, path=None):
@@ -73,47 +155,279 @@ class FileBuilder(Builder, Emitter):
             self.path = path
         elif path is not None:
             self.path = FilePath(path)
+        
+        self.scheduler = Scheduler(self._runBuild)
+        self.scheduler.admit = self._admits
+        self._indexes = {}
+        self._notifier = None
+        self._requestCount = itertools.count()
+        self._latest = {}
 
 
     def _build(self, request):
         """
         Find the build in the file system and start it.
+        
+        Returns a Deferred that fires once all the builds have been found.
         """
         project = request['project']
         test_path = request['test_path']
         version = request['version']
+        timeout = request.get('timeout', self.timeout)
+        priority = request.get('priority', 0)
+        submitter = request.get('submitter')
+        uid = request.get('uid')
+        order = self._requestCount.next()
+        
+        def submit(build):
+            self._submit(build, priority, submitter, uid)
+        
+        graph = BuildGraph(submit)
+        
+        def found(builds):
+            for build in builds:
+                build.timeout = timeout
+                self._track(build)
+                self._supersede(build, order)
+                graph.add(build)
+        
+        def discovered(result):
+            graph.close()
+            return result
+        
+        d = self.discoverBuilds(project, test_path, version, found)
+        d.addBoth(discovered)
+        d.addErrback(log.err)
+        return d
+    
+    
+    def discoverBuilds(self, project, test_path, version, found):
+        """
+        Find and prepare the builds for C{version} of C{project} matching
+        C{test_path} in a thread.
+        
+        The builds that found builds depend on are found too.
+        
+        C{found} is called in the reactor thread with lists of builds as they
+        are found.  Returns a Deferred that fires with the number of builds
+        found once they all have been passed to C{found}.
+        """
+        if self.path is not None and self.path.child(project).isdir():
+            # watching files has to be set up in the reactor thread
+            self._getIndex(self.path.child(project))
         
-        builds = self.findBuilds(project, test_path)
-        for build in builds:
-            build.version = version
-            build.run()
-            
+        def discover():
+            count = 0
+            batch = []
+            paths = set()
+            looked = set()
+            builds = self.findBuilds(project, test_path)
+            while builds:
+                depends = []
+                for build in builds:
+                    build.version = version
+                    build.cache = self.resultCache
+                    build.workers = self.workers
+                    build.prepare()
+                    paths.add(build.test_path)
+                    depends.extend(build.getDepends())
+                    batch.append(build)
+                    if len(batch) >= self.discoveryBatch:
+                        reactor.callFromThread(found, batch)
+                        count += len(batch)
+                        batch = []
+                # dependencies that test_path didn't match
+                builds = []
+                for name in depends:
+                    if name in looked:
+                        continue
+                    looked.add(name)
+                    if [x for x in paths if provides(x, name)]:
+                        continue
+                    for build in self.findBuilds(project, name):
+                        if build.test_path not in paths:
+                            paths.add(build.test_path)
+                            build.dependency = True
+                            builds.append(build)
+            if batch:
+                reactor.callFromThread(found, batch)
+                count += len(batch)
+            return count
+        return threads.deferToThread(discover)
+    
+    
+    def _track(self, build):
+        """
+        Emit a found build's log and its result when it is done.
+        """
+        build.emitLog = self.emit
+        
+        def emitDone(build, self):
             self.emit(build.toDict())
-            
-            def emitDone(build, self):
-                self.emit(build.toDict())
-            
-            build.done.addCallback(emitDone, self)
+            return build
         
+        build.done.addCallback(emitDone, self)
     
-    def _findHeads(self, project, test_path=None):
+    
+    def _supersede(self, build, order):
+        """
+        Supersede the build of the same file from an earlier request, or
+        C{build} itself if it's from an earlier request than that build.
+        
+        C{order} is the order in which C{build}'s request arrived.
+        """
+        mode = self.supersede.get(build.project)
+        if not mode or build.dependency:
+            return
+        key = (build.project, build.test_path)
+        latest = self._latest.get(key)
+        if latest is not None:
+            if latest[0] > order:
+                build._finish(SUPERSEDED)
+                return
+            old = latest[1]
+            if old.state == 'running':
+                if mode == 'running':
+                    old.kill(SUPERSEDED)
+            elif old.state != 'done':
+                self.scheduler.remove(old)
+                old._finish(SUPERSEDED)
+        self._latest[key] = (order, build)
+        
+        def forget(result, build, self):
+            latest = self._latest.get(key)
+            if latest is not None and latest[1] is build:
+                del self._latest[key]
+            return result
+        
+        build.done.addCallback(forget, build, self)
+    
+    
+    def _submit(self, build, priority=0, submitter=None, request=None):
+        """
+        Hand a build that is ready to run to my scheduler, unless its result
+        is already cached.
+        """
+        if build.runCached():
+            return
+        self.scheduler.submit(build, priority, submitter, request)
+        if build.state == 'queued':
+            self.emit(build.toDict())
+    
+    
+    def _admits(self):
+        return self.admission is None or self.admission.admits()
+    
+    
+    def getMetrics(self):
+        """
+        Returns a dictionary describing how busy I am: builds C{running} and
+        C{queued}, my C{slots}, whether I am C{admitting} more builds and,
+        if I have an C{admission}, its metrics.
+        """
+        d = dict(
+            running=self.scheduler.running,
+            queued=self.scheduler.queued(),
+            slots=self.scheduler.slots,
+            admitting=self._admits())
+        if self.admission is not None:
+            d.update(self.admission.getMetrics())
+        return d
+    
+    
+    def getLoad(self, project):
+        """
+        Returns my load (see L{IBuilder.getLoad}), or C{None} if I don't have
+        C{project}.
+        """
+        if self.path is None or not self.path.child(project).exists():
+            return None
+        return dict(
+            queued=self.scheduler.queued(),
+            running=self.scheduler.running,
+            slots=self.scheduler.slots,
+            admitting=self._admits())
+    
+    
+    def getProjects(self):
+        """
+        Returns the names of the projects in my path.
+        """
+        if self.path is None or not self.path.isdir():
+            return []
+        return sorted([x for x in self.path.listdir()
+                       if not x.startswith('.')])
+    
+    
+    def queuePosition(self, uid):
+        """
+        Returns the number of builds that will start before the next build
+        of the request with the given C{uid}, or C{None} if none of its
+        builds are waiting.
+        """
+        return self.scheduler.position(uid)
+    
+    
+    def _runBuild(self, build):
+        """
+        Called by my scheduler to start a build.
+        """
+        self.emit(build.toDict())
+        build.run()
+        return build.done
+        
+    
+    def _findHeads(self, project, test_path=None, index=None):
         """
         Find the directory roots for a given project and test_path
+        
+        test_path is a glob pattern matched against the project's
+        L{ScriptIndex} (or C{index}, a snapshot of it), in which '**'
+        matches any number of directories.
         """
         project_fp = self.path.child(project)
         if project_fp.exists():
             if test_path:
-                for child in project_fp.globChildren(test_path):
-                    yield child
+                if project_fp.isdir():
+                    if index is None:
+                        index = self._getIndex(project_fp)
+                    for path in index.match(test_path):
+                        yield project_fp.preauthChild(path)
             else:
                 yield project_fp
     
     
-    def _getChildFiles(self, root):
+    def _getIndex(self, project_fp):
+        """
+        Return the L{ScriptIndex} of the project directory C{project_fp}.
+        
+        Indexes made outside the reactor thread don't watch for changes,
+        because inotify can only be used from the reactor thread.
+        """
+        index = self._indexes.get(project_fp.path)
+        if index is None:
+            notifier = None
+            if self.watchFiles and threadable.isInIOThread():
+                if self._notifier is None:
+                    self._notifier = getNotifier()
+                notifier = self._notifier
+            index = ScriptIndex(project_fp, notifier)
+            self._indexes[project_fp.path] = index
+        return index
+    
+    
+    def _getChildFiles(self, root, index=None):
         """
         Given the root file/directory, return all the file descendents
+        
+        If given, the L{ScriptIndex} or snapshot C{index} (which must
+        contain C{root}) is used instead of walking C{root}.
         """
-        if root.isdir():
+        if index is not None:
+            prefix = len(index.root.path) + 1
+            for path in index.filesUnder(root.path[prefix:]):
+                yield FilePath(os.path.join(index.root.path, path))
+        elif root.isdir():
             for child in root.walk():
                 if child.isfile():
                     yield child
@@ -129,10 +443,19 @@ class FileBuilder(Builder, Emitter):
         if not project_root:
             return
         project_prefix = len(project_root[0].path) + 1
+        index = None
+        if project_root[0].isdir():
+            # check for changes once, not once per head
+            index = self._getIndex(project_root[0]).snapshot()
         
-        heads = self._findHeads(project, test_path)
+        seen = set()
+        heads = self._findHeads(project, test_path, index=index)
         for head in heads:
-            for child in self._getChildFiles(head):
+            for child in self._getChildFiles(head, index):
+                # heads can be nested when test_path has '**'
+                if child.path in seen:
+                    continue
+                seen.add(child.path)
                 # find test_path
                 b = FileBuild(child)
                 b.project = project
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import time
+
+from twisted.internet import threads
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+
+
+class ResultCache:
+    """
+    I remember the results of successful builds on disk, keyed by the
+    content of the build file, the version it was run with and its
+    environment.
+
+    Results older than C{maxAge} seconds are forgotten, and once the cache
+    holds more than C{maxSize} bytes the least recently used results are
+    forgotten.  I keep a rough count of the bytes I've stored so that I
+    only scan my directory, in a thread, when I might be too big (and
+    once when I first store a result, to learn how big I am).
+    """
+
+    maxSize = 50 * 1024 * 1024
+    maxAge = 7 * 24 * 60 * 60
+
+    def __init__(self, path, maxSize=None, maxAge=None):
+        if isinstance(path, FilePath):
+            self.path = path
+        else:
+            self.path = FilePath(path)
+        if maxSize is not None:
+            self.maxSize = maxSize
+        if maxAge is not None:
+            self.maxAge = maxAge
+        if not self.path.exists():
+            self.path.makedirs()
+        self._size = None
+        self._added = 0
+        self._evicting = None
+
+
+    def key(self, filepath, version, env):
+        """
+        Return the key for running the file at C{filepath} with C{version}
+        in the environment C{env}.
+        """
+        h = hashlib.sha256()
+        h.update(hashlib.sha256(filepath.getContent()).hexdigest())
+        h.update('\0' + str(version))
+        for k, v in sorted(env.items()):
+            h.update('\0%s=%s' % (k, v))
+        return h.hexdigest()
+
+
+    def get(self, key):
+        """
+        Return the result stored for C{key}, or C{None}.
+        """
+        fp = self.path.child(key)
+        try:
+            mtime = fp.getModificationTime()
+            content = fp.getContent()
+        except (IOError, OSError):
+            return None
+        if time.time() - mtime > self.maxAge:
+            fp.remove()
+            return None
+        try:
+            os.utime(fp.path, None)
+        except OSError:
+            # evicted meanwhile
+            pass
+        return json.loads(content)
+
+
+    def put(self, key, result):
+        """
+        Store the dictionary C{result} for C{key}, and make room in a
+        thread if I might be too big now.
+        """
+        content = json.dumps(result)
+        self.path.child(key).setContent(content)
+        self._added += len(content)
+        if self._evicting is not None:
+            return
+        if self._size is None or self._size + self._added > self.maxSize:
+            self._added = 0
+            self._evicting = threads.deferToThread(self.evict)
+            self._evicting.addCallbacks(self._evicted, self._evictFailed)
+
+
+    def _evicted(self, size):
+        self._evicting = None
+        self._size = size
+
+
+    def _evictFailed(self, f):
+        self._evicting = None
+        log.err(f, 'Evicting from %s' % (self.path.path,))
+
+
+    def evict(self):
+        """
+        Forget results that are too old, then the least recently used ones
+        until I fit in C{maxSize}.  Returns the number of bytes left.
+        """
+        now = time.time()
+        entries = []
+        for fp in self.path.children():
+            # FilePath.setContent leaves these around while writing
+            if fp.basename().endswith('.new'):
+                continue
+            try:
+                mtime = fp.getModificationTime()
+                size = fp.getsize()
+            except OSError:
+                continue
+            if now - mtime > self.maxAge:
+                fp.remove()
+            else:
+                entries.append((mtime, size, fp))
+        entries.sort()
+        total = sum([x[1] for x in entries])
+        while entries and total > self.maxSize:
+            mtime, size, fp = entries.pop(0)
+            fp.remove()
+            total -= size
+        return total
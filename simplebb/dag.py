@@ -0,0 +1,146 @@
+from simplebb.build import SKIPPED
+
+
+
+def provides(test_path, name):
+    """
+    Returns True if a build of C{test_path} is one of the builds named by
+    the dependency C{name}: the file itself, or any file under the directory
+    C{name}.
+    """
+    if test_path is None:
+        return False
+    name = name.strip('/')
+    return test_path == name or test_path.startswith(name + '/')
+
+
+
+class BuildGraph:
+    """
+    I start the builds of a single request in dependency order.
+
+    Builds are given to L{add} as they are found.  Those that don't depend
+    on anything are passed to C{submit} right away.  The rest wait until
+    L{close} is called, when all the builds are known, and then until every
+    build they depend on has succeeded.  Independent builds are submitted
+    together so they can run in parallel.
+
+    A build whose dependency fails, is missing or (through other builds)
+    depends on itself is not run but finished with L{SKIPPED}, which in turn
+    skips the builds depending on it.
+
+    Builds that are finished by someone else before they are submitted are
+    left alone.
+    """
+
+
+    def __init__(self, submit):
+        self.submit = submit
+        self._builds = []
+        self._waiting = []
+        self._depends = {}
+        self._closed = False
+        self._updating = False
+
+
+    def add(self, build):
+        """
+        Add a found build to the graph.
+        """
+        self._builds.append(build)
+        build.done.addCallback(self._finished)
+        if build.state == 'done':
+            return
+        depends = build.getDepends()
+        if depends:
+            self._depends[build.uid] = depends
+            self._waiting.append(build)
+        else:
+            self.submit(build)
+
+
+    def close(self):
+        """
+        Called once all the builds have been added.
+        """
+        self._closed = True
+        for build in self._waiting:
+            self._depends[build.uid] = self._resolve(build)
+        for build in self._cycles():
+            self._depends[build.uid] = None
+        self._update()
+
+
+    def waiting(self):
+        """
+        Returns the number of builds waiting on others.
+        """
+        return len(self._waiting)
+
+
+    def _resolve(self, build):
+        """
+        Returns the list of builds C{build} depends on, or C{None} if one of
+        its dependencies names no build.
+        """
+        ret = []
+        for name in self._depends[build.uid]:
+            found = [x for x in self._builds
+                     if x is not build and provides(x.test_path, name)]
+            if not found:
+                return None
+            ret.extend(found)
+        return ret
+
+
+    def _cycles(self):
+        """
+        Returns the waiting builds that can never start because they depend
+        on themselves or on such a build.
+        """
+        pending = set([x.uid for x in self._waiting])
+        changed = True
+        while changed:
+            changed = False
+            for build in self._waiting:
+                if build.uid not in pending:
+                    continue
+                depends = self._depends[build.uid] or []
+                if not [x for x in depends if x.uid in pending]:
+                    pending.discard(build.uid)
+                    changed = True
+        return [x for x in self._waiting if x.uid in pending]
+
+
+    def _finished(self, build):
+        self._update()
+        return build
+
+
+    def _update(self):
+        """
+        Submit the waiting builds whose dependencies have all succeeded and
+        skip those with a dependency that didn't.
+        """
+        if not self._closed or self._updating:
+            return
+        self._updating = True
+        try:
+            changed = True
+            while changed:
+                changed = False
+                for build in self._waiting[:]:
+                    depends = self._depends[build.uid]
+                    if build.state == 'done':
+                        self._waiting.remove(build)
+                    elif depends is None or [x for x in depends
+                            if x.state == 'done' and x.status != 0]:
+                        self._waiting.remove(build)
+                        build._finish(SKIPPED)
+                        changed = True
+                    elif not [x for x in depends if x.state != 'done']:
+                        self._waiting.remove(build)
+                        self.submit(build)
+                        changed = True
+        finally:
+            self._updating = False
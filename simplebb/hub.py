@@ -1,16 +1,36 @@
 from twisted.spread import pb
 from twisted.internet import endpoints
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from zope.interface import implements
 
 from simplebb.interface import IBuilder, IEmitter, IObserver, IBuilderHub
 from simplebb.report import Emitter
 from simplebb.builder import Builder
-from simplebb.util import generateId
+from simplebb.util import generateId, monotonic
 from simplebb.shell import ShellFactory
 
 from twisted.python import log
 
+from collections import deque, OrderedDict
+import random
+
+
+
+BROADCAST = 'broadcast'
+LEAST_LOADED = 'least-loaded'
+LOCAL = 'local'
+
+
+
+def loadKey(load):
+    """
+    Returns a key that sorts the loads (see L{IBuilder.getLoad}) of less
+    busy builders first: those admitting builds, then by the number of
+    builds that would be ahead of a new one, then the most slots.
+    """
+    free = load['slots'] - load['running']
+    return (not load['admitting'], load['queued'] - free, -load['slots'])
+
 
 
 class RemoteHub:
@@ -69,6 +89,8 @@ class RemoteHub:
         """
         def gotUID(uid):
             self.uid = uid
+            if self.hub is not None:
+                self.hub._identified(self)
         self.wrappedCallRemote('getUID').addCallback(gotUID)
         
         def gotName(name):
@@ -78,6 +100,21 @@ class RemoteHub:
 
     def build(self, request):
         self.wrappedCallRemote('build', request)
+
+
+    def getLoad(self, project):
+        return self.wrappedCallRemote('getLoad', project)
+
+
+    def getProjects(self):
+        return self.wrappedCallRemote('getProjects')
+
+
+    def projectsChanged(self, uid, projects, relayed=None):
+        if relayed:
+            return self.wrappedCallRemote('projectsChanged', uid, projects,
+                                          relayed)
+        return self.wrappedCallRemote('projectsChanged', uid, projects)
     
     
     def addBuilder(self, builder):
@@ -92,29 +129,321 @@ class RemoteHub:
         self.wrappedCallRemote('remObserver', observer)
 
 
-    def addObserver(self, observer):
-        self.wrappedCallRemote('addObserver', observer)
+    def addObserver(self, observer, filter=None):
+        """
+        Ask the remote side to send builds to C{observer}.  If C{filter} is
+        given, the remote side drops builds that don't pass it before they
+        are sent over the wire.
+        """
+        if filter is None:
+            self.wrappedCallRemote('addObserver', observer)
+        else:
+            self.wrappedCallRemote('addObserver', observer, filter)
+
+
+    def buildReceived(self, buildDict):
+        return self.wrappedCallRemote('buildReceived', buildDict)
+
+
+    def buildsReceived(self, buildDicts):
+        return self.wrappedCallRemote('buildsReceived', buildDicts)
+
 
 
+class PersistentRemoteHub(RemoteHub):
+    """
+    I am a L{RemoteHub} for a connection that my hub keeps up.
+    
+    If I can't connect, or lose the connection, I try again after a delay
+    that starts at C{initialDelay} seconds and grows by C{factor} with each
+    failed attempt up to C{maxDelay}.  Each delay is varied by up to
+    C{jitter} of itself so that hubs that lost a peer together don't all
+    come back at once.
+    
+    I stay one of my hub's builders and observers while I'm disconnected.
+    The requests and builds I'm sent in the meantime are buffered, at most
+    C{bufferLimit} of them (the oldest are dropped, counted in C{dropped}),
+    and sent once I reconnect and have registered with the remote hub
+    again.  Other calls have no result while I'm disconnected.
+    
+    C{original} is C{None} while I'm disconnected.
+    """
+    
+    initialDelay = 0.5
+    maxDelay = 30.0
+    factor = 2.0
+    jitter = 0.5
+    
+    bufferLimit = 10000
+    
+    clock = reactor
+    
+    
+    def __init__(self, hub, description):
+        RemoteHub.__init__(self, None)
+        self.hub = hub
+        self.description = description
+        self.attempts = 0
+        self.buffered = deque()
+        self.dropped = 0
+        self.random = random.random
+        self._registered = False
+        self._stopped = False
+        self._retry = None
+        self._protocol = None
+        self._started = None
+    
+    
+    def __eq__(self, other):
+        if self.original is None:
+            return other is self
+        return RemoteHub.__eq__(self, other)
+    
+    
+    def start(self):
+        """
+        Start connecting.
+        
+        Returns a Deferred that fires with me once I'm first connected.
+        """
+        self._started = defer.Deferred()
+        self._attempt()
+        return self._started
+    
+    
+    def stop(self):
+        """
+        Stop reconnecting, drop the connection and leave my hub.
+        """
+        self._stopped = True
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        self._retry = None
+        RemoteHub.disconnectMe(self)
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+    
+    
+    def nextDelay(self):
+        """
+        Returns the number of seconds to wait before the next attempt.
+        """
+        delay = min(self._backoff(), self.maxDelay)
+        delay *= 1 + self.jitter * (2 * self.random() - 1)
+        return min(delay, self.maxDelay)
+    
+    
+    def _backoff(self):
+        try:
+            return self.initialDelay * self.factor ** self.attempts
+        except OverflowError:
+            return self.maxDelay
+    
+    
+    def _attempt(self):
+        self._retry = None
+        d = self.hub._connectRoot(self.description)
+        d.addCallbacks(self._connected, self._failed)
+    
+    
+    def _failed(self, failure):
+        log.msg('Could not connect to %s: %s' % (self.description,
+                                                 failure.getErrorMessage()))
+        self._reconnectLater()
+    
+    
+    def _reconnectLater(self):
+        if self._stopped:
+            return
+        delay = self.nextDelay()
+        if self._backoff() < self.maxDelay:
+            # the delay has stopped growing otherwise
+            self.attempts += 1
+        self._retry = self.clock.callLater(delay, self._attempt)
+    
+    
+    def _connected(self, result):
+        protocol, root = result
+        if self._stopped:
+            protocol.transport.loseConnection()
+            return
+        self.attempts = 0
+        self._protocol = protocol
+        self.original = root
+        root.notifyOnDisconnect(self._lost)
+        if not self._registered:
+            self._registered = True
+            self.hub.gotRemoteRoot(self)
+        else:
+            self.addBuilder(self.hub)
+            self.addObserver(self.hub, self.hub.observerFilter)
+            self.getStaticInfo()
+            self.hub._askProjects(self)
+        self._replay()
+        if self._started is not None:
+            started, self._started = self._started, None
+            started.callback(self)
+    
+    
+    def _lost(self, root):
+        log.msg('Lost connection to %s' % (self.description,))
+        self.original = None
+        self._protocol = None
+        self._reconnectLater()
+    
+    
+    def disconnectMe(self):
+        """
+        I don't leave my hub when the remote side goes away, I reconnect.
+        """
+    
+    
+    def wrappedCallRemote(self, *args):
+        if self.original is None:
+            return defer.succeed(None)
+        return RemoteHub.wrappedCallRemote(self, *args)
+    
+    
+    def _buffer(self, args):
+        if len(self.buffered) >= self.bufferLimit:
+            self.buffered.popleft()
+            self.dropped += 1
+        self.buffered.append(args)
+    
+    
+    def _send(self, *args):
+        """
+        Call the remote method or, if that can't be done now, buffer the
+        call to be made once I've reconnected.
+        
+        Calls lost along with the connection are made again, which repeats
+        nothing because hubs ignore requests and builds they've seen.
+        """
+        if self.original is None:
+            self._buffer(args)
+            return None
+        def eb(failure):
+            failure.trap(pb.DeadReferenceError, pb.PBConnectionLost)
+            self._buffer(args)
+        try:
+            d = self.original.callRemote(*args)
+        except pb.DeadReferenceError:
+            self._buffer(args)
+            return None
+        return d.addErrback(eb)
+    
+    
+    def _replay(self):
+        buffered, self.buffered = self.buffered, deque()
+        for args in buffered:
+            self._send(*args)
+    
+    
+    def build(self, request):
+        self._send('build', request)
+    
+    
     def buildReceived(self, buildDict):
-        self.wrappedCallRemote('buildReceived', buildDict)
+        return self._send('buildReceived', buildDict)
+    
+    
+    def buildsReceived(self, buildDicts):
+        return self._send('buildsReceived', buildDicts)
 
 
 
 class Hub(Builder, Emitter, pb.Root):
     """
     I am a build server instance's central hub.
+    
+    How I pass requests on to my builders depends on the request's
+    C{dispatch}, or else my C{dispatchMode}:
+    
+        - L{BROADCAST}: every builder gets the request.
+        
+        - L{LEAST_LOADED}: only the least busy builder that can build the
+          project gets it (see L{loadKey}).  Remote hubs count as the sum of
+          their local builders, and are sent the request as L{LOCAL} so that
+          it isn't passed on again.  A builder may not have queued the
+          builds of a request it was just sent yet, so each request sent to
+          it in the last C{dispatchWindow} seconds counts as a queued build
+          too, and a burst of requests is spread out.
+        
+        - L{LOCAL}: like L{LEAST_LOADED}, but only among my builders that
+          aren't remote hubs.
+    
+    Either way only builders that can build the request's project are
+    considered.  I ask each builder for its projects when it is added, and
+    keep an index of the builders by project.  Builders that haven't said
+    (or can't say) what they can build are sent everything.
+    
+    I tell the hubs I'm connected to which projects my local builders can
+    build, and also which projects each of them can reach through me and
+    how many hops away, as learned from my other remote hubs (but not from
+    itself), leaving out those C{maxHops} or more hops away.  They are told
+    again when either changes.  Broadcast requests only go to the remote
+    hubs that can reach their project, and L{LEAST_LOADED} only considers
+    those that can build it themselves.  L{refreshProjects} asks my local
+    builders again, which L{startRefreshing} does every
+    C{projectRefreshInterval} seconds.  That starts when I start a server
+    or connect to another hub, and stops once I've stopped them all.  A
+    request for a project I don't know also makes me ask again (at most
+    every C{projectMissInterval} seconds), so that a project added since
+    is built straight away.
+    
+    Broadcast requests carry the number of C{hops} they have made between
+    hubs and the uids of the hubs that have C{visited} them: those they
+    passed through and those they were sent to along the way.  I don't
+    send a request on to a hub that has already been visited, or at all
+    once it has made C{maxHops} hops, so a request is never sent back to a
+    hub it has visited.  Hubs that were sent it along different paths
+    don't know about each other, though, and may still send it to each
+    other or to the same hub; hubs ignore the requests they've seen.
+    
+    Build dictionaries I emit are tagged with the uid of the hub they came
+    from first (C{origin}) and of the last C{eventPathLength} hubs that
+    emitted them (C{via}), and I don't send them to observing hubs in
+    either, so builds aren't echoed back to the hub they came from.
     """
     
     implements(IBuilder, IEmitter, IObserver, IBuilderHub)
     
     remoteHubFactory = RemoteHub
+    
+    # filter (see simplebb.report.matches) sent to hubs I connect to,
+    # restricting the builds they tell me about.
+    observerFilter = None
+    
+    dispatchMode = BROADCAST
+    
+    dispatchWindow = 5.0
+    
+    projectRefreshInterval = 60
+    
+    projectMissInterval = 1.0
+    
+    maxHops = 16
+    
+    # how many advertisements from hubs I don't know yet to keep
+    unidentifiedLimit = 64
+    
+    eventPathLength = 8
 
 
     def __init__(self):
         Emitter.__init__(self)
         Builder.__init__(self)
         self._builders = []
+        self._builderProjects = []
+        self._projectIndex = {}
+        self._relayIndex = {}
+        self._unknownProjects = []
+        self._advertised = []
+        self._unidentified = OrderedDict()
+        self._refresher = None
+        self._lastMiss = None
+        self._dispatched = []
+        self._dispatchClock = monotonic
         self._servers = {}
         self._outgoingConns = {}
 
@@ -125,6 +454,47 @@ class Hub(Builder, Emitter, pb.Root):
         interesting has happened with this build.
         """
         self.emit(buildDict)
+    
+    
+    def buildsReceived(self, buildDicts):
+        """
+        Called by Emitters that I am observing with several builds at once.
+        """
+        for buildDict in buildDicts:
+            self.emit(buildDict)
+    
+    
+    def emit(self, buildDict):
+        """
+        Tag C{buildDict} with where it has been and emit it.
+        """
+        Emitter.emit(self, self._tagEvent(buildDict))
+    
+    
+    def _tagEvent(self, buildDict):
+        """
+        Returns a copy of C{buildDict} with me added to its C{via} hubs,
+        and C{origin} set if it didn't come from another hub.
+        """
+        if not isinstance(buildDict, dict):
+            return buildDict
+        via = list(buildDict.get('via', []))
+        if self.uid not in via:
+            via.append(self.uid)
+        return dict(buildDict, origin=buildDict.get('origin', self.uid),
+                    via=via[-self.eventPathLength:])
+    
+    
+    def _interested(self, buildDict):
+        """
+        Leave out the observing hubs that have already seen C{buildDict}.
+        """
+        subs = Emitter._interested(self, buildDict)
+        if not isinstance(buildDict, dict):
+            return subs
+        seen = [buildDict.get('origin')] + buildDict.get('via', [])
+        return [x for x in subs if not isinstance(x.observer, RemoteHub)
+                or x.observer.uid is None or x.observer.uid not in seen]
 
 
     def addBuilder(self, builder):
@@ -133,6 +503,15 @@ class Hub(Builder, Emitter, pb.Root):
         """
         if builder not in self._builders:
             self._builders.append(builder)
+            # builder, its projects (None if unknown) and, for remote hubs,
+            # the hops to the projects they relay to
+            self._builderProjects.append([builder, None, {}])
+            self._reindex()
+            self._askProjects(builder)
+            if isinstance(builder, RemoteHub):
+                # it asks for my projects itself
+                self._advertised.append([builder, (self.getProjects(), {})])
+                self._advertise()
 
 
     def remBuilder(self, builder):
@@ -141,14 +520,326 @@ class Hub(Builder, Emitter, pb.Root):
         """
         if builder in self._builders:
             self._builders.remove(builder)
+            self._dispatched = [x for x in self._dispatched
+                                if not x[0] == builder]
+            self._advertised = [x for x in self._advertised
+                                if not x[0] == builder]
+            entry = self._projectsEntry(builder)
+            if entry is None:
+                return
+            self._builderProjects.remove(entry)
+            self._reindex()
+            self._advertise()
+    
+    
+    def getProjects(self):
+        """
+        Returns the projects my local builders can build.
+        """
+        projects = set()
+        for builder, known, relayed in self._builderProjects:
+            if known is not None and not isinstance(builder, RemoteHub):
+                projects.update(known)
+        return sorted(projects)
+    
+    
+    def refreshProjects(self):
+        """
+        Ask my local builders again which projects they can build.
+        """
+        for builder in self._localBuilders():
+            self._askProjects(builder)
+    
+    
+    def startRefreshing(self, clock=reactor):
+        """
+        Call L{refreshProjects} every C{projectRefreshInterval} seconds.
+        """
+        if self._refresher is not None:
+            return
+        self._refresher = task.LoopingCall(self.refreshProjects)
+        self._refresher.clock = clock
+        self._refresher.start(self.projectRefreshInterval, now=False)
+    
+    
+    def stopRefreshing(self):
+        if self._refresher is not None:
+            self._refresher.stop()
+            self._refresher = None
+    
+    
+    def _networked(self):
+        """
+        Called when I start or stop a server or a connection to another
+        hub.  I refresh my projects while there are any.
+        """
+        if self._servers or self._outgoingConns:
+            self.startRefreshing()
+        else:
+            self.stopRefreshing()
+    
+    
+    def _refreshMissing(self, project):
+        """
+        Ask my local builders for their projects again if C{project} isn't
+        one of them, and I haven't just done so.
+        """
+        if project is None or project in self._projectIndex:
+            return
+        now = monotonic()
+        if (self._lastMiss is not None and
+            now - self._lastMiss < self.projectMissInterval):
+            return
+        self._lastMiss = now
+        self.refreshProjects()
+    
+    
+    def _askProjects(self, builder):
+        d = defer.maybeDeferred(lambda: builder.getProjects())
+        d.addCallbacks(self._setProjects, self._projectsUnknown,
+                       callbackArgs=(builder,), errbackArgs=(builder,))
+    
+    
+    def _projectsUnknown(self, failure, builder):
+        log.msg('Could not get the projects of %r: %s' % (
+                builder, failure.getErrorMessage()))
+    
+    
+    def _projectsEntry(self, builder):
+        for entry in self._builderProjects:
+            if entry[0] == builder:
+                return entry
+        return None
+    
+    
+    def _setProjects(self, projects, builder):
+        """
+        Record that C{builder} can build C{projects}.
+        """
+        entry = self._projectsEntry(builder)
+        if entry is None or projects is None:
+            # removed in the meantime, or the connection was lost
+            return
+        entry[1] = set(projects)
+        self._reindex()
+        self._advertise()
+    
+    
+    def _reindex(self):
+        index = {}
+        relayIndex = {}
+        unknown = []
+        for builder, projects, relayed in self._builderProjects:
+            if projects is None:
+                unknown.append(builder)
+                continue
+            for project in projects:
+                index.setdefault(project, []).append(builder)
+            for project in relayed:
+                if project not in projects:
+                    relayIndex.setdefault(project, []).append(builder)
+        self._projectIndex = index
+        self._relayIndex = relayIndex
+        self._unknownProjects = unknown
+    
+    
+    def _relayed(self, exclude=None):
+        """
+        Returns the hops to the projects my remote hubs other than
+        C{exclude} can reach, but my local builders can't build, leaving
+        out those C{maxHops} or more hops away.
+        """
+        local = set(self.getProjects())
+        relayed = {}
+        for builder, projects, routes in self._builderProjects:
+            if not isinstance(builder, RemoteHub) or builder == exclude:
+                continue
+            hops = dict(routes)
+            hops.update(dict.fromkeys(projects or (), 0))
+            for project, count in hops.items():
+                count += 1
+                if project in local or count >= self.maxHops:
+                    continue
+                if count < relayed.get(project, self.maxHops):
+                    relayed[project] = count
+        return relayed
+    
+    
+    def _advertise(self):
+        """
+        Tell the hubs I'm connected to about a change to my projects, or to
+        those they can reach through me.
+        """
+        projects = self.getProjects()
+        for entry in self._advertised:
+            advert = (projects, self._relayed(entry[0]))
+            if advert == entry[1]:
+                continue
+            entry[1] = advert
+            entry[0].projectsChanged(self.uid, *advert)
+    
+    
+    def _capable(self, project, relayed=False):
+        """
+        Returns the builders that can build C{project} and, if C{relayed},
+        the remote hubs that can reach a hub that can.
+        """
+        if project is None:
+            return list(self._builders)
+        builders = self._projectIndex.get(project, []) + self._unknownProjects
+        if relayed:
+            builders = builders + self._relayIndex.get(project, [])
+        return builders
     
     
     def _build(self, request):
         """
         As a Hub, I pass build requests on to my list of Builders.
+        
+        Unless broadcasting, returns a Deferred that fires with the builder
+        chosen, or C{None} if none could build the request.
+        """
+        mode = request.get('dispatch', self.dispatchMode)
+        self._refreshMissing(request.get('project'))
+        if mode == BROADCAST:
+            self._broadcast(request, self._capable(request.get('project'),
+                                                   relayed=True))
+            return
+        builders = self._capable(request.get('project'))
+        if mode == LOCAL:
+            builders = [x for x in builders if not isinstance(x, RemoteHub)]
+        return self._dispatch(request, builders)
+    
+    
+    def _broadcast(self, request, builders):
         """
-        for builder in self._builders:
-            builder.build(request)
+        Send C{request} to all of C{builders}, except remote hubs it has
+        already visited or is too many hops away to go on to.
+        """
+        hops = request.get('hops', 0)
+        visited = list(request.get('visited', []))
+        hubs = []
+        for builder in builders:
+            if not isinstance(builder, RemoteHub):
+                builder.build(request)
+            elif hops < self.maxHops and builder.uid not in visited:
+                hubs.append(builder)
+        if not hubs:
+            return
+        for uid in [self.uid] + [x.uid for x in hubs]:
+            if uid is not None and uid not in visited:
+                visited.append(uid)
+        forwarded = dict(request, hops=hops + 1, visited=visited)
+        for hub in hubs:
+            hub.build(forwarded)
+    
+    
+    def _localBuilders(self):
+        return [x for x in self._builders if not isinstance(x, RemoteHub)]
+    
+    
+    def _dispatch(self, request, builders):
+        """
+        Send C{request} to the least busy of C{builders}.
+        """
+        builders = list(builders)
+        project = request.get('project')
+        loads = [defer.maybeDeferred(x.getLoad, project) for x in builders]
+        
+        def gotLoads(results):
+            best = None
+            for (success, load), builder in zip(results, builders):
+                if not success or load is None:
+                    continue
+                queued = load['queued'] + self._inFlight(builder)
+                key = loadKey(dict(load, queued=queued))
+                if best is None or key < best[0]:
+                    best = (key, builder)
+            if best is None:
+                log.msg('No builder for request %s of %r' % (
+                        request.get('uid'), project))
+                return None
+            builder = best[1]
+            self._sentTo(builder)
+            if isinstance(builder, RemoteHub):
+                builder.build(dict(request, dispatch=LOCAL))
+            else:
+                builder.build(request)
+            return builder
+        
+        d = defer.DeferredList(loads, consumeErrors=True)
+        return d.addCallback(gotLoads)
+    
+    
+    def _dispatchedEntry(self, builder):
+        for entry in self._dispatched:
+            if entry[0] == builder:
+                return entry
+        entry = [builder, []]
+        self._dispatched.append(entry)
+        return entry
+    
+    
+    def _inFlight(self, builder):
+        """
+        Returns the number of requests sent to C{builder} in the last
+        C{dispatchWindow} seconds.
+        """
+        entry = self._dispatchedEntry(builder)
+        now = self._dispatchClock()
+        entry[1] = [x for x in entry[1] if now - x < self.dispatchWindow]
+        return len(entry[1])
+    
+    
+    def _sentTo(self, builder):
+        self._dispatchedEntry(builder)[1].append(self._dispatchClock())
+    
+    
+    def getLoad(self, project):
+        """
+        Returns the combined load of my local builders that can build
+        C{project}, or C{None} if none of them can.
+        """
+        loads = [defer.maybeDeferred(x.getLoad, project)
+                 for x in self._localBuilders()]
+        
+        def combine(results):
+            total = None
+            for success, load in results:
+                if not success or load is None:
+                    continue
+                if total is None:
+                    total = dict(queued=0, running=0, slots=0,
+                                 admitting=False)
+                for k in ('queued', 'running', 'slots'):
+                    total[k] += load[k]
+                total['admitting'] = total['admitting'] or load['admitting']
+            return total
+        
+        d = defer.DeferredList(loads, consumeErrors=True)
+        return d.addCallback(combine)
+    
+    
+    def queuePosition(self, uid):
+        """
+        Returns a Deferred that fires with the smallest number of builds
+        that will start before the next build of the request with the given
+        C{uid} on one of my local builders, or C{None} if none of its builds
+        are waiting here.
+        """
+        positions = [defer.maybeDeferred(x.queuePosition, uid)
+                     for x in self._localBuilders()
+                     if hasattr(x, 'queuePosition')]
+        
+        def combine(results):
+            found = [x for success, x in results
+                     if success and x is not None]
+            if not found:
+                return None
+            return min(found)
+        
+        d = defer.DeferredList(positions, consumeErrors=True)
+        return d.addCallback(combine)
 
     # ------------------------------------------------------------------------
     # remote methods   
@@ -161,6 +852,20 @@ class Hub(Builder, Emitter, pb.Root):
         self.build(request)
     
     
+    def remote_buildReceived(self, buildDict):
+        """
+        Call through to buildReceived.
+        """
+        self.buildReceived(buildDict)
+    
+    
+    def remote_buildsReceived(self, buildDicts):
+        """
+        Call through to buildsReceived.
+        """
+        self.buildsReceived(buildDicts)
+    
+    
     def remote_addBuilder(self, builder):
         """
         Wraps the remote builder in remoteHubFactory and passes it on.
@@ -168,6 +873,7 @@ class Hub(Builder, Emitter, pb.Root):
         o = self.remoteHubFactory(builder)
         o.hub = self
         self.addBuilder(o)
+        o.getStaticInfo()
     
     
     def remote_remBuilder(self, builder):
@@ -178,6 +884,62 @@ class Hub(Builder, Emitter, pb.Root):
         self.remBuilder(o)
     
     
+    def remote_getLoad(self, project):
+        """
+        Call through to getLoad.
+        """
+        return self.getLoad(project)
+    
+    
+    def remote_queuePosition(self, uid):
+        """
+        Call through to queuePosition.
+        """
+        return self.queuePosition(uid)
+    
+    
+    def remote_getProjects(self):
+        """
+        Call through to getProjects.
+        """
+        return self.getProjects()
+    
+    
+    def remote_projectsChanged(self, uid, projects, relayed=None):
+        """
+        Called by the remote hub with the uid C{uid} when the projects it
+        can build, or the hops to the projects it C{relayed} to, change.
+        
+        The hub is found by its uid because a hub passing itself over the
+        wire doesn't arrive as the same reference it was connected with.
+        If I don't know which hub it is yet, I keep what it said until I
+        do, and ask the remote hubs whose uids I don't know for their
+        projects.
+        """
+        hubs = [x for x in self._builders if isinstance(x, RemoteHub)]
+        for hub in hubs:
+            if hub.uid == uid:
+                self._projectsEntry(hub)[2] = dict(relayed or {})
+                self._setProjects(projects, hub)
+                return
+        self._unidentified.pop(uid, None)
+        self._unidentified[uid] = (projects, relayed)
+        while len(self._unidentified) > self.unidentifiedLimit:
+            self._unidentified.popitem(last=False)
+        for hub in hubs:
+            if hub.uid is None:
+                self._askProjects(hub)
+    
+    
+    def _identified(self, hub):
+        """
+        Called when the uid of the remote hub C{hub} is known.
+        """
+        advert = self._unidentified.pop(hub.uid, None)
+        if advert is not None and hub in self._builders:
+            self.remote_projectsChanged(hub.uid, *advert)
+    
+    
     def remote_getUID(self):
         """
         Returns my uid
@@ -192,13 +954,15 @@ class Hub(Builder, Emitter, pb.Root):
         return self.name
     
     
-    def remote_addObserver(self, observer):
+    def remote_addObserver(self, observer, filter=None):
         """
-        Add the remote observer to my list of observers
+        Add the remote observer to my list of observers, only sending it
+        builds that pass C{filter}.
         """
         wrapped = self.remoteHubFactory(observer)
         wrapped.hub = self
-        self.addObserver(wrapped)
+        wrapped.getStaticInfo()
+        self.addObserver(wrapped, filter)
 
 
     def remote_remObserver(self, observer):
@@ -236,6 +1000,7 @@ class Hub(Builder, Emitter, pb.Root):
         
         def getServer(server, description):
             self._servers[description] = server
+            self._networked()
             return server
         return server.listen(factory).addCallback(getServer, description)
     
@@ -248,21 +1013,33 @@ class Hub(Builder, Emitter, pb.Root):
         """
         d = self._servers[description].stopListening()
         del self._servers[description]
+        self._networked()
         return d
     
     
-    def connect(self, description):
+    def connect(self, description, persistent=False):
         """
         Connect to another PB Server as a client with the given endpoint
         description string
         
+        If C{persistent}, keep reconnecting whenever the connection can't be
+        made or is lost (see L{PersistentRemoteHub}).  The returned Deferred
+        fires once it's first made.
+        
         @see: U{http://socuteurl.com/twiggykitteh}
         """
+        if persistent:
+            remote = PersistentRemoteHub(self, description)
+            self._outgoingConns[description] = remote
+            self._networked()
+            return remote.start()
+        
         client = endpoints.clientFromString(reactor, description)
         factory = pb.PBClientFactory()
         
         def getClient(client, description):
             self._outgoingConns[description] = client
+            self._networked()
             return client
         
         def getRoot(client, factory):
@@ -276,14 +1053,32 @@ class Hub(Builder, Emitter, pb.Root):
         return d
     
     
+    def _connectRoot(self, description):
+        """
+        Connect to the PB Server at C{description}.
+        
+        Returns a Deferred that fires with the connection's protocol and
+        the server's root object.
+        """
+        client = endpoints.clientFromString(reactor, description)
+        factory = pb.PBClientFactory()
+        
+        def getRoot(protocol):
+            d = factory.getRootObject()
+            return d.addCallback(lambda root: (protocol, root))
+        return client.connect(factory).addCallback(getRoot)
+    
+    
     def disconnect(self, description):
         """
         Disconnect the previous connection (initiated by me) to another
         server matching the given endpoint description.
         """
-        d = self._outgoingConns[description].transport.loseConnection()
-        del self._outgoingConns[description]
-        return d
+        conn = self._outgoingConns.pop(description)
+        self._networked()
+        if isinstance(conn, PersistentRemoteHub):
+            return conn.stop()
+        return conn.transport.loseConnection()
     
     
     def gotRemoteRoot(self, remote):
@@ -300,7 +1095,7 @@ class Hub(Builder, Emitter, pb.Root):
         self.addObserver(remote)
         
         remote.addBuilder(self)
-        remote.addObserver(self)
+        remote.addObserver(self, self.observerFilter)
         remote.getStaticInfo()
 
 
@@ -0,0 +1,272 @@
+import os
+import re
+import glob
+import fnmatch
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+from simplebb.util import LRUCache
+
+
+
+# inotify events that change which files are under a directory
+WATCH_MASK = 0
+if inotify is not None:
+    WATCH_MASK = (inotify.IN_CREATE | inotify.IN_DELETE |
+                  inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+                  inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF)
+
+
+
+def getNotifier():
+    """
+    Returns a started C{INotify} instance, or C{None} if inotify is not
+    available here.
+    """
+    if inotify is None:
+        return None
+    try:
+        notifier = inotify.INotify()
+    except Exception:
+        return None
+    notifier.startReading()
+    return notifier
+
+
+
+# pattern segment matching any number of directories
+RECURSIVE = object()
+
+# compiled patterns, by pattern
+_patterns = LRUCache(256)
+
+
+
+def compilePattern(pattern):
+    """
+    Return a compiled form of the '/'-separated glob C{pattern} for
+    L{ScriptIndex.match}.
+    
+    Each segment becomes a plain name if it has no wildcards, L{RECURSIVE}
+    for '**', and otherwise a (regex, matchHidden) pair.  Compiled patterns
+    are cached.
+    """
+    compiled = _patterns.get(pattern)
+    if compiled is None:
+        compiled = tuple([_compileSegment(x) for x in pattern.split('/')
+                          if x not in ('', '.')])
+        _patterns[pattern] = compiled
+    return compiled
+
+
+
+def _compileSegment(segment):
+    if segment == '**':
+        return RECURSIVE
+    if not glob.has_magic(segment):
+        return segment
+    return (re.compile(fnmatch.translate(segment)), segment.startswith('.'))
+
+
+
+class ScriptIndex:
+    """
+    I remember the paths of all the files under a directory, relative to
+    it, so that they can be looked up without walking the directory.
+    
+    The paths are kept in a trie of nested dictionaries, one per directory,
+    mapping names to a dictionary (for directories) or C{None} (for files).
+    
+    I notice when files are added or removed either through an inotify
+    C{notifier} or, without one, by checking whether any directory's
+    modification time has changed.
+    """
+
+
+    def __init__(self, root, notifier=None):
+        self.root = root
+        self.notifier = notifier
+        self._trie = None
+        self._dirs = {}
+        self._dirty = True
+        if notifier is not None:
+            notifier.watch(root, WATCH_MASK, autoAdd=True,
+                           callbacks=[self._changed], recursive=True)
+
+
+    def _changed(self, ignore, filepath, mask):
+        self._dirty = True
+
+
+    def isStale(self):
+        """
+        Returns True if files may have been added or removed since I last
+        scanned.
+        """
+        if self._trie is None or self._dirty:
+            return True
+        if self.notifier is not None:
+            return False
+        for path, mtime in self._dirs.iteritems():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+    def scan(self):
+        """
+        Walk my root directory and remember all the files under it.
+        """
+        self._dirty = False
+        root = self.root.path
+        trie = {}
+        nodes = {root: trie}
+        dirs = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            try:
+                dirs[dirpath] = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            node = nodes.pop(dirpath)
+            for name in dirnames:
+                node[name] = nodes[os.path.join(dirpath, name)] = {}
+            for name in filenames:
+                node[name] = None
+        self._trie = trie
+        self._dirs = dirs
+
+
+    def _getTrie(self):
+        if self.isStale():
+            self.scan()
+        return self._trie
+
+
+    def files(self):
+        """
+        Returns the sorted list of paths of all the files under my root,
+        scanning again first if needed.
+        """
+        return self.filesUnder('')
+
+
+    def snapshot(self):
+        """
+        Returns a L{Snapshot} of the files under my root, scanning again
+        first if needed.  Many lookups can be made in it with only one check
+        for changes.
+        """
+        return Snapshot(self.root, self._getTrie())
+
+
+    def filesUnder(self, path):
+        """
+        Returns the paths of files at or under the relative C{path} ('' is
+        the root).
+        """
+        return self.snapshot().filesUnder(path)
+
+
+    def match(self, pattern):
+        """
+        Returns the sorted relative paths of files and directories matching
+        the glob C{pattern} (see L{Snapshot.match}).
+        """
+        return self.snapshot().match(pattern)
+
+
+
+class Snapshot:
+    """
+    I am the files under C{root} as a L{ScriptIndex} last saw them.
+    """
+
+
+    def __init__(self, root, trie):
+        self.root = root
+        self._trie = trie
+
+
+    def filesUnder(self, path):
+        """
+        Returns the paths of files at or under the relative C{path} ('' is
+        the root).
+        """
+        node = self._trie
+        parts = [x for x in path.split(os.sep) if x]
+        for part in parts:
+            if node is None or part not in node:
+                return []
+            node = node[part]
+        ret = []
+        self._collect(node, '/'.join(parts), ret)
+        return ret
+
+
+    def _collect(self, node, path, ret):
+        """
+        Append the paths of all the files at or under C{node} to C{ret}.
+        """
+        if node is None:
+            ret.append(path)
+            return
+        for name in sorted(node):
+            if path:
+                self._collect(node[name], path + '/' + name, ret)
+            else:
+                self._collect(node[name], name, ret)
+
+
+    def match(self, pattern):
+        """
+        Returns the sorted relative paths of files and directories matching
+        the glob C{pattern}.
+        
+        Segments are matched like L{glob.glob} matches them, and a '**'
+        segment matches any number (including none) of directories.
+        """
+        segments = compilePattern(pattern)
+        if not segments:
+            return []
+        found = set()
+        self._match(self._trie, '', segments, 0, found)
+        return sorted(found)
+
+
+    def _match(self, node, path, segments, i, found):
+        if i == len(segments):
+            found.add(path)
+            return
+        if node is None:
+            return
+        segment = segments[i]
+        if segment is RECURSIVE:
+            self._match(node, path, segments, i + 1, found)
+            for name, child in node.iteritems():
+                if child is not None and not name.startswith('.'):
+                    self._match(child, self._join(path, name), segments, i,
+                                found)
+        elif isinstance(segment, basestring):
+            if segment in node:
+                self._match(node[segment], self._join(path, segment),
+                            segments, i + 1, found)
+        else:
+            regex, matchHidden = segment
+            for name, child in node.iteritems():
+                if name.startswith('.') and not matchHidden:
+                    continue
+                if regex.match(name):
+                    self._match(child, self._join(path, name), segments,
+                                i + 1, found)
+
+
+    def _join(self, path, name):
+        if path:
+            return path + '/' + name
+        return name
@@ -20,6 +20,11 @@ class IBuild(Interface):
         ''')
 
 
+    state = Attribute('''
+        str: None, 'queued', 'running' or 'done'.
+        ''')
+
+
     version = Attribute('''
         str: version passed to the underlying build steps.
         ''')
@@ -38,7 +43,7 @@ class IBuild(Interface):
 
 
     runtime = Attribute('''
-        int: number of seconds it took to run this Build.
+        float: number of seconds it took to run this Build.
         ''')
     
     
@@ -81,6 +86,24 @@ class IBuilder(Interface):
         """
 
 
+    def getLoad(project):
+        """
+        Return a dictionary saying how busy I am, with the number of builds
+        C{queued} and C{running}, my number of C{slots} and whether I am
+        C{admitting} more builds, or C{None} if I can't build C{project}.
+        
+        The result may be a Deferred.
+        """
+
+
+    def getProjects():
+        """
+        Return the sorted list of the names of the projects I can build.
+        
+        The result may be a Deferred.
+        """
+
+
 
 class IEmitter(Interface):
     """
@@ -88,9 +111,12 @@ class IEmitter(Interface):
     """
     
     
-    def addObserver(observer):
+    def addObserver(observer, filter=None):
         """
         Register an observer to be notified by this emitter.
+        
+        If given, C{filter} is a dictionary restricting which builds the
+        observer is told about (see L{simplebb.report.matches}).
         """
     
     
@@ -110,6 +136,13 @@ class IObserver(Interface):
         """
         Called with a Build dictionary.
         """
+    
+    
+    def buildsReceived(buildDicts):
+        """
+        Called with a list of Build dictionaries, in the order they were
+        emitted.
+        """
 
 
 
@@ -1,37 +1,308 @@
 from zope.interface import implements
+from twisted.internet import reactor, defer
+from twisted.python import log
 from simplebb.interface import IEmitter
+from simplebb.util import LRUSet
 
+from collections import deque
 import hashlib
 
 
 
+# build dictionary fields that identify one state (or log chunk) of one build
+KEY_FIELDS = ('uid', 'status', 'state', 'seq')
+
+# what to do when an observer's queue is full
+DROP_OLDEST = 'drop-oldest'
+COLLAPSE = 'collapse'
+DISCONNECT = 'disconnect'
+
+
+
+def eventKey(buildDict):
+    """
+    Return a small hashable key for C{buildDict} used to detect repeats.
+    
+    Build dictionaries are keyed on their L{KEY_FIELDS}; anything else is
+    keyed on a digest of its text.
+    """
+    if isinstance(buildDict, dict) and 'uid' in buildDict:
+        return tuple([buildDict.get(x) for x in KEY_FIELDS])
+    return hashlib.sha256(unicode(buildDict)).digest()
+
+
+
+def statusClass(status, done=False):
+    """
+    Return 'pending', 'success' or 'failure' for a build status.
+    
+    A build that is C{done} without a status (killed by a signal, say) has
+    failed.
+    """
+    if status is None:
+        if done:
+            return 'failure'
+        return 'pending'
+    elif status == 0:
+        return 'success'
+    return 'failure'
+
+
+
+def isDone(buildDict):
+    """
+    Return C{True} if the build C{buildDict} describes has finished.
+    """
+    if 'state' in buildDict:
+        return buildDict['state'] == 'done'
+    # from a hub that doesn't send states
+    return buildDict.get('status') is not None
+
+
+
+def matches(filter, buildDict):
+    """
+    Return C{True} if C{buildDict} passes C{filter}.
+    
+    A filter is a dictionary with any of these keys:
+    
+        - C{project}: the build's project must equal this.
+        - C{test_path}: the build's test_path must start with this.
+        - C{status}: one of 'pending', 'success' or 'failure'.
+        - C{final}: if true, only finished builds pass.
+        - C{logs}: if false, log chunks don't pass.
+    
+    An empty filter (or C{None}) passes everything.
+    """
+    if not filter:
+        return True
+    if not isinstance(buildDict, dict):
+        return False
+    if 'project' in filter and buildDict.get('project') != filter['project']:
+        return False
+    if filter.get('test_path'):
+        test_path = buildDict.get('test_path') or ''
+        if not test_path.startswith(filter['test_path']):
+            return False
+    if not filter.get('logs', True) and buildDict.get('event') == 'log':
+        return False
+    done = isDone(buildDict)
+    if filter.get('final') and not done:
+        return False
+    if ('status' in filter and
+        statusClass(buildDict.get('status'), done) != filter['status']):
+        return False
+    return True
+
+
+
+class Subscription:
+    """
+    I am an observer's registration with an L{Emitter}, along with the filter
+    it registered with and the queue of builds waiting to be delivered to it.
+    
+    My queue holds at most C{limit} builds.  When it is full, C{policy} says
+    what to do:
+    
+        - L{DROP_OLDEST}: forget the oldest queued build.
+        - L{COLLAPSE}: if a state of the same build uid is queued, replace
+          the latest one with the new state; otherwise forget the oldest.
+        - L{DISCONNECT}: give up on the observer.
+    
+    C{dropped} counts the builds that were never delivered.
+    """
+
+
+    def __init__(self, observer, filter=None, limit=1000,
+                 policy=DROP_OLDEST):
+        self.observer = observer
+        self.filter = filter or {}
+        self.limit = limit
+        self.policy = policy
+        self.busy = False
+        self.dropped = 0
+        # each queued build dictionary is kept in a one item list, so that
+        # collapsing can replace it where it is
+        self._queue = deque()
+        # uid -> the latest queued item with that uid
+        self._latest = {}
+
+
+    def matches(self, buildDict):
+        return matches(self.filter, buildDict)
+
+
+    def push(self, buildDict):
+        """
+        Queue C{buildDict} for delivery.
+        
+        Return C{False} if my queue is full and my policy is L{DISCONNECT}.
+        """
+        uid = None
+        if isinstance(buildDict, dict):
+            uid = buildDict.get('uid')
+        if len(self._queue) >= self.limit:
+            if self.policy == DISCONNECT:
+                self.dropped += 1
+                return False
+            if self.policy == COLLAPSE and uid in self._latest:
+                self._latest[uid][0] = buildDict
+                self.dropped += 1
+                return True
+            self.pop()
+            self.dropped += 1
+        item = [buildDict]
+        self._queue.append(item)
+        if uid is not None:
+            self._latest[uid] = item
+        return True
+
+
+    def queued(self):
+        """
+        Returns the number of builds waiting to be delivered.
+        """
+        return len(self._queue)
+
+
+    @property
+    def pending(self):
+        """
+        The list of builds waiting to be delivered, oldest first.
+        """
+        return [x[0] for x in self._queue]
+
+
+    def pop(self):
+        """
+        Remove and return the oldest queued build.
+        """
+        item = self._queue.popleft()
+        buildDict = item[0]
+        if isinstance(buildDict, dict):
+            uid = buildDict.get('uid')
+            if self._latest.get(uid) is item:
+                del self._latest[uid]
+        return buildDict
+
+
+    def popAll(self):
+        """
+        Remove and return all the queued builds, oldest first.
+        """
+        buildDicts = self.pending
+        self.clear()
+        return buildDicts
+
+
+    def clear(self):
+        self._queue.clear()
+        self._latest.clear()
+
+
+
 class Emitter:
     """
     I emit information about builds.
+    
+    I remember the keys of the last C{handledLimit} things I emitted so that
+    repeats are not passed on.
+    
+    If C{flushInterval} is C{None} builds are passed on as soon as they are
+    emitted.  Otherwise they are collected for C{flushInterval} seconds (0
+    meaning until the end of the current reactor turn) and delivered together
+    to observers that have a buildsReceived method.
+    
+    Observers may register with a filter (see L{matches}).  Subscriptions
+    are indexed by the project they filter on so that emitting only looks at
+    observers that could be interested.
+    
+    Each observer has its own queue of at most C{queueLimit} builds.  If an
+    observer returns a Deferred, nothing more is sent to it until that
+    Deferred fires, and builds queue up in the meantime.  C{overflowPolicy}
+    decides what happens when the queue is full (see L{Subscription}).
     """
     
     implements(IEmitter)
+    
+    handledLimit = 100000
+    
+    queueLimit = 1000
+    
+    overflowPolicy = DROP_OLDEST
+    
+    flushInterval = None
+    
+    clock = reactor
 
 
     def __init__(self):
         self._observers = []
-        self._handled = []
+        self._subscriptions = []
+        self._index = {}
+        self._unindexed = []
+        self._handled = LRUSet(self.handledLimit)
+        self._waiting = []
+        self._flushCall = None
 
 
-    def addObserver(self, observer):
+    def addObserver(self, observer, filter=None):
         """
-        Register this observer to receive buildReceived notifications.
+        Register this observer to receive buildReceived notifications for
+        builds that pass C{filter}.
+        
+        Registering an observer again replaces its filter.
         """
-        if observer not in self._observers:
-            self._observers.append(observer)
+        if observer in self._observers:
+            self.remObserver(observer)
+        sub = Subscription(observer, filter, self.queueLimit,
+                           self.overflowPolicy)
+        self._observers.append(observer)
+        self._subscriptions.append(sub)
+        if 'project' in sub.filter:
+            self._index.setdefault(sub.filter['project'], []).append(sub)
+        else:
+            self._unindexed.append(sub)
     
     
     def remObserver(self, observer):
         """
         Unregister an observer from receiving buildReceived notifications.
         """
-        if observer in self._observers:
-            self._observers.remove(observer)
+        if observer not in self._observers:
+            return
+        i = self._observers.index(observer)
+        del self._observers[i]
+        sub = self._subscriptions.pop(i)
+        if 'project' in sub.filter:
+            project = sub.filter['project']
+            self._index[project].remove(sub)
+            if not self._index[project]:
+                del self._index[project]
+        else:
+            self._unindexed.remove(sub)
+        if sub in self._waiting:
+            self._waiting.remove(sub)
+    
+    
+    def getDropped(self, observer):
+        """
+        Return the number of builds that were dropped instead of being
+        delivered to C{observer}.
+        """
+        return self._subscriptions[self._observers.index(observer)].dropped
+    
+    
+    def _interested(self, buildDict):
+        """
+        Return the subscriptions whose filters C{buildDict} passes.
+        """
+        subs = self._unindexed
+        if isinstance(buildDict, dict):
+            project = buildDict.get('project')
+            if project in self._index:
+                subs = subs + self._index[project]
+        return [x for x in subs if x.matches(buildDict)]
 
     
     def emit(self, buildDict):
@@ -39,12 +310,80 @@ class Emitter:
         Emit to all my observer's buildReceived method the given buildDict
         """
         # don't allow repeats
-        h = hashlib.sha256(unicode(buildDict)).hexdigest()
-        if h in self._handled:
+        key = eventKey(buildDict)
+        if key in self._handled:
             return
-        self._handled.append(h)
+        self._handled.add(key)
         
-        for o in self._observers:
-            o.buildReceived(buildDict)
-
-
+        subs = self._interested(buildDict)
+        
+        for sub in subs:
+            if not sub.queued() and self.flushInterval is not None:
+                self._waiting.append(sub)
+            if not sub.push(buildDict):
+                self._overflowed(sub)
+        
+        if self.flushInterval is None:
+            for sub in subs:
+                self._send(sub)
+        elif self._waiting and self._flushCall is None:
+            self._flushCall = self.clock.callLater(self.flushInterval,
+                                                   self.flush)
+    
+    
+    def flush(self):
+        """
+        Deliver all the builds collected since the last flush.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        waiting, self._waiting = self._waiting, []
+        for sub in waiting:
+            self._send(sub)
+    
+    
+    def _send(self, sub):
+        """
+        Pass queued builds on to a subscribed observer, in one call to
+        buildsReceived if there is more than one and the observer has it.
+        
+        Stop if the observer returns a Deferred, until it fires.  One that
+        has already fired doesn't stop me (nor recurse through L{_sent}).
+        """
+        o = sub.observer
+        while sub.queued() and not sub.busy:
+            if sub.queued() > 1 and hasattr(o, 'buildsReceived'):
+                r = o.buildsReceived(sub.popAll())
+            else:
+                r = o.buildReceived(sub.pop())
+            if isinstance(r, defer.Deferred):
+                if r.called and not r.paused:
+                    continue
+                sub.busy = True
+                r.addBoth(self._sent, sub)
+    
+    
+    def _sent(self, result, sub):
+        """
+        Called when an observer is done with what it was last sent.
+        """
+        sub.busy = False
+        if sub in self._subscriptions:
+            self._send(sub)
+        return result
+    
+    
+    def _overflowed(self, sub):
+        """
+        Called when an observer with the L{DISCONNECT} policy has fallen
+        too far behind.
+        """
+        log.msg('Disconnecting observer %r: %d builds dropped' % (
+                sub.observer, sub.dropped + sub.queued()))
+        sub.dropped += sub.queued()
+        sub.clear()
+        self.remObserver(sub.observer)
+        if hasattr(sub.observer, 'disconnectMe'):
+            sub.observer.disconnectMe()
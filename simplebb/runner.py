@@ -0,0 +1,253 @@
+"""
+Run a build script and report its resource usage.
+
+    python runner.py script [args...]
+
+I put myself in a new process group, so that the script and anything it
+starts can be killed together, then run C{script} in a child process and
+wait for it.  Then I write the child's resource usage to file descriptor 3
+(which the child doesn't inherit) as a single line::
+
+    utime stime maxrss
+
+and exit the same way the child did.
+
+    python runner.py --worker [module...]
+
+runs me as a worker instead (see L{simplebb.worker}).  I import the
+C{module}s and then, for each job read from stdin as a line of JSON with
+the C{path} of a Python script, its C{args} and its C{env}, fork a child in
+its own process group that runs the script.  The child's output and exit
+status are written to stdout as frames of the form::
+
+    kind length\n
+    data
+
+where C{kind} is C{start} (the child's pid), C{stdout}, C{stderr} or
+C{exit} (the wait status and resource usage of the child, and my own
+maximum resident set size).
+"""
+
+import os
+import sys
+import signal
+import errno
+import json
+import select
+import resource
+import runpy
+import traceback
+
+
+
+USAGE_FD = 3
+
+
+
+def run(argv):
+    """
+    Run C{argv} to completion and return the (status, rusage) from wait4.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            # USAGE_FD is only for me
+            try:
+                os.close(USAGE_FD)
+            except OSError:
+                pass
+            os.execv(argv[0], argv)
+        except Exception, e:
+            sys.stderr.write('%s: %s\n' % (argv[0], e))
+        os._exit(1)
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            return status, usage
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+
+def report(usage):
+    """
+    Write C{usage} to L{USAGE_FD} if it is open.
+    """
+    line = '%f %f %d\n' % (usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+    try:
+        os.write(USAGE_FD, line)
+    except OSError:
+        pass
+
+
+
+def exitLike(status):
+    """
+    Exit with the same exit code, or die from the same signal, as described
+    by the wait C{status}.
+    """
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+        if sig not in (signal.SIGKILL, signal.SIGSTOP):
+            signal.signal(sig, signal.SIG_DFL)
+        os.kill(os.getpid(), sig)
+    os._exit(os.WEXITSTATUS(status))
+
+
+
+def writeAll(fd, data):
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+
+def writeFrame(kind, data):
+    writeAll(1, '%s %d\n%s' % (kind, len(data), data))
+
+
+
+def readJobs(fd=0):
+    """
+    Yield the jobs read from C{fd} until it is closed.
+    """
+    buf = ''
+    while True:
+        i = buf.find('\n')
+        if i != -1:
+            line, buf = buf[:i], buf[i+1:]
+            yield json.loads(line)
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            return
+        buf += data
+
+
+
+def runScript(path, args, env):
+    """
+    Run the Python script at C{path} in this process like the interpreter
+    would and return its exit code.
+    """
+    os.environ.clear()
+    os.environ.update(env)
+    sys.argv = [path] + args
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+    sys.stdin = open(os.devnull)
+    # buffer output like a new interpreter with env would
+    if env.get('PYTHONUNBUFFERED'):
+        sys.stdout = os.fdopen(1, 'w', 0)
+    else:
+        sys.stdout = os.fdopen(1, 'w')
+    sys.stderr = os.fdopen(2, 'w', 0)
+    code = 0
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit, e:
+        code = e.code
+        if code is None:
+            code = 0
+        elif not isinstance(code, (int, long)):
+            sys.stderr.write('%s\n' % (code,))
+            code = 1
+    except:
+        traceback.print_exc()
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    return code
+
+
+
+def relay(fds):
+    """
+    Write what is read from C{fds} (a dictionary of stream names by file
+    descriptor) as frames until they are all closed.
+    """
+    fds = dict(fds)
+    while fds:
+        try:
+            readable = select.select(list(fds), [], [])[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        for fd in readable:
+            data = os.read(fd, 65536)
+            if data:
+                writeFrame(fds[fd], data)
+            else:
+                os.close(fd)
+                del fds[fd]
+
+
+
+def runJob(job):
+    """
+    Run one job in a child process and report on it.
+    """
+    outR, outW = os.pipe()
+    errR, errW = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.setpgrp()
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            os.dup2(outW, 1)
+            os.dup2(errW, 2)
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            for fd in (outR, outW, errR, errW, null):
+                os.close(fd)
+            code = runScript(str(job['path']), [str(x) for x in job['args']],
+                             dict([(str(k), str(v))
+                                   for k, v in job['env'].items()]))
+        finally:
+            os._exit(code & 0xff)
+    os.close(outW)
+    os.close(errW)
+    writeFrame('start', str(pid))
+    relay({outR: 'stdout', errR: 'stderr'})
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    writeFrame('exit', '%d %f %f %d %d' % (status, usage.ru_utime,
+               usage.ru_stime, usage.ru_maxrss, rss))
+
+
+
+def worker(modules):
+    for name in modules:
+        __import__(name)
+    for job in readJobs():
+        runJob(job)
+
+
+
+def main(argv):
+    if argv and argv[0] == '--worker':
+        return worker(argv[1:])
+    os.setpgrp()
+    status, usage = run(argv)
+    report(usage)
+    exitLike(status)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
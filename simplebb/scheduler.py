@@ -0,0 +1,241 @@
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+import heapq
+import itertools
+import multiprocessing
+
+from simplebb.build import ERROR
+
+
+
+def cpuCount():
+    """
+    Returns the number of CPUs on this machine (at least 1).
+    """
+    try:
+        return max(1, multiprocessing.cpu_count())
+    except NotImplementedError:
+        return 1
+
+
+
+class Scheduler:
+    """
+    I run Builds a few at a time.
+
+    At most C{slots} builds run at once, and at most C{projectLimits[project]}
+    of those may belong to a single project.
+
+    Other builds wait, and those with the highest priority start first.
+    Builds of the same priority are shared out between flows (the builds of
+    one project from one submitter) by weighted fair queuing: each build is
+    tagged with a virtual finish time that grows by C{1 / weights[project]}
+    (1 by default) with each build of its flow queued ahead of it, and the
+    smallest tag goes first.  So a small request arriving behind a big one
+    starts after only a few of the big one's builds, and builds of a single
+    flow start in the order they were submitted.
+
+    If C{admit} is set it is called before starting each build, and while
+    it returns False builds wait; it is asked again every
+    C{recheckInterval} seconds.
+
+    C{runner} is called with each build when it is its turn and returns a
+    Deferred that fires when the build is done.  If it raises (or its
+    Deferred fails), the error is logged, the build is finished with
+    L{ERROR} if it isn't done yet and its slot is freed.
+
+    Builds taken out of the queue by L{remove} are only marked as removed,
+    and skipped when they come up.
+    """
+
+
+    clock = reactor
+
+    admit = None
+    recheckInterval = 1.0
+
+
+    def __init__(self, runner, slots=None, projectLimits=None):
+        self.runner = runner
+        if slots is None:
+            slots = cpuCount()
+        self.slots = slots
+        self.projectLimits = projectLimits or {}
+        self.weights = {}
+        self.running = 0
+        self._runningByProject = {}
+        self._queue = []
+        self._waiting = {}
+        self._removed = set()
+        self._flowWaiting = {}
+        self._counter = itertools.count()
+        self._vtime = 0.0
+        self._flowFinish = {}
+        self._pumping = False
+        self._recheck = None
+
+
+    def submit(self, build, priority=0, submitter=None, request=None):
+        """
+        Queue C{build} and start it if there is room.
+
+        C{submitter} is who asked for it and C{request} the uid of the
+        request it is part of, which L{position} can be asked about.
+        """
+        build.state = 'queued'
+        flow = (build.project, submitter)
+        start = max(self._vtime, self._flowFinish.get(flow, 0.0))
+        finish = start + 1.0 / self.weights.get(build.project, 1)
+        self._flowFinish[flow] = finish
+        entry = (-priority, finish, self._counter.next(), build, flow, request)
+        heapq.heappush(self._queue, entry)
+        self._waiting[id(build)] = entry
+        self._flowWaiting[flow] = self._flowWaiting.get(flow, 0) + 1
+        self._pump()
+
+
+    def queued(self):
+        """
+        Returns the number of builds waiting to run.
+        """
+        return len(self._waiting)
+
+
+    def remove(self, build):
+        """
+        Take C{build} out of the queue.  Returns True if it was waiting.
+        """
+        entry = self._waiting.get(id(build))
+        if entry is None or entry[3] is not build:
+            return False
+        self._unqueue(entry)
+        self._removed.add(entry[2])
+        if not self._flowWaiting.get(entry[4]):
+            self._flowFinish.pop(entry[4], None)
+        if len(self._removed) > len(self._waiting):
+            self._queue = [x for x in self._queue
+                           if x[2] not in self._removed]
+            heapq.heapify(self._queue)
+            self._removed.clear()
+        return True
+
+
+    def _unqueue(self, entry):
+        """
+        Forget that the build of C{entry} is waiting.
+        """
+        del self._waiting[id(entry[3])]
+        flow = entry[4]
+        self._flowWaiting[flow] -= 1
+        if not self._flowWaiting[flow]:
+            del self._flowWaiting[flow]
+
+
+    def position(self, request):
+        """
+        Returns how many builds will start before the first waiting build
+        of C{request}, or C{None} if none of its builds are waiting.
+        """
+        for i, entry in enumerate(sorted(self._waiting.values())):
+            if entry[5] == request:
+                return i
+        return None
+
+
+    def _hasRoom(self, build):
+        """
+        Returns True if C{build} may start now (assuming a free slot).
+        """
+        limit = self.projectLimits.get(build.project)
+        if limit is None:
+            return True
+        return self._runningByProject.get(build.project, 0) < limit
+
+
+    def _next(self):
+        """
+        Remove and return the queue entry of the first build that may start
+        now, or C{None}.
+        """
+        skipped = []
+        found = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            if entry[2] in self._removed:
+                self._removed.remove(entry[2])
+                continue
+            if self._hasRoom(entry[3]):
+                self._unqueue(entry)
+                found = entry
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return found
+
+
+    def _pump(self):
+        """
+        Start builds while there are free slots.
+        """
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while self._waiting and self.running < self.slots:
+                if self.admit is not None and not self.admit():
+                    self._waitForRoom()
+                    break
+                entry = self._next()
+                if entry is None:
+                    break
+                self._start(entry)
+        finally:
+            self._pumping = False
+
+
+    def _waitForRoom(self):
+        if self._recheck is None:
+            self._recheck = self.clock.callLater(self.recheckInterval,
+                                                 self._checkRoom)
+
+
+    def _checkRoom(self):
+        self._recheck = None
+        self._pump()
+
+
+    def _start(self, entry):
+        finish, build, flow = entry[1], entry[3], entry[4]
+        self._vtime = max(self._vtime, finish)
+        if self._flowFinish.get(flow) == finish:
+            # nothing else of this flow is waiting
+            del self._flowFinish[flow]
+        project = build.project
+        self.running += 1
+        self._runningByProject[project] = \
+            self._runningByProject.get(project, 0) + 1
+        build.state = 'running'
+        d = defer.maybeDeferred(self.runner, build)
+        d.addErrback(self._failed, build)
+        d.addBoth(self._release, build)
+
+
+    def _failed(self, failure, build):
+        log.err(failure, 'Error running build %s' % (build.uid,))
+        if build.state != 'done':
+            build._finish(ERROR)
+
+
+    def _release(self, result, build):
+        """
+        Called when a build is done to free its slot.
+        """
+        project = build.project
+        self.running -= 1
+        self._runningByProject[project] -= 1
+        if not self._runningByProject[project]:
+            del self._runningByProject[project]
+        self._pump()
+        return result
@@ -176,6 +176,21 @@ class ShellProtocol(LineReceiver):
         self.sendLine('Build requested: %s' % response['uid'])
     
     
+    def cmd_position(self, uid):
+        """
+        Show how many builds will start before a request's next build.
+        
+        uid is the request identifier returned by the "build" command.
+        """
+        d = self.hub.queuePosition(uid)
+        def cb(position, self, uid):
+            if position is None:
+                self.sendLine('No builds of %s are waiting' % uid)
+            else:
+                self.sendLine('%s: %d builds ahead' % (uid, position))
+        d.addCallback(cb, self, uid)
+    
+    
     def cmd_start(self, endpoint):
         """
         Start a simplebb server for other simplebb instances to connect to.
@@ -218,7 +233,7 @@ class ShellProtocol(LineReceiver):
         d.addCallback(cb, self, endpoint)
 
 
-    def cmd_connect(self, endpoint):
+    def cmd_connect(self, endpoint, persistent=None):
         """
         Tell this simplebb instance to connect to another instance as a client.
         
@@ -226,9 +241,17 @@ class ShellProtocol(LineReceiver):
         
             tcp:host=69.34.13.51:port=9876
         
+        Add "persistent" to keep reconnecting whenever the connection is
+        lost:
+        
+            connect tcp:host=69.34.13.51:port=9876 persistent
+        
         socuteurl.com/goobeygoobean
         """
-        d = self.hub.connect(endpoint)
+        if persistent == 'persistent':
+            d = self.hub.connect(endpoint, persistent=True)
+        else:
+            d = self.hub.connect(endpoint)
         def cb(_, self, endpoint):
             self.sendLine('Connected to %s' % endpoint)
         d.addCallback(cb, self, endpoint)
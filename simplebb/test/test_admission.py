@@ -0,0 +1,113 @@
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+
+from simplebb import admission
+from simplebb.admission import Admission, freeMemory, freeDisk, loadAverage
+
+
+
+class measureTest(TestCase):
+
+
+    def test_loadAverage(self):
+        load = loadAverage()
+        self.assertTrue(load is None or load >= 0)
+
+
+    def test_freeMemory(self):
+        """
+        MemAvailable is used when there is one.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('MemTotal:  1000 kB\nMemFree:  100 kB\n'
+                     'MemAvailable:  300 kB\nHugePages_Total:  0\n')
+        self.assertEqual(freeMemory(f.path), 300)
+
+
+    def test_freeMemory_old(self):
+        """
+        Older kernels don't say what is available, so it is estimated.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('MemTotal:  1000 kB\nMemFree:  100 kB\n'
+                     'Buffers:  10 kB\nCached:  50 kB\n')
+        self.assertEqual(freeMemory(f.path), 160)
+
+
+    def test_freeMemory_unknown(self):
+        self.assertEqual(freeMemory(self.mktemp()), None)
+
+
+    def test_freeDisk(self):
+        self.assertTrue(freeDisk('.') >= 0)
+        self.assertEqual(freeDisk(self.mktemp()), None)
+
+
+
+class AdmissionTest(TestCase):
+
+
+    def setUp(self):
+        self.now = 0
+        self.measured = dict(load=1.0, free_memory=1000, free_disk=5000)
+        self.patch(admission, 'loadAverage', lambda: self.measured['load'])
+        self.patch(admission, 'freeMemory',
+                   lambda: self.measured['free_memory'])
+        self.patch(admission, 'freeDisk',
+                   lambda path: self.measured['free_disk'])
+
+
+    def admission(self, **kwargs):
+        return Admission(clock=lambda: self.now, **kwargs)
+
+
+    def test_defaults(self):
+        """
+        Nothing is checked by default.
+        """
+        a = Admission()
+        self.assertEqual(a.maxLoad, None)
+        self.assertEqual(a.minFreeMemory, None)
+        self.assertEqual(a.minFreeDisk, None)
+        self.assertEqual(a.path, '.')
+        self.assertTrue(a.admits())
+
+
+    def test_thresholds(self):
+        a = self.admission(maxLoad=2, minFreeMemory=500, minFreeDisk=4000)
+        self.assertEqual(a.blocked(), [])
+        self.assertTrue(a.admits())
+
+        self.measured = dict(load=3.0, free_memory=100, free_disk=10)
+        self.now = 1
+        self.assertEqual(a.blocked(), ['load', 'free_memory', 'free_disk'])
+        self.assertFalse(a.admits())
+
+
+    def test_unknown(self):
+        """
+        Measurements that aren't known here don't block.
+        """
+        a = self.admission(maxLoad=2, minFreeMemory=500, minFreeDisk=4000)
+        self.measured = dict(load=None, free_memory=None, free_disk=None)
+        self.assertTrue(a.admits())
+
+
+    def test_interval(self):
+        """
+        Measurements are reused for interval seconds.
+        """
+        a = self.admission(maxLoad=2)
+        self.assertTrue(a.admits())
+        self.measured['load'] = 3.0
+        self.now = 0.5
+        self.assertTrue(a.admits())
+        self.now = 1
+        self.assertFalse(a.admits())
+
+
+    def test_getMetrics(self):
+        a = self.admission(maxLoad=0.5)
+        self.assertEqual(a.getMetrics(), dict(
+            load=1.0, free_memory=1000, free_disk=5000, max_load=0.5,
+            min_free_memory=None, min_free_disk=None, blocked=['load']))
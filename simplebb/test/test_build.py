@@ -1,11 +1,17 @@
 from twisted.trial.unittest import TestCase
 from twisted.python.filepath import FilePath
 from twisted.internet import defer
+from twisted.internet.error import ProcessTerminated
+from twisted.python.failure import Failure
 from zope.interface.verify import verifyClass, verifyObject
 
 
 from simplebb.interface import IBuild
 from simplebb.build import Build, FileBuild, FILE_NOT_FOUND, MISSING_VERSION
+from simplebb.build import TIMEOUT, BuildProtocol, readHeaders
+from simplebb.cache import ResultCache
+
+import os
 
 
 
@@ -34,6 +40,7 @@ class BuildTest(TestCase):
         b = Build()
         self.assertNotEqual(b.uid, None)
         self.assertEqual(b.status, None)
+        self.assertEqual(b.state, None)
         self.assertEqual(b.version, None)
         self.assertEqual(b.project, None)
         self.assertEqual(b.test_path, None)
@@ -53,6 +60,7 @@ class BuildTest(TestCase):
         
         b._finish(0)
         self.assertEqual(b.status, 0)
+        self.assertEqual(b.state, 'done')
         
         return b.done
     
@@ -88,6 +96,50 @@ class BuildTest(TestCase):
         return b.done
 
 
+    def test_outputReceived(self):
+        """
+        Output is kept in the log and passed to emitLog as chunks.
+        """
+        b = Build()
+        b.project = 'project'
+        b.version = 'version'
+        b.test_path = 'foo/bar'
+        called = []
+        b.emitLog = called.append
+        
+        b.outputReceived('stdout', 'hello')
+        b.outputReceived('stderr', 'oops')
+        
+        self.assertEqual(list(b.log), [('stdout', 'hello'), ('stderr', 'oops')])
+        self.assertEqual(b.getLog(), 'hellooops')
+        self.assertEqual(called, [
+            dict(uid=b.uid, event='log', status=None, project='project',
+                 version='version', test_path='foo/bar', stream='stdout',
+                 seq=1, data='hello'),
+            dict(uid=b.uid, event='log', status=None, project='project',
+                 version='version', test_path='foo/bar', stream='stderr',
+                 seq=2, data='oops'),
+        ])
+    
+    
+    def test_outputReceived_bounded(self):
+        """
+        Output is split into chunks of at most logChunkSize and only the
+        last logChunks chunks are kept.
+        """
+        class SmallBuild(Build):
+            logChunks = 3
+            logChunkSize = 2
+        b = SmallBuild()
+        called = []
+        b.emitLog = called.append
+        
+        b.outputReceived('stdout', 'abcdefg')
+        
+        self.assertEqual([x['data'] for x in called], ['ab', 'cd', 'ef', 'g'])
+        self.assertEqual(b.getLog(), 'cdefg')
+    
+    
     def test_toDict(self):
         """
         Should read all the required attributes.
@@ -95,12 +147,13 @@ class BuildTest(TestCase):
         b = Build()
         b.uid = 'something'
         b.status = 10
+        b.state = 'done'
         b.project = 'project'
         b.version = 'version'
         b.test_path = 'foo/bar'
         b.runtime = 203
         self.assertEqual(b.toDict(), dict(
-            uid='something', status=10, project='project',
+            uid='something', status=10, state='done', project='project',
             version='version', test_path='foo/bar', runtime=203))
 
 
@@ -187,6 +240,316 @@ class FileBuildTest(TestCase):
         return b.done
     
     
+    def test_run_output(self):
+        """
+        The output of the file is captured as it is written.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\necho out $1\necho err >&2')
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        called = []
+        b.emitLog = called.append
+        
+        def cb(build):
+            streams = {}
+            for chunk in called:
+                streams.setdefault(chunk['stream'], []).append(chunk['data'])
+            self.assertEqual(''.join(streams['stdout']), 'out foo\n')
+            self.assertEqual(''.join(streams['stderr']), 'err\n')
+            self.assertEqual(build.status, 0)
+        b.done.addCallback(cb)
+        
+        b.run()
+        return b.done
+    
+    
+    def test_run_usage(self):
+        """
+        The runtime, queue wait and resource usage of the process are
+        recorded and included in toDict.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\nexit 0')
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        
+        def cb(build):
+            self.assertTrue(build.runtime > 0)
+            self.assertTrue(build.queue_wait >= 0)
+            self.assertTrue(build.cpu_user >= 0)
+            self.assertTrue(build.cpu_system >= 0)
+            self.assertTrue(build.max_rss > 0)
+            d = build.toDict()
+            for key in ['runtime', 'queue_wait', 'cpu_user', 'cpu_system',
+                        'max_rss']:
+                self.assertEqual(d[key], getattr(build, key))
+        b.done.addCallback(cb)
+        
+        b.run()
+        return b.done
+    
+    
+    def test_run_usageFD(self):
+        """
+        The file doesn't get the runner's usage file descriptor, so it can't
+        spoil the usage line.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\necho hi >&3\nexit 0')
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        
+        def cb(build):
+            self.assertEqual(build.status, 0)
+            self.assertTrue(build.max_rss > 0)
+        b.done.addCallback(cb)
+        
+        b.run()
+        return b.done
+    
+    
+    def test_run_signal(self):
+        """
+        A file killed by a signal finishes with a status of None, just like
+        utils.getProcessValue.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\nkill -9 $$')
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        
+        def cb(build):
+            self.assertEqual(build.status, None)
+        b.done.addCallback(cb)
+        
+        b.run()
+        return b.done
+    
+    
+    def test_run_timeout(self):
+        """
+        A build that runs past its timeout has its whole process group
+        killed, including processes the file started, and finishes with
+        TIMEOUT.
+        """
+        pidfile = FilePath(self.mktemp())
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\nsleep 10 &\necho $! > %s\nwait' % (
+                     pidfile.path,))
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        b.timeout = 0.2
+        
+        def alive(pid):
+            try:
+                stat = open('/proc/%d/stat' % pid).read()
+            except IOError:
+                return False
+            return stat.split(') ')[1][0] != 'Z'
+        
+        def cb(build):
+            self.assertEqual(build.status, TIMEOUT)
+            pid = int(pidfile.getContent())
+            self.assertFalse(alive(pid),
+                "The script's child should have been killed too")
+        b.done.addCallback(cb)
+        
+        b.run()
+        return b.done
+    
+    
+    def test_run_cache(self):
+        """
+        A successful result is stored in the cache, and a later build of the
+        same file and version finishes with it without running.
+        """
+        cache = ResultCache(self.mktemp())
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\necho ran >> %s.count\necho hello' % (
+                     f.path,))
+        count = f.sibling(f.basename() + '.count')
+        
+        first = FileBuild(f)
+        first.version = 'foo'
+        first.cache = cache
+        
+        def runAgain(build):
+            self.assertEqual(build.status, 0)
+            self.assertEqual(build.cached, False)
+            second = FileBuild(f)
+            second.version = 'foo'
+            second.cache = cache
+            second.run()
+            self.assertTrue(second.done.called,
+                "A cached result should finish right away")
+            return second.done
+        
+        def check(build):
+            self.assertEqual(build.status, 0)
+            self.assertEqual(build.cached, True)
+            self.assertEqual(build.toDict()['cached'], True)
+            self.assertEqual(build.getLog(), 'hello\n')
+            self.assertEqual(build.runtime, first.runtime)
+            self.assertEqual(count.getContent(), 'ran\n')
+        
+        first.done.addCallback(runAgain)
+        first.done.addCallback(check)
+        first.run()
+        return first.done
+    
+    
+    def test_run_cacheFailure(self):
+        """
+        Failed results are not cached.
+        """
+        cache = ResultCache(self.mktemp())
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\nexit 1')
+        
+        b = FileBuild(f)
+        b.version = 'foo'
+        b.cache = cache
+        
+        def cb(build):
+            self.assertEqual(cache.path.children(), [])
+        b.done.addCallback(cb)
+        b.run()
+        return b.done
+    
+    
+    def test_prepare(self):
+        """
+        prepare reads the headers and looks up the cache ahead of run, which
+        then doesn't read the file again.
+        """
+        cache = ResultCache(self.mktemp())
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\n# simplebb-timeout: 20\nexit 0')
+        key = cache.key(f, 'foo', {})
+        cache.put(key, dict(status=0, runtime=1.0, cpu_user=None,
+                            cpu_system=None, max_rss=None, log=[]))
+    
+        b = FileBuild(f)
+        b.version = 'foo'
+        b.cache = cache
+        b.prepare()
+        f.remove()
+        f.setContent('#!/bin/bash\nexit 1')
+        self.assertEqual(b.getTimeout(), 20)
+    
+        b.run()
+        self.assertEqual(b.cached, True)
+        self.assertEqual(b.status, 0)
+    
+    
+    def test_prepare_missing(self):
+        """
+        prepare does nothing when the file doesn't exist.
+        """
+        b = FileBuild(FilePath(self.mktemp()))
+        b.version = 'foo'
+        b.prepare()
+        b.run()
+        self.assertEqual(b.status, FILE_NOT_FOUND)
+    
+    
+    def test_getDepends(self):
+        """
+        Dependencies are named in the simplebb-depends header.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\n# simplebb-depends: setup/db, setup/web '
+                     'lib\nexit 0')
+        b = FileBuild(f)
+        self.assertEqual(b.getDepends(), ['setup/db', 'setup/web', 'lib'])
+        
+        f.setContent('#!/bin/bash\nexit 0')
+        self.assertEqual(b.getDepends(), [])
+        self.assertEqual(FileBuild(self.mktemp()).getDepends(), [])
+        self.assertEqual(Build().getDepends(), [])
+    
+    
+    def test_getTimeout(self):
+        """
+        The timeout is the smaller of the timeout attribute and the file's
+        simplebb-timeout header.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\n# simplebb-timeout: 20\nexit 0')
+        b = FileBuild(f)
+        self.assertEqual(b.getTimeout(), 20)
+        b.timeout = 5
+        self.assertEqual(b.getTimeout(), 5)
+        b.timeout = 30
+        self.assertEqual(b.getTimeout(), 20)
+        
+        f.setContent('#!/bin/bash\nexit 0')
+        self.assertEqual(b.getTimeout(), 30)
+        b.timeout = None
+        self.assertEqual(b.getTimeout(), None)
+    
+    
+    def test_getTimeout_bad(self):
+        """
+        A timeout header that isn't a number is ignored, and the build runs.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\n# simplebb-timeout: 30s\nexit 0')
+        f.chmod(0755)
+        b = FileBuild(f)
+        self.assertEqual(b.getTimeout(), None)
+        b.timeout = 5
+        self.assertEqual(b.getTimeout(), 5)
+        
+        b.version = 'version'
+        b.run()
+        def check(build):
+            self.assertEqual(build.status, 0)
+        return b.done.addCallback(check)
+    
+    
+    def test_readHeaders(self):
+        """
+        simplebb- header comments near the top of the file are read.
+        """
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\n'
+                     '# simplebb-timeout: 20\n'
+                     '#simplebb-foo:bar baz  \n'
+                     '# not a header: 1\n'
+                     'exit 0\n')
+        self.assertEqual(readHeaders(f), {'timeout': '20', 'foo': 'bar baz'})
+        self.assertEqual(readHeaders(f, 2), {'timeout': '20'})
+    
+    
+    def test_usageReceived(self):
+        b = FileBuild('foo')
+        b.usageReceived('1.5 0.25 2048\n')
+        self.assertEqual(b.cpu_user, 1.5)
+        self.assertEqual(b.cpu_system, 0.25)
+        self.assertEqual(b.max_rss, 2048)
+    
+    
+    def test_usageReceived_bad(self):
+        """
+        A bad usage line is ignored, and the build still finishes.
+        """
+        b = FileBuild('foo')
+        b.usageReceived('hi\n1.5 0.25 2048\n')
+        self.assertEqual(b.max_rss, None)
+        
+        p = BuildProtocol(b)
+        p.childDataReceived(3, 'hi\n')
+        p.processEnded(Failure(ProcessTerminated(exitCode=0)))
+        self.assertEqual(b.status, 0)
+    
+    
     def test_version_passed(self):
         """
         The version should be passed to the underlying script
@@ -1,10 +1,17 @@
+import os
+import resource
+import threading
+
 from twisted.trial.unittest import TestCase
 from zope.interface.verify import verifyClass, verifyObject
 from twisted.python.filepath import FilePath
+from twisted.internet import defer, reactor
+from twisted.python import threadable
 
 from simplebb.interface import IBuilder, IEmitter
+from simplebb import builder
 from simplebb.builder import Builder, FileBuilder
-from simplebb.build import FileBuild, Build
+from simplebb.build import FileBuild, Build, SKIPPED, SUPERSEDED
 
 
 
@@ -110,6 +117,42 @@ class BuilderTest(TestCase):
         b.build(r)
         self.assertEqual(called, [r],
             "Should not have sent to _build this time")
+    
+    
+    def test_build_pastRequestIdsBounded(self):
+        """
+        Only a bounded number of request uids are remembered.
+        """
+        class SmallBuilder(Builder):
+            requestIdLimit = 10
+        b = SmallBuilder()
+        b._build = lambda request: None
+        for i in xrange(100):
+            b.build(dict(project='foo', version='bar', uid=str(i)))
+        self.assertTrue(len(b._pastRequestIds) <= 20)
+        self.assertTrue('99' in b._pastRequestIds)
+
+
+    def test_build_pastRequestIdsRSS(self):
+        """
+        The process's memory levels off however many requests come in.
+        """
+        b = Builder()
+        b._build = lambda request: None
+        def maxrss():
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        def push(start, stop):
+            for i in xrange(start, stop):
+                b.build(dict(project='foo', version='bar', uid='%040x' % i))
+        # fill and rotate both generations first
+        push(0, 1000000)
+        before = maxrss()
+        push(1000000, 10000000)
+        self.assertTrue(maxrss() - before < before / 10,
+                        (before, maxrss()))
+
+    if not os.environ.get('SIMPLEBB_SLOW_TESTS'):
+        test_build_pastRequestIdsRSS.skip = "Set SIMPLEBB_SLOW_TESTS to run"
            
 
 
@@ -275,9 +318,9 @@ class FileBuilderTest(TestCase):
                 self.func = func
                 self.called = []
             
-            def __call__(self, *args):
+            def __call__(self, *args, **kwargs):
                 self.called.append(args)
-                return self.func(*args)
+                return self.func(*args, **kwargs)
 
 
         b._findHeads = Spy(b._findHeads)
@@ -301,6 +344,185 @@ class FileBuilderTest(TestCase):
         self.assertEqual(len(r), 2)
 
 
+    def test_discoverBuilds_watchFiles(self):
+        """
+        Files are watched from the reactor thread even though builds are
+        found in another.
+        """
+        root = FilePath(self.mktemp())
+        root.child('project').makedirs()
+        root.child('project').child('foo').setContent('foo')
+        
+        calls = []
+        class FakeNotifier:
+            def watch(self, *args, **kwargs):
+                calls.append(('watch', threadable.isInIOThread()))
+        def getNotifier():
+            calls.append(('getNotifier', threadable.isInIOThread()))
+            return FakeNotifier()
+        self.patch(builder, 'getNotifier', getNotifier)
+        
+        b = FileBuilder(root)
+        b.watchFiles = True
+        found = []
+        d = b.discoverBuilds('project', '*', 'version', found.extend)
+        
+        def check(count):
+            self.assertEqual(count, 1)
+            self.assertEqual(calls, [('getNotifier', True), ('watch', True)])
+        return d.addCallback(check)
+
+
+    def test_getIndex_thread(self):
+        """
+        Indexes made outside the reactor thread don't watch files.
+        """
+        root = FilePath(self.mktemp())
+        root.child('project').makedirs()
+        self.patch(builder, 'getNotifier', lambda: self.fail('notifier'))
+        b = FileBuilder(root)
+        b.watchFiles = True
+        indexes = []
+        t = threading.Thread(target=lambda: indexes.append(
+                             b._getIndex(root.child('project'))))
+        t.start()
+        t.join()
+        self.assertEqual(indexes[0].notifier, None)
+
+
+    def test_findBuilds_index(self):
+        """
+        The files of a project are indexed once and the index is reused until
+        files are added or removed.
+        """
+        root = FilePath(self.mktemp())
+        project = root.child('project')
+        sub = project.child('sub')
+        sub.makedirs()
+        sub.child('foo').setContent('foo')
+        
+        b = FileBuilder(root)
+        r = [x.test_path for x in b.findBuilds('project')]
+        self.assertEqual(r, ['sub/foo'])
+        
+        index = b._indexes[project.path]
+        scans = []
+        realScan = index.scan
+        def scan():
+            scans.append(True)
+            realScan()
+        index.scan = scan
+        
+        r = [x.test_path for x in b.findBuilds('project', 'sub')]
+        self.assertEqual(r, ['sub/foo'])
+        self.assertEqual(scans, [], "Should have used the index")
+        
+        index._dirs[sub.path] -= 10
+        sub.child('bar').setContent('bar')
+        r = [x.test_path for x in b.findBuilds('project')]
+        self.assertEqual(set(r), set(['sub/foo', 'sub/bar']))
+        self.assertEqual(scans, [True])
+
+
+    def test_findBuilds_recursive(self):
+        """
+        test_path can match files at any depth with **, and files under
+        nested heads are only built once.
+        """
+        root = FilePath(self.mktemp())
+        unit = root.child('project').child('unit')
+        deep = unit.child('a').child('b')
+        deep.makedirs()
+        unit.child('fast_1').setContent('foo')
+        deep.child('fast_2').setContent('foo')
+        deep.child('slow_3').setContent('foo')
+        
+        b = FileBuilder(root)
+        r = [x.test_path for x in b.findBuilds('project', 'unit/**/fast_*')]
+        self.assertEqual(sorted(r), ['unit/a/b/fast_2', 'unit/fast_1'])
+        
+        r = [x.test_path for x in b.findBuilds('project', 'unit/**')]
+        self.assertEqual(sorted(r), [
+            'unit/a/b/fast_2', 'unit/a/b/slow_3', 'unit/fast_1'])
+    
+    
+    def test_findBuilds_checkOnce(self):
+        """
+        The index is checked for changes once per lookup, however many heads
+        match.
+        """
+        root = FilePath(self.mktemp())
+        project = root.child('project')
+        for name in ('a', 'b', 'c'):
+            project.child(name).makedirs()
+            project.child(name).child('fast_1').setContent('foo')
+        
+        b = FileBuilder(root)
+        list(b.findBuilds('project'))
+        index = b._indexes[project.path]
+        checks = []
+        realIsStale = index.isStale
+        def isStale():
+            checks.append(True)
+            return realIsStale()
+        index.isStale = isStale
+        
+        r = [x.test_path for x in b.findBuilds('project', '**/fast_*')]
+        self.assertEqual(sorted(r), ['a/fast_1', 'b/fast_1', 'c/fast_1'])
+        self.assertEqual(checks, [True])
+
+
+    def test__build_depends(self):
+        """
+        Builds named in a simplebb-depends header are built first, even if
+        they don't match test_path, and builds whose dependencies fail are
+        skipped.
+        """
+        root = FilePath(self.mktemp())
+        project = root.child('project')
+        project.child('tests').makedirs()
+        project.child('setup').setContent('#!/bin/bash\nexit 3')
+        project.child('ok').setContent('#!/bin/bash\nexit 0')
+        project.child('tests').child('a').setContent(
+            '#!/bin/bash\n# simplebb-depends: setup\nexit 0')
+        project.child('tests').child('b').setContent(
+            '#!/bin/bash\n# simplebb-depends: ok\nexit 0')
+        for fp in project.walk():
+            if fp.isfile():
+                fp.chmod(0755)
+
+        b = FileBuilder(root)
+        finished = {}
+        def emit(d):
+            if d['state'] == 'done':
+                finished[d['test_path']] = d['status']
+        b.emit = emit
+
+        d = b._build(dict(version='version', project='project',
+                          test_path='tests/*'))
+
+        def check():
+            self.assertEqual(finished, {
+                'setup': 3,
+                'ok': 0,
+                'tests/a': SKIPPED,
+                'tests/b': 0,
+            })
+
+        def wait(count):
+            self.assertEqual(count, 4)
+            waits = [defer.Deferred()]
+            def poll():
+                if len(finished) == 4:
+                    waits[0].callback(None)
+                else:
+                    reactor.callLater(0.01, poll)
+            poll()
+            return waits[0].addCallback(lambda ign: check())
+
+        return d.addCallback(wait)
+
+
     def test__build(self):
         """
         _build should
@@ -329,8 +551,13 @@ class FileBuilderTest(TestCase):
         b.emit = emit_called.append
         
         
-        b._build(dict(version='version', project='foo', test_path='bar'))
-        
+        d = b._build(dict(version='version', project='foo', test_path='bar'))
+        d.addCallback(self._check_build, b, r, run_called, emit_called)
+        return d
+    
+    
+    def _check_build(self, count, b, r, run_called, emit_called):
+        self.assertEqual(count, 1)
         
         # version should be set on the Build
         self.assertEqual(r[0].version, 'version',
@@ -339,6 +566,12 @@ class FileBuilderTest(TestCase):
         self.assertEqual(run_called, [True],
             "Build.run() should have been called")
         
+        self.assertEqual(r[0].emitLog, b.emit,
+            "Log chunks should be emitted")
+        
+        self.assertEqual(r[0].timeout, None)
+        self.assertEqual(r[0].cache, None)
+        
         self.assertEqual(emit_called, [r[0].toDict()],
             "Builder.emit() should have been called")
         
@@ -351,5 +584,343 @@ class FileBuilderTest(TestCase):
         self.assertEqual(emit_called, [r[0].toDict()],
             "When the build finishes, Builder.emit should be called")
 
+    
+    def test__build_timeout(self):
+        """
+        The request's timeout, or else my timeout, is set on each Build.
+        """
+        b = FileBuilder('foo')
+        b.timeout = 10
+        r = [Build(), Build()]
+        for build in r:
+            build.run = lambda: None
+        b.findBuilds = lambda *ign: r[:1]
+        d = b._build(dict(version='version', project='foo', test_path='bar'))
+        
+        def second(ign):
+            self.assertEqual(r[0].timeout, 10)
+            b.findBuilds = lambda *ign: r[1:]
+            return b._build(dict(version='version', project='foo',
+                                 test_path='bar', timeout=2))
+        
+        d.addCallback(second)
+        d.addCallback(lambda ign: self.assertEqual(r[1].timeout, 2))
+        return d
 
+    
+    def test__build_cached(self):
+        """
+        Builds whose result is cached finish without waiting for a slot.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 0
+        r = [Build(), Build()]
+        r[0].runCached = lambda: r[0]._finish(0) or True
+        for build in r:
+            build.run = lambda: None
+        b.findBuilds = lambda *ign: r
+        b.emit = lambda d: None
+        d = b._build(dict(version='version', project='foo', test_path='bar'))
+        
+        def check(ign):
+            self.assertEqual(r[0].status, 0)
+            self.assertEqual(r[1].state, 'queued')
+            self.assertEqual(b.scheduler.queued(), 1)
+        
+        return d.addCallback(check)
 
+    
+    def test__build_queued(self):
+        """
+        Builds that can't start right away are emitted as queued, then as
+        running when they start.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 1
+        r = [Build(), Build()]
+        for build in r:
+            build.run = lambda: None
+        b.findBuilds = lambda *ign: r
+        
+        emitted = []
+        b.emit = lambda d: emitted.append((d['uid'], d['state']))
+        
+        d = b._build(dict(version='version', project='foo', test_path='bar'))
+        
+        def check(ign):
+            self.assertEqual(emitted, [
+                (r[0].uid, 'running'),
+                (r[1].uid, 'queued'),
+            ])
+            
+            del emitted[:]
+            r[0]._finish(0)
+            self.assertEqual(emitted, [
+                (r[0].uid, 'done'),
+                (r[1].uid, 'running'),
+            ])
+        
+        return d.addCallback(check)
+    
+    
+    def test__build_priority(self):
+        """
+        A request's priority and submitter are passed to the scheduler, and
+        its position in the queue can be asked for by its uid.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 1
+        builds = {}
+        def findBuilds(project, test_path):
+            builds[test_path] = r = [Build(), Build()]
+            for build in r:
+                build.project = project
+                build.run = lambda: None
+            return r
+        b.findBuilds = findBuilds
+        b.emit = lambda d: None
+        
+        d = b._build(dict(uid='nightly', version='version', project='foo',
+                          test_path='nightly', submitter='cron'))
+        d.addCallback(lambda ign: b._build(dict(uid='urgent',
+            version='version', project='foo', test_path='urgent',
+            priority=10)))
+        
+        def check(ign):
+            self.assertEqual(b.queuePosition('urgent'), 0)
+            self.assertEqual(b.queuePosition('nightly'), 2)
+            self.assertEqual(b.queuePosition('other'), None)
+            builds['nightly'][0]._finish(0)
+            self.assertEqual(builds['urgent'][0].state, 'running')
+        
+        return d.addCallback(check)
+    
+    
+    def test_discoverBuilds(self):
+        """
+        Builds are found and prepared in a thread and handed to the reactor
+        thread in batches of discoveryBatch.
+        """
+        b = FileBuilder('foo')
+        b.discoveryBatch = 2
+        b.resultCache = 'cache'
+        r = [Build(), Build(), Build()]
+        prepared = []
+        for build in r:
+            build.prepare = lambda build=build: prepared.append(
+                (build, threading.currentThread()))
+        b.findBuilds = lambda *ign: iter(r)
+        
+        batches = []
+        def found(builds):
+            batches.append((builds, threading.currentThread()))
+        
+        d = b.discoverBuilds('foo', 'bar', 'version', found)
+        
+        def check(count):
+            self.assertEqual(count, 3)
+            self.assertEqual([x[0] for x in batches], [r[:2], r[2:]])
+            main = threading.currentThread()
+            self.assertEqual([x[1] for x in batches], [main, main],
+                "Batches should be given to the reactor thread")
+            self.assertEqual([x[0] for x in prepared], r)
+            self.assertNotEqual(prepared[0][1], main,
+                "Builds should be prepared in a thread")
+            for build in r:
+                self.assertEqual(build.version, 'version')
+                self.assertEqual(build.cache, 'cache')
+        
+        return d.addCallback(check)
+    
+    
+    def supersedeBuilder(self, mode):
+        """
+        Returns a FileBuilder with one slot that supersedes builds of the
+        'foo' project, and the builds it finds by request version.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 1
+        b.supersede = {'foo': mode}
+        builds = {}
+        def findBuilds(project, test_path):
+            r = []
+            for path in ['a', 'b']:
+                build = Build()
+                build.project = project
+                build.test_path = path
+                build.run = lambda: None
+                build.kill = lambda status, build=build: build._finish(status)
+                r.append(build)
+            builds.setdefault('next', []).append(r)
+            return r
+        b.findBuilds = findBuilds
+        return b, builds
+    
+    
+    def test__build_supersede(self):
+        """
+        Builds that haven't started are superseded by later requests for the
+        same files, and emitted with a SUPERSEDED status.
+        """
+        b, builds = self.supersedeBuilder('queued')
+        emitted = []
+        b.emit = lambda d: emitted.append((d['version'], d['test_path'],
+                                           d['status']))
+        
+        d = b._build(dict(version='1', project='foo', test_path='*'))
+        d.addCallback(lambda ign: b._build(dict(version='2', project='foo',
+                                                test_path='*')))
+        
+        def check(ign):
+            first, second = builds['next']
+            self.assertEqual(first[0].state, 'running',
+                "Running builds aren't superseded")
+            self.assertEqual(first[1].status, SUPERSEDED)
+            self.assertTrue(('1', 'b', SUPERSEDED) in emitted)
+            self.assertEqual([x.state for x in second], ['queued', 'queued'])
+            self.assertEqual(b.scheduler.queued(), 2)
+            first[0]._finish(0)
+            self.assertEqual(second[0].state, 'running')
+            self.assertEqual(b._latest[('foo', 'a')][1], second[0])
+            second[0]._finish(0)
+            self.assertFalse(('foo', 'a') in b._latest)
+        
+        return d.addCallback(check)
+    
+    
+    def test__build_supersedeRunning(self):
+        """
+        Running builds are killed too if the project is set to 'running'.
+        """
+        b, builds = self.supersedeBuilder('running')
+        b.emit = lambda d: None
+        
+        d = b._build(dict(version='1', project='foo', test_path='*'))
+        d.addCallback(lambda ign: b._build(dict(version='2', project='foo',
+                                                test_path='*')))
+        
+        def check(ign):
+            first, second = builds['next']
+            self.assertEqual([x.status for x in first], [SUPERSEDED] * 2)
+            self.assertEqual(second[0].state, 'running')
+        
+        return d.addCallback(check)
+    
+    
+    def test__build_supersedeDepends(self):
+        """
+        Builds found as dependencies are neither superseded by another
+        request's builds of the same file, nor supersede them.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 0
+        b.supersede = {'foo': 'queued'}
+        b.emit = lambda d: None
+        depends = {'integration/a': ['setup'], 'unit/a': ['setup']}
+        builds = []
+        def findBuilds(project, test_path):
+            build = Build()
+            build.project = project
+            build.test_path = test_path
+            if test_path in depends:
+                build.getDepends = lambda: depends[test_path]
+            build.run = lambda: None
+            builds.append(build)
+            return [build]
+        b.findBuilds = findBuilds
+        
+        d = b._build(dict(version='1', project='foo',
+                          test_path='integration/a'))
+        d.addCallback(lambda ign: b._build(dict(version='2', project='foo',
+                                                test_path='unit/a')))
+        d.addCallback(lambda ign: b._build(dict(version='3', project='foo',
+                                                test_path='setup')))
+        
+        def check(ign):
+            self.assertEqual([x.test_path for x in builds],
+                             ['integration/a', 'setup', 'unit/a', 'setup',
+                              'setup'])
+            self.assertEqual([x.dependency for x in builds],
+                             [False, True, False, True, False])
+            self.assertEqual([x.status for x in builds], [None] * 5)
+            self.assertEqual(b.scheduler.queued(), 3)
+        
+        return d.addCallback(check)
+    
+    
+    def test__supersede_stale(self):
+        """
+        A build from an earlier request than the latest build of its file
+        is superseded itself.
+        """
+        b = FileBuilder('foo')
+        b.supersede = {'foo': 'queued'}
+        old, new = Build(), Build()
+        for x in (old, new):
+            x.project = 'foo'
+            x.test_path = 'a'
+        b._supersede(new, 5)
+        b._supersede(old, 4)
+        self.assertEqual(old.status, SUPERSEDED)
+        self.assertEqual(new.status, None)
+        
+        other = Build()
+        other.project = 'bar'
+        other.test_path = 'a'
+        b._supersede(other, 3)
+        self.assertEqual(other.status, None,
+            "Only projects in supersede are affected")
+    
+    
+    def test_getMetrics(self):
+        """
+        Metrics say how busy I am and, with an admission, why builds are
+        being held back.
+        """
+        b = FileBuilder('foo')
+        b.scheduler.slots = 3
+        self.assertEqual(b.getMetrics(), dict(running=0, queued=0, slots=3,
+                                              admitting=True))
+        
+        class FakeAdmission:
+            def admits(self):
+                return False
+            def getMetrics(self):
+                return dict(load=9.0, blocked=['load'])
+        b.admission = FakeAdmission()
+        self.assertEqual(b.getMetrics(), dict(running=0, queued=0, slots=3,
+            admitting=False, load=9.0, blocked=['load']))
+        
+        build = Build()
+        b._submit(build)
+        self.assertEqual(build.state, 'queued')
+        b.scheduler._recheck.cancel()
+    
+    
+    def test_getLoad(self):
+        """
+        The load is only given for projects I have.
+        """
+        root = FilePath(self.mktemp())
+        root.child('foo').makedirs()
+        b = FileBuilder(root)
+        b.scheduler.slots = 2
+        self.assertEqual(b.getLoad('foo'), dict(queued=0, running=0, slots=2,
+                                                admitting=True))
+        self.assertEqual(b.getLoad('bar'), None)
+        self.assertEqual(FileBuilder().getLoad('foo'), None)
+        self.assertEqual(Builder().getLoad('foo'), None)
+    
+    
+    def test_getProjects(self):
+        """
+        My projects are the files and directories in my path.
+        """
+        root = FilePath(self.mktemp())
+        root.child('foo').makedirs()
+        root.child('bar').setContent('#!/bin/bash')
+        root.child('.hidden').makedirs()
+        self.assertEqual(FileBuilder(root).getProjects(), ['bar', 'foo'])
+        self.assertEqual(FileBuilder().getProjects(), [])
+        self.assertEqual(FileBuilder(self.mktemp()).getProjects(), [])
+        self.assertEqual(Builder().getProjects(), [])
@@ -0,0 +1,118 @@
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+
+import json
+import os
+import threading
+import time
+
+from simplebb.cache import ResultCache
+
+
+
+class ResultCacheTest(TestCase):
+
+
+    def test_init(self):
+        """
+        Should create the directory if needed.
+        """
+        path = FilePath(self.mktemp())
+        c = ResultCache(path.path)
+        self.assertEqual(c.path, path)
+        self.assertTrue(path.isdir())
+
+
+    def test_key(self):
+        """
+        The key depends on the file's content, the version and the
+        environment.
+        """
+        c = ResultCache(self.mktemp())
+        f = FilePath(self.mktemp())
+        f.setContent('foo')
+        
+        a = c.key(f, 'version', {})
+        self.assertEqual(a, c.key(f, 'version', {}))
+        self.assertNotEqual(a, c.key(f, 'other', {}))
+        self.assertNotEqual(a, c.key(f, 'version', {'FOO': 'bar'}))
+        
+        f.setContent('bar')
+        self.assertNotEqual(a, c.key(f, 'version', {}))
+
+
+    def test_putGet(self):
+        c = ResultCache(self.mktemp())
+        self.assertEqual(c.get('foo'), None)
+        c.put('foo', dict(status=0))
+        self.assertEqual(c.get('foo'), dict(status=0))
+
+
+    def test_maxAge(self):
+        """
+        Results older than maxAge are forgotten.
+        """
+        c = ResultCache(self.mktemp(), maxAge=60)
+        c.put('foo', dict(status=0))
+        old = time.time() - 61
+        os.utime(c.path.child('foo').path, (old, old))
+        self.assertEqual(c.get('foo'), None)
+        self.assertFalse(c.path.child('foo').exists())
+
+
+    def test_maxSize(self):
+        """
+        The least recently used results are forgotten when the cache is too
+        big.
+        """
+        c = ResultCache(self.mktemp(), maxSize=70)
+        content = json.dumps(dict(data='x' * 20))
+        for key in 'abc':
+            c.path.child(key).setContent(content)
+        old = time.time() - 10
+        os.utime(c.path.child('a').path, (old, old))
+        os.utime(c.path.child('b').path, (old + 1, old + 1))
+        
+        c.get('a')
+        self.assertEqual(c.evict(), 64)
+        self.assertNotEqual(c.get('a'), None)
+        self.assertEqual(c.get('b'), None)
+        self.assertNotEqual(c.get('c'), None)
+
+
+    def test_put_evict(self):
+        """
+        put scans the directory in a thread the first time, and after that
+        only once the bytes stored since the last scan might make the cache
+        too big.
+        """
+        c = ResultCache(self.mktemp(), maxSize=70)
+        scans = []
+        evict = c.evict
+        def spy():
+            scans.append(threading.currentThread())
+            return evict()
+        c.evict = spy
+        
+        c.put('a', dict(data='x' * 20))
+        self.assertNotEqual(c._evicting, None)
+        
+        def first(ign):
+            self.assertEqual(len(scans), 1)
+            self.assertNotEqual(scans[0], threading.currentThread(),
+                "The directory should be scanned in a thread")
+            self.assertEqual(c._size, 32)
+            
+            c.put('b', dict(data='x' * 20))
+            self.assertEqual(c._evicting, None, "Still under maxSize")
+            self.assertEqual(len(scans), 1)
+            c.put('c', dict(data='x' * 20))
+            self.assertNotEqual(c._evicting, None)
+            return c._evicting.addCallback(second)
+        
+        def second(ign):
+            self.assertEqual(len(scans), 2)
+            self.assertEqual(c._size, 64)
+            self.assertEqual(len(c.path.children()), 2)
+        
+        return c._evicting.addCallback(first)
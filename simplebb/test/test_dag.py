@@ -0,0 +1,171 @@
+from twisted.trial.unittest import TestCase
+
+from simplebb.dag import BuildGraph, provides
+from simplebb.build import Build, SKIPPED
+
+
+
+class providesTest(TestCase):
+
+
+    def test_file(self):
+        self.assertTrue(provides('setup/db', 'setup/db'))
+        self.assertFalse(provides('setup/dbx', 'setup/db'))
+
+
+    def test_dir(self):
+        self.assertTrue(provides('setup/db', 'setup'))
+        self.assertTrue(provides('setup/db', 'setup/'))
+        self.assertFalse(provides('setupx/db', 'setup'))
+
+
+    def test_None(self):
+        self.assertFalse(provides(None, 'setup'))
+
+
+
+class BuildGraphTest(TestCase):
+
+
+    def setUp(self):
+        self.submitted = []
+
+
+    def build(self, test_path, depends=()):
+        b = Build()
+        b.test_path = test_path
+        b.getDepends = lambda: list(depends)
+        return b
+
+
+    def graph(self):
+        return BuildGraph(self.submitted.append)
+
+
+    def test_independent(self):
+        """
+        Builds without dependencies are submitted as soon as they are added.
+        """
+        g = self.graph()
+        a, b = self.build('a'), self.build('b')
+        g.add(a)
+        self.assertEqual(self.submitted, [a])
+        g.add(b)
+        self.assertEqual(self.submitted, [a, b])
+        g.close()
+        self.assertEqual(self.submitted, [a, b])
+
+
+    def test_order(self):
+        """
+        Builds wait for close and for all their dependencies to succeed, and
+        builds that become ready together are submitted together.
+        """
+        g = self.graph()
+        setup = self.build('setup')
+        t1 = self.build('tests/1', ['setup'])
+        t2 = self.build('tests/2', ['setup'])
+        teardown = self.build('teardown', ['tests'])
+        for x in (teardown, t1, t2, setup):
+            g.add(x)
+        self.assertEqual(self.submitted, [setup])
+
+        setup._finish(0)
+        self.assertEqual(self.submitted, [setup],
+            "Should wait for close")
+
+        g.close()
+        self.assertEqual(self.submitted, [setup, t1, t2])
+
+        t1._finish(0)
+        self.assertEqual(self.submitted, [setup, t1, t2])
+        t2._finish(0)
+        self.assertEqual(self.submitted, [setup, t1, t2, teardown])
+        self.assertEqual(g.waiting(), 0)
+
+
+    def test_failed(self):
+        """
+        If a dependency fails its dependents, and theirs, are skipped.
+        """
+        g = self.graph()
+        setup = self.build('setup')
+        test = self.build('test', ['setup'])
+        report = self.build('report', ['test'])
+        other = self.build('other')
+        for x in (setup, test, report, other):
+            g.add(x)
+        g.close()
+
+        setup._finish(1)
+        self.assertEqual(self.submitted, [setup, other])
+        self.assertEqual(test.status, SKIPPED)
+        self.assertEqual(test.state, 'done')
+        self.assertEqual(report.status, SKIPPED)
+        self.assertEqual(other.status, None)
+
+
+    def test_missing(self):
+        """
+        Builds depending on builds that weren't found are skipped.
+        """
+        g = self.graph()
+        a = self.build('a', ['nothing'])
+        g.add(a)
+        g.close()
+        self.assertEqual(a.status, SKIPPED)
+        self.assertEqual(self.submitted, [])
+
+
+    def test_cycle(self):
+        """
+        Builds that depend on themselves, directly or not, are skipped along
+        with the builds depending on them.
+        """
+        g = self.graph()
+        a = self.build('a', ['b'])
+        b = self.build('b', ['a'])
+        c = self.build('c', ['b'])
+        d = self.build('d', ['d'])
+        for x in (a, b, c, d):
+            g.add(x)
+        g.close()
+        self.assertEqual([x.status for x in (a, b, c, d)], [SKIPPED] * 4)
+        self.assertEqual(self.submitted, [])
+
+
+    def test_finishedOnSubmit(self):
+        """
+        Builds that finish as soon as they are submitted release their
+        dependents.
+        """
+        def submit(build):
+            self.submitted.append(build)
+            build._finish(0)
+        g = BuildGraph(submit)
+        a = self.build('a')
+        b = self.build('b', ['a'])
+        c = self.build('c', ['b'])
+        for x in (c, b, a):
+            g.add(x)
+        g.close()
+        self.assertEqual(self.submitted, [a, b, c])
+
+
+    def test_finishedElsewhere(self):
+        """
+        Builds finished before they are submitted aren't submitted.
+        """
+        g = self.graph()
+        a = self.build('a')
+        a._finish(5)
+        b = self.build('b', ['c'])
+        c = self.build('c')
+        g.add(a)
+        g.add(b)
+        g.add(c)
+        b._finish(6)
+        g.close()
+        self.assertEqual(self.submitted, [c])
+        self.assertEqual(g.waiting(), 0)
+        self.assertEqual(b.status, 6)
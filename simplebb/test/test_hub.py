@@ -2,14 +2,17 @@ from twisted.trial.unittest import TestCase
 from zope.interface.verify import verifyClass, verifyObject
 
 from twisted.internet.endpoints import clientFromString
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
 from twisted.spread import pb
 
 from simplebb.interface import IBuilder, IEmitter, IObserver, IBuilderHub
-from simplebb.hub import Hub, RemoteHub
+from simplebb.hub import Hub, RemoteHub, PersistentRemoteHub, loadKey
+from simplebb.hub import BROADCAST, LEAST_LOADED, LOCAL
 from simplebb.builder import Builder
 from simplebb.shell import ShellFactory
 
+from collections import deque
+
 
 
 class FakeReference:
@@ -27,10 +30,92 @@ class FakeReference:
 
 
 
+class MethodReference(FakeReference):
+    """
+    I fake Remotes, answering each method with its own result.
+    """
+
+    def __init__(self, **results):
+        FakeReference.__init__(self)
+        self.results = results
+
+    def callRemote(self, *args):
+        self.called.append(args)
+        return defer.succeed(self.results.get(args[0]))
+
+
+
 class FakeRemoteHub:
     
+    uid = None
+    
     def __init__(self, original):
         self.original = original
+        self.staticInfo = False
+    
+    def getStaticInfo(self):
+        self.staticInfo = True
+
+
+
+class FakeObserver:
+    
+    def __init__(self, received):
+        self.received = received
+    
+    def buildReceived(self, buildDict):
+        self.received.append(buildDict)
+
+
+
+class LoadedBuilder:
+    """
+    I am a builder with a given load.
+    """
+    
+    def __init__(self, load, deferred=False, projects=('foo',)):
+        self.load = load
+        self.deferred = deferred
+        self.projects = list(projects)
+        self.requests = []
+    
+    def build(self, request):
+        self.requests.append(request)
+    
+    def getProjects(self):
+        return self.projects
+    
+    def getLoad(self, project):
+        if self.deferred:
+            return defer.succeed(self.load)
+        return self.load
+
+
+
+def load(queued=0, running=0, slots=1, admitting=True):
+    return dict(queued=queued, running=running, slots=slots,
+                admitting=admitting)
+
+
+
+class loadKeyTest(TestCase):
+
+
+    def test_order(self):
+        """
+        Builders admitting builds come first, then those with the fewest
+        builds that would be ahead of a new one, then the biggest.
+        """
+        loads = [
+            load(queued=0, running=0, slots=1, admitting=False),
+            load(queued=5, running=2, slots=2),
+            load(queued=1, running=2, slots=2),
+            load(queued=0, running=0, slots=1),
+            load(queued=0, running=1, slots=2),
+            load(queued=0, running=0, slots=4),
+        ]
+        expected = list(reversed(loads))
+        self.assertEqual(sorted(loads, key=loadKey), expected)
 
 
 
@@ -89,6 +174,94 @@ class HubTest(TestCase):
         self.assertEqual(called, ['something'])
     
     
+    def test_buildsReceived(self):
+        """
+        Should call emit for each build
+        """
+        h = Hub()
+        called = []
+        h.emit = called.append
+        h.buildsReceived(['a', 'b'])
+        self.assertEqual(called, ['a', 'b'])
+    
+    
+    def test_emit_tagged(self):
+        """
+        Builds are tagged with the hub they started at and the hubs that
+        emitted them.
+        """
+        h = Hub()
+        received = []
+        h.addObserver(FakeObserver(received))
+        
+        h.emit(dict(uid='1', status=0))
+        self.assertEqual(received, [dict(uid='1', status=0, origin=h.uid,
+                                         via=[h.uid])])
+        
+        h.emit(dict(uid='2', origin='a', via=['a', 'b']))
+        self.assertEqual(received[-1], dict(uid='2', origin='a',
+                                            via=['a', 'b', h.uid]))
+        
+        h.emit('not a build')
+        self.assertEqual(received[-1], 'not a build')
+
+
+    def test_emit_eventPathLength(self):
+        """
+        Only the last eventPathLength hubs are kept.
+        """
+        h = Hub()
+        h.eventPathLength = 2
+        received = []
+        h.addObserver(FakeObserver(received))
+        build = dict(uid='1', origin='a', via=['a', 'b', 'c'])
+        h.emit(build)
+        self.assertEqual(received, [dict(uid='1', origin='a',
+                                         via=['c', h.uid])])
+        self.assertEqual(build['via'], ['a', 'b', 'c'])
+
+
+    def test_emit_noEcho(self):
+        """
+        Builds aren't sent to observing hubs they came from or went
+        through.
+        """
+        h = Hub()
+        refs = {}
+        for uid in ('origin', 'via', 'other', None):
+            ref = FakeReference()
+            remote = RemoteHub(ref)
+            remote.uid = uid
+            h.addObserver(remote)
+            refs[uid] = ref
+        h.emit(dict(uid='1', origin='origin', via=['via']))
+        self.assertEqual(refs['origin'].called, [])
+        self.assertEqual(refs['via'].called, [])
+        self.assertEqual(len(refs['other'].called), 1)
+        self.assertEqual(len(refs[None].called), 1, "uid not known yet")
+
+
+    def test_emit_peered(self):
+        """
+        Between two hubs observing each other a build crosses the link once.
+        """
+        a, b = Hub(), Hub()
+        sent = []
+        class Link:
+            def __init__(self, hub):
+                self.hub = hub
+            def callRemote(self, name, *args):
+                sent.append(self.hub)
+                return defer.succeed(
+                    getattr(self.hub, 'remote_' + name)(*args))
+        for x, y in ((a, b), (b, a)):
+            remote = RemoteHub(Link(y))
+            remote.uid = y.uid
+            x.addObserver(remote)
+        a.emit(dict(uid='1', status=0))
+        self.assertEqual(sent, [b])
+
+
     def test_addBuilder(self):
         """
         Should add builder to _builders list
@@ -130,6 +303,588 @@ class HubTest(TestCase):
         self.assertEqual(b.called, r)
 
 
+    def test_dispatchMode(self):
+        self.assertEqual(Hub.dispatchMode, BROADCAST)
+
+
+    def test__build_leastLoaded(self):
+        """
+        In least-loaded mode only the least busy builder that can build the
+        project gets the request.
+        """
+        h = Hub()
+        h.dispatchMode = LEAST_LOADED
+        busy = LoadedBuilder(load(running=1))
+        idle = LoadedBuilder(load(), deferred=True)
+        incapable = LoadedBuilder(None)
+        for b in (busy, idle, incapable):
+            h.addBuilder(b)
+        r = dict(project='foo')
+        
+        def check(chosen):
+            self.assertEqual(chosen, idle)
+            self.assertEqual(idle.requests, [r])
+            self.assertEqual(busy.requests, [])
+            self.assertEqual(incapable.requests, [])
+        return h._build(r).addCallback(check)
+
+
+    def test__build_burst(self):
+        """
+        Requests sent to a builder recently count towards its load, so a
+        burst of requests is spread out before the builders' own loads
+        change.
+        """
+        h = Hub()
+        h.dispatchMode = LEAST_LOADED
+        now = [0]
+        h._dispatchClock = lambda: now[0]
+        a, b = LoadedBuilder(load()), LoadedBuilder(load())
+        h.addBuilder(a)
+        h.addBuilder(b)
+        for i in range(10):
+            h._build(dict(project='foo', uid=str(i)))
+        self.assertEqual([len(a.requests), len(b.requests)], [5, 5])
+        
+        a.load = load(queued=3)
+        now[0] = h.dispatchWindow
+        h._build(dict(project='foo'))
+        self.assertEqual(len(b.requests), 6, "Old requests forgotten")
+        
+        h.remBuilder(a)
+        self.assertEqual([x[0] for x in h._dispatched], [b])
+
+
+    def test__build_broadcastRequest(self):
+        """
+        Requests can ask to be broadcast.
+        """
+        h = Hub()
+        h.dispatchMode = LEAST_LOADED
+        builders = [LoadedBuilder(load()), LoadedBuilder(load())]
+        for b in builders:
+            h.addBuilder(b)
+        r = dict(project='foo', dispatch=BROADCAST)
+        h._build(r)
+        self.assertEqual([x.requests for x in builders], [[r], [r]])
+
+
+    def test_maxHops(self):
+        self.assertEqual(Hub.maxHops, 16)
+
+
+    def test__build_visited(self):
+        """
+        Broadcast requests are sent on to remote hubs with one more hop and
+        the uids of this hub and of the hubs being sent it, and aren't sent
+        to hubs they have already visited.
+        """
+        h = Hub()
+        local = LoadedBuilder(load())
+        seen, seenRef = self.remoteBuilder(load())
+        seen.uid = 'seen'
+        new, newRef = self.remoteBuilder(load())
+        new.uid = 'new'
+        unknown, unknownRef = self.remoteBuilder(load())
+        for b in (local, seen, new, unknown):
+            h.addBuilder(b)
+        r = dict(project='foo', hops=2, visited=['first', 'seen'])
+        h._build(r)
+        
+        self.assertEqual(local.requests, [r])
+        self.assertFalse([x for x in seenRef.called if x[0] == 'build'])
+        forwarded = dict(project='foo', hops=3,
+                         visited=['first', 'seen', h.uid, 'new'])
+        self.assertEqual(newRef.called[-1], ('build', forwarded))
+        self.assertEqual(unknownRef.called[-1], ('build', forwarded))
+        self.assertEqual(r['hops'], 2)
+        self.assertEqual(r['visited'], ['first', 'seen'])
+
+
+    def test__build_new(self):
+        """
+        A request that hasn't been anywhere yet starts with no hops.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load())
+        remote.uid = 'remote'
+        h.addBuilder(remote)
+        h._build(dict(project='foo'))
+        self.assertEqual(ref.called[-1], ('build', dict(project='foo',
+                         hops=1, visited=[h.uid, 'remote'])))
+
+
+    def test__build_maxHops(self):
+        """
+        Requests that have made maxHops hops only go to local builders.
+        """
+        h = Hub()
+        h.maxHops = 3
+        local = LoadedBuilder(load())
+        remote, ref = self.remoteBuilder(load())
+        h.addBuilder(local)
+        h.addBuilder(remote)
+        r = dict(project='foo', hops=3)
+        h._build(r)
+        self.assertEqual(local.requests, [r])
+        self.assertFalse([x for x in ref.called if x[0] == 'build'])
+
+
+    def test_mesh(self):
+        """
+        A request crosses each link of a triangle of hubs at most once and
+        reaches every hub.
+        """
+        hubs = [Hub(), Hub(), Hub()]
+        locals = []
+        sent = []
+        class Link:
+            def __init__(self, hub):
+                self.hub = hub
+            def callRemote(self, name, *args):
+                if name == 'build':
+                    sent.append(self.hub)
+                return defer.succeed(getattr(self.hub, 'remote_' + name)(*args))
+        for h in hubs:
+            b = LoadedBuilder(load())
+            locals.append(b)
+            h.addBuilder(b)
+        for h in hubs:
+            for other in hubs:
+                if other is not h:
+                    remote = RemoteHub(Link(other))
+                    remote.hub = h
+                    remote.uid = other.uid
+                    h.addBuilder(remote)
+        hubs[0].build(dict(project='foo'))
+        self.assertEqual([len(x.requests) for x in locals], [1, 1, 1])
+        self.assertEqual(sent, hubs[1:])
+
+
+    def test_line(self):
+        """
+        Requests reach hubs more than one hop away that can build them, even
+        though the hubs in between can't.
+        """
+        a, b, c = Hub(), Hub(), Hub()
+        builder = LoadedBuilder(load(), projects=['bench'])
+        c.addBuilder(builder)
+        class Link:
+            def __init__(self, hub):
+                self.hub = hub
+            def callRemote(self, name, *args):
+                return defer.succeed(getattr(self.hub, 'remote_' + name)(*args))
+        for x, y in ((a, b), (b, a), (b, c), (c, b)):
+            remote = RemoteHub(Link(y))
+            remote.hub = x
+            remote.uid = y.uid
+            x.addBuilder(remote)
+        a.build(dict(project='bench'))
+        self.assertEqual(len(builder.requests), 1)
+
+
+    def test_leaves(self):
+        """
+        Broadcast requests aren't sent to hubs that can't reach a builder of
+        their project.
+        """
+        hubs = [Hub() for i in range(4)]
+        builders = []
+        for h, project in zip(hubs, ['foo', 'foo', 'bar', 'baz']):
+            b = LoadedBuilder(load(), projects=[project])
+            builders.append(b)
+            h.addBuilder(b)
+        sent = []
+        class Link:
+            def __init__(self, hub):
+                self.hub = hub
+            def callRemote(self, name, *args):
+                if name == 'build':
+                    sent.append(self.hub)
+                return defer.succeed(getattr(self.hub, 'remote_' + name)(*args))
+        # a star around the first hub, and the last one behind the third
+        for x, y in ((0, 1), (0, 2), (2, 3)):
+            for a, b in ((x, y), (y, x)):
+                remote = RemoteHub(Link(hubs[b]))
+                remote.hub = hubs[a]
+                remote.uid = hubs[b].uid
+                hubs[a].addBuilder(remote)
+        hubs[0].build(dict(project='foo'))
+        self.assertEqual(sent, [hubs[1]])
+        
+        del sent[:]
+        hubs[0].build(dict(project='baz'))
+        self.assertEqual(sent, [hubs[2], hubs[3]])
+        self.assertEqual(len(builders[3].requests), 1)
+
+
+    def test__relayed(self):
+        """
+        Hubs are told the hops to the projects they can reach through me,
+        except through themselves or too many hops away.
+        """
+        h = Hub()
+        h.maxHops = 3
+        h.addBuilder(LoadedBuilder(load(), projects=['mine']))
+        a, aRef = self.remoteBuilder(load(), projects=['a', 'mine'])
+        b, bRef = self.remoteBuilder(load(), projects=['b'])
+        a.uid, b.uid = 'a', 'b'
+        h.addBuilder(a)
+        h.addBuilder(b)
+        h.remote_projectsChanged('a', ['a', 'mine'], {'near': 1, 'far': 2})
+        h.remote_projectsChanged('b', ['b'], {'near': 2})
+        self.assertEqual(h._relayed(a), {'b': 1})
+        self.assertEqual(h._relayed(b), {'a': 1, 'near': 2})
+        self.assertEqual(bRef.called[-1],
+                         ('projectsChanged', h.uid, ['mine'],
+                          {'a': 1, 'near': 2}))
+
+
+    def test__build_noBuilder(self):
+        """
+        If no builder can build the project, nobody gets the request.
+        """
+        h = Hub()
+        h.addBuilder(LoadedBuilder(None))
+        d = h._build(dict(project='foo', dispatch=LEAST_LOADED))
+        return d.addCallback(self.assertEqual, None)
+
+
+    def remoteBuilder(self, load, projects=('foo',)):
+        ref = MethodReference(getLoad=load, getProjects=list(projects))
+        remote = RemoteHub(ref)
+        remote.hub = Hub()
+        return remote, ref
+
+
+    def test__build_remote(self):
+        """
+        Remote hubs are asked for their load, and are sent the request
+        as local so that they don't pass it on.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load(slots=8))
+        h.addBuilder(LoadedBuilder(load()))
+        h.addBuilder(remote)
+        r = dict(project='foo', dispatch=LEAST_LOADED)
+        
+        def check(chosen):
+            self.assertEqual(chosen, remote)
+            self.assertEqual(ref.called, [
+                ('getProjects',),
+                ('getLoad', 'foo'),
+                ('build', dict(project='foo', dispatch=LOCAL)),
+            ])
+            self.assertEqual(r['dispatch'], LEAST_LOADED)
+        return h._build(r).addCallback(check)
+
+
+    def test__build_local(self):
+        """
+        Local requests only go to builders that aren't remote hubs.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load(slots=8))
+        local = LoadedBuilder(load(running=1))
+        h.addBuilder(remote)
+        h.addBuilder(local)
+        r = dict(project='foo', dispatch=LOCAL)
+        
+        def check(chosen):
+            self.assertEqual(chosen, local)
+            self.assertEqual(ref.called, [
+                ('getProjects',),
+                ('projectsChanged', h.uid, ['foo']),
+            ])
+        return h._build(r).addCallback(check)
+
+
+    def test_getLoad(self):
+        """
+        A Hub's load is the sum of its local builders' that can build the
+        project.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load(slots=8))
+        h.addBuilder(remote)
+        h.addBuilder(LoadedBuilder(load(queued=2, running=1, slots=2,
+                                        admitting=False)))
+        h.addBuilder(LoadedBuilder(load(queued=1, slots=3), deferred=True))
+        h.addBuilder(LoadedBuilder(None))
+        d = h.getLoad('foo')
+        d.addCallback(self.assertEqual, load(queued=3, running=1, slots=5,
+                                             admitting=True))
+        return d
+
+
+    def test_getLoad_none(self):
+        h = Hub()
+        h.addBuilder(LoadedBuilder(None))
+        return h.getLoad('foo').addCallback(self.assertEqual, None)
+
+
+    def test_queuePosition(self):
+        """
+        A request's position is the smallest among my local builders.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load())
+        h.addBuilder(remote)
+        for position in (4, None, 2):
+            b = LoadedBuilder(load())
+            b.queuePosition = lambda uid, position=position: position
+            h.addBuilder(b)
+        h.addBuilder(LoadedBuilder(load()))
+        d = h.queuePosition('foo')
+        d.addCallback(self.assertEqual, 2)
+        return d
+
+
+    def test_queuePosition_none(self):
+        h = Hub()
+        h.addBuilder(LoadedBuilder(load()))
+        return h.queuePosition('foo').addCallback(self.assertEqual, None)
+
+
+    def test_getProjects(self):
+        """
+        A Hub can build the projects of its local builders, whatever its
+        remote hubs say they can build.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load(), projects=['remote'])
+        h.addBuilder(remote)
+        h.addBuilder(LoadedBuilder(load(), projects=['foo', 'bar']))
+        h.addBuilder(LoadedBuilder(load(), projects=['bar', 'baz']))
+        self.assertEqual(h.getProjects(), ['bar', 'baz', 'foo'])
+        self.assertEqual(h.remote_getProjects(), ['bar', 'baz', 'foo'])
+
+
+    def test__build_capable(self):
+        """
+        Requests only go to builders that can build their project, or that
+        haven't said what they can build.  Broadcast requests also go to
+        remote hubs that can reach a hub that can build them.
+        """
+        h = Hub()
+        foo = LoadedBuilder(load(), projects=['foo'])
+        bar = LoadedBuilder(load(), projects=['bar'])
+        unknown = LoadedBuilder(load())
+        unknown.getProjects = lambda: defer.fail(Exception('no'))
+        remote, ref = self.remoteBuilder(load(), projects=['bar'])
+        for b in (foo, bar, unknown, remote):
+            h.addBuilder(b)
+        del ref.called[:]
+        
+        r = dict(project='foo')
+        h._build(r)
+        self.assertEqual(foo.requests, [r])
+        self.assertEqual(bar.requests, [])
+        self.assertEqual(unknown.requests, [r])
+        self.assertEqual(ref.called, [])
+        
+        r = dict(project='bar')
+        h._build(r)
+        self.assertEqual(bar.requests, [r])
+        self.assertEqual([(x[0], x[1]['project']) for x in ref.called],
+                         [('build', 'bar')])
+        
+        remote.uid = 'remote'
+        h.remote_projectsChanged('remote', ['bar'], {'far': 2})
+        del ref.called[:]
+        h._build(dict(project='far'))
+        self.assertEqual([(x[0], x[1]['project']) for x in ref.called],
+                         [('build', 'far')])
+        
+        del ref.called[:]
+        h._build(dict(project='foo', dispatch=LEAST_LOADED))
+        h._build(dict(project='far', dispatch=LEAST_LOADED))
+        self.assertEqual(ref.called, [], "Not asked for its load")
+
+
+    def test_advertise(self):
+        """
+        Remote hubs are told when the projects of my local builders change,
+        and what they tell me is indexed.
+        """
+        h = Hub()
+        remote, ref = self.remoteBuilder(load(), projects=[])
+        h.addBuilder(remote)
+        local = LoadedBuilder(load(), projects=['foo'])
+        h.addBuilder(local)
+        self.assertEqual(ref.called, [
+            ('getProjects',),
+            ('projectsChanged', h.uid, ['foo']),
+        ])
+        
+        del ref.called[:]
+        h.refreshProjects()
+        self.assertEqual(ref.called, [], "Nothing changed")
+        
+        local.projects = ['foo', 'new']
+        h.refreshProjects()
+        self.assertEqual(ref.called, [('projectsChanged', h.uid, ['foo', 'new'])])
+        
+        del ref.called[:]
+        h.remBuilder(local)
+        self.assertEqual(ref.called, [('projectsChanged', h.uid, [])])
+        
+        remote.uid = 'remote'
+        h.remote_projectsChanged('remote', ['baz'])
+        self.assertEqual(h._capable('baz'), [remote])
+        self.assertEqual(h._capable('foo'), [])
+
+
+    def test_remote_projectsChanged_unknown(self):
+        """
+        If the hub whose projects changed isn't known by its uid yet, the
+        remote hubs without a uid are asked for their projects.
+        """
+        h = Hub()
+        known, knownRef = self.remoteBuilder(load(), projects=['foo'])
+        known.uid = 'known'
+        unknown, unknownRef = self.remoteBuilder(load(), projects=['foo'])
+        h.addBuilder(known)
+        h.addBuilder(unknown)
+        unknownRef.results['getProjects'] = ['bar']
+        del knownRef.called[:]
+        del unknownRef.called[:]
+        
+        h.remote_projectsChanged('other', ['baz'], {'far': 1})
+        self.assertEqual(knownRef.called,
+                         [('projectsChanged', h.uid, [], {'bar': 1})])
+        self.assertEqual(unknownRef.called, [('getProjects',)])
+        self.assertEqual(h._capable('bar'), [unknown])
+        self.assertEqual(h._capable('baz'), [])
+        
+        unknown.uid = 'other'
+        h._identified(unknown)
+        self.assertEqual(h._capable('baz'), [unknown])
+        self.assertEqual(h._capable('far', relayed=True), [unknown])
+        self.assertEqual(h._unidentified, {})
+
+
+    def test_projectsChanged_pb(self):
+        """
+        Changes to the projects of either side of a real PB connection are
+        indexed by the other side.  This is functionalish.
+        """
+        server = Hub()
+        client = Hub()
+        serverBuilder = LoadedBuilder(load(), projects=['foo'])
+        clientBuilder = LoadedBuilder(load(), projects=['bar'])
+        server.addBuilder(serverBuilder)
+        client.addBuilder(clientBuilder)
+        description = 'tcp:host=127.0.0.1:port=10997'
+        
+        def roundTrips(ign, remote, count=3):
+            # replies come back after anything sent before them
+            d = remote.wrappedCallRemote('getUID')
+            for i in range(count - 1):
+                d.addCallback(lambda x: remote.wrappedCallRemote('getUID'))
+            return d
+        
+        def connected(ign):
+            remote = [x for x in client._builders
+                      if isinstance(x, RemoteHub)][0]
+            d = roundTrips(None, remote)
+            
+            def change(ign):
+                self.assertEqual(client._capable('foo'), [remote])
+                serverBuilder.projects = ['foo', 'new']
+                server.refreshProjects()
+                clientBuilder.projects = ['bar', 'mine']
+                client.refreshProjects()
+            d.addCallback(change)
+            d.addCallback(roundTrips, remote)
+            
+            def check(ign):
+                self.assertEqual(client._capable('new'), [remote])
+                wrapped = [x for x in server._builders
+                           if isinstance(x, RemoteHub)]
+                self.assertEqual(server._capable('mine'), wrapped)
+                self.assertEqual(len(wrapped), 1)
+            return d.addCallback(check)
+        
+        d = server.startServer(server.getPBServerFactory(), 'tcp:10997')
+        d.addCallback(lambda x: client.connect(description))
+        d.addCallback(connected)
+        d.addBoth(self.disconnected, client, server, description)
+        return d
+
+
+    def disconnected(self, result, client, server, description):
+        client.disconnect(description)
+        d = server.stopServer('tcp:10997')
+        return d.addCallback(lambda x: result)
+
+
+    def test__build_newProject(self):
+        """
+        A request for a project that isn't known makes the hub ask its local
+        builders again, so that projects added since are built.
+        """
+        h = Hub()
+        local = LoadedBuilder(load(), projects=['foo'])
+        h.addBuilder(local)
+        local.projects = ['foo', 'new']
+        r = dict(project='new')
+        h._build(r)
+        self.assertEqual(local.requests, [r])
+        
+        local.projects = ['foo', 'new', 'newer']
+        h._build(dict(project='newer'))
+        self.assertEqual(len(local.requests), 1, "Asked too recently")
+        
+        h._lastMiss -= h.projectMissInterval
+        h._build(dict(project='newer'))
+        self.assertEqual(len(local.requests), 2)
+
+
+    def test_networked(self):
+        """
+        Hubs refresh their projects while they have servers or connections.
+        """
+        h = Hub()
+        started = []
+        h.startRefreshing = lambda: started.append(True)
+        h.stopRefreshing = lambda: started.append(False)
+        h._servers['tcp:1'] = 'server'
+        h._networked()
+        h._outgoingConns['tcp:2'] = 'client'
+        del h._servers['tcp:1']
+        h._networked()
+        del h._outgoingConns['tcp:2']
+        h._networked()
+        self.assertEqual(started, [True, True, False])
+
+
+    def test_startRefreshing(self):
+        h = Hub()
+        clock = task.Clock()
+        local = LoadedBuilder(load(), projects=['foo'])
+        h.addBuilder(local)
+        h.startRefreshing(clock)
+        h.startRefreshing(clock)
+        local.projects = ['bar']
+        clock.advance(h.projectRefreshInterval)
+        self.assertEqual(h.getProjects(), ['bar'])
+        h.stopRefreshing()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_remote_getLoad(self):
+        h = Hub()
+        h.getLoad = lambda project: project + ' load'
+        self.assertEqual(h.remote_getLoad('foo'), 'foo load')
+
+
+    def test_remote_queuePosition(self):
+        h = Hub()
+        h.queuePosition = lambda uid: uid + ' position'
+        self.assertEqual(h.remote_queuePosition('foo'), 'foo position')
+
+
     def test_remote_build(self):
         """
         Should have a remote build that just runs build
@@ -142,6 +897,28 @@ class HubTest(TestCase):
         self.assertEqual(called, [o])
     
     
+    def test_remote_buildReceived(self):
+        """
+        Should just call buildReceived
+        """
+        h = Hub()
+        called = []
+        h.buildReceived = called.append
+        h.remote_buildReceived('foo')
+        self.assertEqual(called, ['foo'])
+    
+    
+    def test_remote_buildsReceived(self):
+        """
+        Should just call buildsReceived
+        """
+        h = Hub()
+        called = []
+        h.buildsReceived = called.append
+        h.remote_buildsReceived(['foo'])
+        self.assertEqual(called, [['foo']])
+    
+    
     def test_remote_addBuilder(self):
         """
         Should wrap the remote in a RemoteHub then call addBuilder
@@ -200,15 +977,53 @@ class HubTest(TestCase):
         h = Hub()
         h.remoteHubFactory = FakeRemoteHub
         called = []
-        h.addObserver = called.append
+        h.addObserver = lambda *args: called.append(args)
         
         h.remote_addObserver('foo')
         
         self.assertEqual(len(called), 1)
-        observer = called[0]
+        observer, filter = called[0]
         self.assertTrue(isinstance(observer, FakeRemoteHub))
         self.assertEqual(observer.original, 'foo')
         self.assertEqual(observer.hub, h)
+        self.assertTrue(observer.staticInfo, "Should learn its uid")
+        self.assertEqual(filter, None)
+    
+    
+    def test_remote_addObserver_filter(self):
+        """
+        A filter sent along with the remote observer is used when adding it.
+        """
+        h = Hub()
+        h.remoteHubFactory = FakeRemoteHub
+        called = []
+        h.addObserver = lambda *args: called.append(args)
+        
+        h.remote_addObserver('foo', dict(project='bar'))
+        
+        self.assertEqual(len(called), 1)
+        observer, filter = called[0]
+        self.assertEqual(observer.original, 'foo')
+        self.assertEqual(filter, dict(project='bar'))
+    
+    
+    def test_remote_addObserver_filtered(self):
+        """
+        Builds that don't pass the remote observer's filter are never sent
+        over the wire.
+        """
+        h = Hub()
+        ref = FakeReference()
+        h.remote_addObserver(ref, dict(project='foo'))
+        del ref.called[:]
+        
+        h.emit(dict(uid='1', project='bar', status=0))
+        self.assertEqual(ref.called, [])
+        
+        h.emit(dict(uid='2', project='foo', status=0))
+        self.assertEqual(ref.called, [('buildReceived',
+                          dict(uid='2', project='foo', status=0,
+                               origin=h.uid, via=[h.uid]))])
 
 
     def test_remote_remObserver(self):
@@ -371,10 +1186,27 @@ class HubTest(TestCase):
             ('addB', (remote,)),
             ('addO', (remote,)),
             ('r_addB', (hub,)),
-            ('r_addO', (hub,)),
+            ('r_addO', (hub, None)),
             ('r_getStaticInfo', ()),
         ]))
         self.assertEqual(remote.hub, hub)
+    
+    
+    def test_gotRemoteRoot_observerFilter(self):
+        """
+        My observerFilter is sent along when observing the remote.
+        """
+        hub = Hub()
+        hub.observerFilter = dict(project='foo')
+        remote = FakeRemoteHub('foo')
+        
+        called = []
+        remote.addBuilder = lambda *args: None
+        remote.addObserver = lambda *args: called.append(args)
+        remote.getStaticInfo = lambda: None
+        
+        hub.gotRemoteRoot(remote)
+        self.assertEqual(called, [(hub, dict(project='foo'))])
 
 
 
@@ -453,6 +1285,18 @@ class RemoteHubTest(TestCase):
         self.tr('addBuilder', 'something')
 
 
+    def test_getLoad(self):
+        self.tr('getLoad', 'something')
+
+
+    def test_getProjects(self):
+        self.tr('getProjects')
+
+
+    def test_projectsChanged(self):
+        self.tr('projectsChanged', 'something', ['foo'])
+
+
     def test_remBuilder(self):
         self.tr('remBuilder', 'something')
     
@@ -465,10 +1309,18 @@ class RemoteHubTest(TestCase):
         self.tr('addObserver', 'something')
     
     
+    def test_addObserver_filter(self):
+        self.tr('addObserver', 'something', dict(project='foo'))
+    
+    
     def test_buildReceived(self):
         self.tr('buildReceived', 'something')
     
     
+    def test_buildsReceived(self):
+        self.tr('buildsReceived', ['something'])
+    
+    
     def test_eq(self):
         """
         If my original is equal, I am equal
@@ -580,6 +1432,297 @@ class RemoteHubTest(TestCase):
 
 
 
+class LinkedReference(MethodReference):
+    """
+    I fake Remotes that can be disconnected.
+    """
+
+    def __init__(self, **results):
+        MethodReference.__init__(self, **results)
+        self.disconnected = []
+
+    def notifyOnDisconnect(self, callback):
+        self.disconnected.append(callback)
+
+    def disconnect(self):
+        for callback in self.disconnected:
+            callback(self)
+
+
+
+class FakeTransport:
+
+    lost = False
+
+    def loseConnection(self):
+        self.lost = True
+
+
+
+class FakeProtocol:
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+
+class PersistentRemoteHubTest(TestCase):
+
+
+    def persistent(self, roots=()):
+        """
+        Make a PersistentRemoteHub on a task.Clock whose connection attempts
+        are answered with C{roots} in turn, failing once they run out.
+        """
+        hub = Hub()
+        roots = list(roots)
+        attempts = []
+        def connectRoot(description):
+            attempts.append(description)
+            if not roots:
+                return defer.fail(Exception('refused'))
+            return defer.succeed((FakeProtocol(), roots.pop(0)))
+        hub._connectRoot = connectRoot
+        remote = PersistentRemoteHub(hub, 'tcp:host=foo:port=1')
+        remote.clock = task.Clock()
+        remote.random = lambda: 0.5
+        return hub, remote, attempts
+
+
+    def test_defaults(self):
+        self.assertEqual(PersistentRemoteHub.initialDelay, 0.5)
+        self.assertEqual(PersistentRemoteHub.maxDelay, 30.0)
+        self.assertEqual(PersistentRemoteHub.factor, 2.0)
+        self.assertEqual(PersistentRemoteHub.jitter, 0.5)
+        self.assertEqual(PersistentRemoteHub.bufferLimit, 10000)
+        self.assertEqual(PersistentRemoteHub.clock, reactor)
+
+
+    def test_nextDelay(self):
+        """
+        Delays grow exponentially up to maxDelay and are varied by up to
+        jitter of themselves.
+        """
+        hub, remote, attempts = self.persistent()
+        delays = []
+        for i in range(8):
+            remote.attempts = i
+            delays.append(remote.nextDelay())
+        self.assertEqual(delays, [0.5, 1, 2, 4, 8, 16, 30, 30])
+        
+        remote.attempts = 2
+        remote.random = lambda: 0.0
+        self.assertEqual(remote.nextDelay(), 1.0)
+        remote.random = lambda: 0.999999
+        self.assertAlmostEqual(remote.nextDelay(), 3.0, 4)
+        
+        remote.attempts = 1100
+        remote.random = lambda: 0.5
+        self.assertEqual(remote.nextDelay(), 30)
+
+
+    def test_retryForever(self):
+        """
+        Attempts stop counting up once the delay is at its maximum, and
+        retries carry on.
+        """
+        hub, remote, attempts = self.persistent()
+        remote.start()
+        for i in range(2000):
+            remote.clock.advance(remote.maxDelay)
+        self.assertEqual(len(attempts), 2001)
+        self.assertEqual(remote.attempts, 6)
+        self.assertEqual(len(remote.clock.getDelayedCalls()), 1)
+
+
+    def test_retry(self):
+        """
+        Failed attempts are retried with backoff until one succeeds, and the
+        Deferred from start fires then.
+        """
+        ref = LinkedReference(getProjects=[])
+        hub, remote, attempts = self.persistent()
+        started = []
+        remote.start().addCallback(started.append)
+        self.assertEqual(len(attempts), 1)
+        
+        remote.clock.advance(0.5)
+        self.assertEqual(len(attempts), 2)
+        remote.clock.advance(0.5)
+        self.assertEqual(len(attempts), 2, "Should wait 1 second")
+        
+        hub._connectRoot = lambda d: defer.succeed((FakeProtocol(), ref))
+        remote.clock.advance(0.5)
+        self.assertEqual(started, [remote])
+        self.assertEqual(remote.attempts, 0)
+        self.assertEqual(remote.original, ref)
+        self.assertEqual(remote.clock.getDelayedCalls(), [])
+
+
+    def test_register(self):
+        """
+        Once connected it registers like any other remote hub, and again
+        each time it reconnects.
+        """
+        first = LinkedReference(getProjects=['foo'], getUID='server')
+        second = LinkedReference(getProjects=['bar'], getUID='server')
+        hub, remote, attempts = self.persistent([first, second])
+        remote.start()
+        self.assertEqual(hub._builders, [remote])
+        self.assertEqual(hub._observers, [remote])
+        self.assertEqual([x[0] for x in first.called],
+            ['getProjects', 'addBuilder', 'addObserver', 'getUID',
+             'getName'])
+        self.assertEqual(remote.uid, 'server')
+        self.assertEqual(hub._capable('foo'), [remote])
+        
+        first.disconnect()
+        self.assertEqual(remote.original, None)
+        self.assertEqual(hub._builders, [remote], "Should stay registered")
+        remote.clock.advance(0.5)
+        self.assertEqual(remote.original, second)
+        self.assertEqual([x[0] for x in second.called],
+            ['addBuilder', 'addObserver', 'getUID', 'getName',
+             'getProjects'])
+        self.assertEqual(hub._capable('bar'), [remote])
+
+
+    def test_buffer(self):
+        """
+        Requests and builds sent while disconnected are sent once
+        reconnected.
+        """
+        first = LinkedReference(getProjects=['foo'])
+        second = LinkedReference(getProjects=['foo'])
+        hub, remote, attempts = self.persistent([first, second])
+        remote.start()
+        first.disconnect()
+        
+        hub.build(dict(project='foo', uid='r'))
+        hub.emit(dict(uid='b', status=0))
+        self.assertEqual(len(remote.buffered), 2)
+        
+        remote.clock.advance(0.5)
+        self.assertEqual(remote.buffered, deque())
+        sent = [x for x in second.called
+                if x[0] in ('build', 'buildReceived')]
+        self.assertEqual([(x[0], x[1]['uid']) for x in sent],
+                         [('build', 'r'), ('buildReceived', 'b')])
+
+
+    def test_bufferLost(self):
+        """
+        Calls that fail because the connection went away are buffered.
+        """
+        ref = FakeReference()
+        hub, remote, attempts = self.persistent()
+        remote.original = ref
+        remote.buildReceived(dict(uid='b'))
+        ref.result.errback(pb.PBConnectionLost())
+        self.assertEqual(list(remote.buffered),
+                         [('buildReceived', dict(uid='b'))])
+
+
+    def test_bufferLimit(self):
+        hub, remote, attempts = self.persistent()
+        remote.bufferLimit = 2
+        for i in range(3):
+            remote.build(dict(uid=str(i)))
+        self.assertEqual(list(remote.buffered),
+                         [('build', dict(uid='1')), ('build', dict(uid='2'))])
+        self.assertEqual(remote.dropped, 1)
+
+
+    def test_disconnected(self):
+        """
+        Other calls have no result while disconnected.
+        """
+        hub, remote, attempts = self.persistent()
+        results = []
+        remote.getLoad('foo').addCallback(results.append)
+        self.assertEqual(results, [None])
+
+
+    def test_eq(self):
+        hub, remote, attempts = self.persistent()
+        self.assertEqual(remote, remote)
+        self.assertNotEqual(remote, RemoteHub(None))
+        remote.original = 'foo'
+        self.assertEqual(remote, RemoteHub('foo'))
+
+
+    def test_stop(self):
+        """
+        Stopping cancels any retry, drops the connection and leaves the hub.
+        """
+        ref = LinkedReference(getProjects=[])
+        hub, remote, attempts = self.persistent([ref])
+        remote.start()
+        protocol = remote._protocol
+        remote.stop()
+        self.assertTrue(protocol.transport.lost)
+        self.assertEqual(hub._builders, [])
+        self.assertEqual(hub._observers, [])
+        ref.disconnect()
+        self.assertEqual(remote.clock.getDelayedCalls(), [])
+        
+        hub, remote, attempts = self.persistent()
+        remote.start()
+        remote.stop()
+        self.assertEqual(remote.clock.getDelayedCalls(), [])
+
+
+    def test_hub(self):
+        """
+        Hubs make persistent connections, and disconnect stops them.
+        """
+        h = Hub()
+        h._connectRoot = lambda d: defer.Deferred()
+        h.connect('tcp:host=foo:port=1', persistent=True)
+        remote = h._outgoingConns['tcp:host=foo:port=1']
+        self.assertTrue(isinstance(remote, PersistentRemoteHub))
+        self.assertEqual(remote.description, 'tcp:host=foo:port=1')
+        h.disconnect('tcp:host=foo:port=1')
+        self.assertTrue(remote._stopped)
+        self.assertEqual(h._outgoingConns, {})
+
+
+    def test_reconnect(self):
+        """
+        A persistent connection comes back after the connection is dropped.
+        This is functionalish.
+        """
+        server = Hub()
+        client = Hub()
+        builds = []
+        server.buildReceived = builds.append
+        description = 'tcp:host=127.0.0.1:port=10998'
+        d = server.startServer(server.getPBServerFactory(), 'tcp:10998')
+        d.addCallback(lambda x: client.connect(description, persistent=True))
+        
+        def connected(remote):
+            remote.initialDelay = 0.05
+            remote._protocol.transport.loseConnection()
+            reconnected = defer.Deferred()
+            def lost(root):
+                client.emit(dict(uid='missed', status=0))
+                self.assertEqual(len(remote.buffered), 1)
+                reactor.callLater(0.5, reconnected.callback, remote)
+            remote.original.notifyOnDisconnect(lost)
+            return reconnected
+        
+        def check(remote):
+            self.assertNotEqual(remote.original, None)
+            self.assertEqual(remote.buffered, deque())
+            self.assertEqual([x['uid'] for x in builds], ['missed'])
+        d.addCallback(connected)
+        d.addCallback(check)
+        d.addCallback(lambda x: client.disconnect(description))
+        d.addCallback(lambda x: server.stopServer('tcp:10998'))
+        return d
+
+
+
 class HubShellTest(TestCase):
     """
     I test the shell aspects of the Hub
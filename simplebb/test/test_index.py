@@ -0,0 +1,188 @@
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+from twisted.internet import task, reactor
+
+import os
+import time
+
+from simplebb.index import ScriptIndex, getNotifier, compilePattern
+from simplebb.index import RECURSIVE, _patterns
+
+
+
+class ScriptIndexTest(TestCase):
+
+
+    def makeTree(self):
+        """
+        Make root/{a, dir/b, dir/sub/c, dirty}
+        """
+        root = FilePath(self.mktemp())
+        sub = root.child('dir').child('sub')
+        sub.makedirs()
+        root.child('a').setContent('a')
+        root.child('dir').child('b').setContent('b')
+        sub.child('c').setContent('c')
+        root.child('dirty').setContent('d')
+        return root
+
+
+    def age(self, root):
+        """
+        Make all the directories under root look old, so that changes show
+        up in their modification times.
+        """
+        old = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(root.path):
+            os.utime(dirpath, (old, old))
+
+
+    def test_files(self):
+        root = self.makeTree()
+        index = ScriptIndex(root)
+        self.assertEqual(index.files(), ['a', 'dir/b', 'dir/sub/c', 'dirty'])
+
+
+    def test_filesUnder(self):
+        root = self.makeTree()
+        index = ScriptIndex(root)
+        self.assertEqual(index.filesUnder(''),
+                         ['a', 'dir/b', 'dir/sub/c', 'dirty'])
+        self.assertEqual(index.filesUnder('dir'), ['dir/b', 'dir/sub/c'])
+        self.assertEqual(index.filesUnder('dir/sub/c'), ['dir/sub/c'])
+        self.assertEqual(index.filesUnder('a'), ['a'])
+        self.assertEqual(index.filesUnder('nothing'), [])
+
+
+    def test_notStale(self):
+        """
+        Once scanned, an unchanged tree isn't scanned again, even if the
+        files' contents change.
+        """
+        root = self.makeTree()
+        self.age(root)
+        index = ScriptIndex(root)
+        index.files()
+        self.assertFalse(index.isStale())
+        
+        root.child('dir').child('sub').child('c').open('w').write('foo')
+        self.assertFalse(index.isStale())
+        
+        scanned = []
+        index.scan = lambda: scanned.append(True)
+        index.files()
+        self.assertEqual(scanned, [])
+
+
+    def test_stale_added(self):
+        """
+        Adding a file deep in the tree is noticed.
+        """
+        root = self.makeTree()
+        self.age(root)
+        index = ScriptIndex(root)
+        index.files()
+        
+        root.child('dir').child('sub').child('new').setContent('new')
+        self.assertTrue(index.isStale())
+        self.assertTrue('dir/sub/new' in index.files())
+        self.assertFalse(index.isStale())
+
+
+    def test_stale_removed(self):
+        """
+        Removing a directory is noticed.
+        """
+        root = self.makeTree()
+        self.age(root)
+        index = ScriptIndex(root)
+        index.files()
+        
+        root.child('dir').remove()
+        self.assertTrue(index.isStale())
+        self.assertEqual(index.files(), ['a', 'dirty'])
+
+
+    def test_notifier(self):
+        """
+        With an inotify notifier, changes are noticed without looking at
+        the directories.
+        """
+        notifier = getNotifier()
+        if notifier is None:
+            raise self.skipTest('inotify is not available')
+        self.addCleanup(notifier.loseConnection)
+        
+        root = self.makeTree()
+        index = ScriptIndex(root, notifier)
+        index.files()
+        self.assertFalse(index.isStale())
+        
+        root.child('dir').child('sub').child('new').setContent('new')
+        
+        d = task.deferLater(reactor, 0.1, lambda: None)
+        
+        def check(_):
+            self.assertTrue(index.isStale())
+            self.assertTrue('dir/sub/new' in index.files())
+        return d.addCallback(check)
+
+
+    def matchTree(self):
+        """
+        Make a tree for testing match.
+        """
+        root = FilePath(self.mktemp())
+        for path in ['unit/fast_a', 'unit/slow_a', 'unit/x/fast_b',
+                     'unit/x/y/fast_c', 'unit/.hidden/fast_d', 'func/fast_e',
+                     'top']:
+            fp = root.preauthChild(path)
+            if not fp.parent().exists():
+                fp.parent().makedirs()
+            fp.setContent('foo')
+        return ScriptIndex(root)
+
+
+    def test_match_literal(self):
+        index = self.matchTree()
+        self.assertEqual(index.match('unit/x'), ['unit/x'])
+        self.assertEqual(index.match('top'), ['top'])
+        self.assertEqual(index.match('nothing/here'), [])
+
+
+    def test_match_wildcard(self):
+        """
+        Wildcards match within a single directory and skip hidden names.
+        """
+        index = self.matchTree()
+        self.assertEqual(index.match('*'), ['func', 'top', 'unit'])
+        self.assertEqual(index.match('unit/fast_*'), ['unit/fast_a'])
+        self.assertEqual(index.match('unit/*'),
+                         ['unit/fast_a', 'unit/slow_a', 'unit/x'])
+        self.assertEqual(index.match('unit/.h*'), ['unit/.hidden'])
+
+
+    def test_match_recursive(self):
+        """
+        ** matches any number of directories.
+        """
+        index = self.matchTree()
+        self.assertEqual(index.match('unit/**/fast_*'), [
+            'unit/fast_a', 'unit/x/fast_b', 'unit/x/y/fast_c'])
+        self.assertEqual(index.match('**/fast_e'), ['func/fast_e'])
+        self.assertEqual(index.match('unit/x/**'), [
+            'unit/x', 'unit/x/y'])
+
+
+    def test_compilePattern(self):
+        """
+        Patterns are split into segments and cached.
+        """
+        c = compilePattern('unit/**/fast_*')
+        self.assertEqual(c[0], 'unit')
+        self.assertEqual(c[1], RECURSIVE)
+        regex, matchHidden = c[2]
+        self.assertTrue(regex.match('fast_foo'))
+        self.assertFalse(matchHidden)
+        self.assertTrue(compilePattern('unit/**/fast_*') is c)
+        self.assertEqual(_patterns.get('unit/**/fast_*'), c)
@@ -1,9 +1,13 @@
 from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
 from zope.interface.verify import verifyClass, verifyObject
 
+import sys
+
 
 from simplebb.interface import IEmitter
-from simplebb.report import Emitter
+from simplebb.report import Emitter, Subscription, eventKey, matches
+from simplebb.report import statusClass, DROP_OLDEST, COLLAPSE, DISCONNECT
 
 
 
@@ -85,5 +89,530 @@ class EmitterTest(TestCase):
         self.assertEqual(o.build, None,
             "Should not have passed the report on because it was already"
             "received: %r" % r)
+    
+    
+    def test_emit_repeatState(self):
+        """
+        Build dictionaries are repeats if they describe the same state of the
+        same build, even if other fields differ.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+        
+        e = Emitter()
+        o = FakeObserver()
+        e.addObserver(o)
+        
+        e.emit(dict(uid='a', status=None, runtime=None))
+        e.emit(dict(uid='a', status=None, runtime=2))
+        e.emit(dict(uid='a', status=0, runtime=2))
+        e.emit(dict(uid='b', status=0, runtime=2))
+        self.assertEqual([(x['uid'], x['status']) for x in o.builds],
+            [('a', None), ('a', 0), ('b', 0)])
+    
+    
+    def test_handledLimit(self):
+        """
+        Only the last handledLimit keys are remembered.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+        
+        e = Emitter()
+        e._handled.size = 2
+        o = FakeObserver()
+        e.addObserver(o)
+        
+        for uid in ['a', 'b', 'c', 'a']:
+            e.emit(dict(uid=uid, status=0))
+        self.assertEqual(len(e._handled), 2)
+        self.assertEqual([x['uid'] for x in o.builds], ['a', 'b', 'c', 'a'],
+            "'a' should have been forgotten")
+
+    
+    
+    def test_flushInterval(self):
+        """
+        With a flushInterval, builds are collected and delivered together
+        through buildsReceived.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.called = []
+            def buildReceived(self, buildDict):
+                self.called.append(('one', buildDict))
+            def buildsReceived(self, buildDicts):
+                self.called.append(('many', buildDicts))
+        
+        e = Emitter()
+        e.clock = task.Clock()
+        e.flushInterval = 2
+        o = FakeObserver()
+        e.addObserver(o)
+        
+        e.emit('a')
+        e.emit('b')
+        self.assertEqual(o.called, [])
+        
+        e.clock.advance(1)
+        e.emit('c')
+        self.assertEqual(o.called, [])
+        
+        e.clock.advance(1)
+        self.assertEqual(o.called, [('many', ['a', 'b', 'c'])])
+        
+        e.emit('d')
+        e.clock.advance(2)
+        self.assertEqual(o.called[1:], [('one', 'd')],
+            "A single build is sent through buildReceived")
+    
+    
+    def test_flushInterval_singleOnly(self):
+        """
+        Observers without buildsReceived get the builds one at a time.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+        
+        e = Emitter()
+        e.clock = task.Clock()
+        e.flushInterval = 0
+        o = FakeObserver()
+        e.addObserver(o)
+        
+        e.emit('a')
+        e.emit('b')
+        self.assertEqual(o.builds, [])
+        e.clock.advance(0)
+        self.assertEqual(o.builds, ['a', 'b'])
+    
+    
+    def test_flush(self):
+        """
+        flush delivers pending builds right away.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+        
+        e = Emitter()
+        e.clock = task.Clock()
+        e.flushInterval = 10
+        o = FakeObserver()
+        e.addObserver(o)
+        
+        e.emit('a')
+        e.flush()
+        self.assertEqual(o.builds, ['a'])
+        self.assertEqual(e.clock.getDelayedCalls(), [])
+        
+        e.flush()
+        self.assertEqual(o.builds, ['a'])
 
+    
+    
+    def test_addObserver_filter(self):
+        """
+        Observers registered with a project filter are indexed by project.
+        """
+        e = Emitter()
+        a = object()
+        b = object()
+        e.addObserver(a, dict(project='foo'))
+        e.addObserver(b)
+        self.assertEqual([x.observer for x in e._index['foo']], [a])
+        self.assertEqual([x.observer for x in e._unindexed], [b])
+        
+        e.addObserver(a, dict(project='bar'))
+        self.assertEqual(e._observers.count(a), 1)
+        self.assertFalse('foo' in e._index,
+            "Registering again should replace the filter")
+        self.assertEqual([x.observer for x in e._index['bar']], [a])
+        
+        e.remObserver(a)
+        self.assertEqual(e._index, {})
+        self.assertEqual(len(e._subscriptions), 1)
+    
+    
+    def test_emit_filter(self):
+        """
+        Observers only receive builds that pass their filter.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict['uid'])
+        
+        e = Emitter()
+        everything = FakeObserver()
+        foo = FakeObserver()
+        fooFinal = FakeObserver()
+        bar = FakeObserver()
+        e.addObserver(everything)
+        e.addObserver(foo, dict(project='foo'))
+        e.addObserver(fooFinal, dict(project='foo', final=True))
+        e.addObserver(bar, dict(project='bar'))
+        
+        e.emit(dict(uid='1', project='foo', status=None))
+        e.emit(dict(uid='1', project='foo', status=0))
+        e.emit(dict(uid='2', project='baz', status=0))
+        
+        self.assertEqual(everything.builds, ['1', '1', '2'])
+        self.assertEqual(foo.builds, ['1', '1'])
+        self.assertEqual(fooFinal.builds, ['1'])
+        self.assertEqual(bar.builds, [])
+    
+    
+    def test_emit_filterBatch(self):
+        """
+        Batched delivery only includes builds that pass the filter.
+        """
+        class FakeObserver:
+            def __init__(self):
+                self.called = []
+            def buildReceived(self, buildDict):
+                self.called.append(buildDict['uid'])
+            def buildsReceived(self, buildDicts):
+                self.called.append([x['uid'] for x in buildDicts])
+        
+        e = Emitter()
+        e.clock = task.Clock()
+        e.flushInterval = 0
+        foo = FakeObserver()
+        bar = FakeObserver()
+        e.addObserver(foo, dict(project='foo'))
+        e.addObserver(bar, dict(project='bar'))
+        
+        e.emit(dict(uid='1', project='foo', status=0))
+        e.emit(dict(uid='2', project='foo', status=0))
+        e.emit(dict(uid='3', project='baz', status=0))
+        e.clock.advance(0)
+        
+        self.assertEqual(foo.called, [['1', '2']])
+        self.assertEqual(bar.called, [])
 
+    
+    
+    def test_emit_backpressure(self):
+        """
+        Nothing more is sent to an observer while the Deferred it returned
+        is waiting.  Builds queue up and are sent when it fires.
+        """
+        class SlowObserver:
+            def __init__(self):
+                self.called = []
+                self.d = None
+            def buildReceived(self, buildDict):
+                self.called.append(buildDict)
+                self.d = defer.Deferred()
+                return self.d
+            def buildsReceived(self, buildDicts):
+                self.called.append(buildDicts)
+                self.d = defer.Deferred()
+                return self.d
+        
+        class FastObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+        
+        e = Emitter()
+        slow = SlowObserver()
+        fast = FastObserver()
+        e.addObserver(slow)
+        e.addObserver(fast)
+        
+        e.emit('a')
+        e.emit('b')
+        e.emit('c')
+        self.assertEqual(slow.called, ['a'])
+        self.assertEqual(fast.builds, ['a', 'b', 'c'],
+            "A slow observer should not hold up the others")
+        
+        slow.d.callback(None)
+        self.assertEqual(slow.called, ['a', ['b', 'c']])
+        
+        slow.d.callback(None)
+        e.emit('d')
+        self.assertEqual(slow.called, ['a', ['b', 'c'], 'd'])
+    
+    
+    def test_emit_fired(self):
+        """
+        Deferreds that have already fired don't hold up the observer, and a
+        long queue is sent without recursing once per build.
+        """
+        class Observer:
+            def __init__(self):
+                self.builds = []
+                self.depths = []
+                self.d = defer.Deferred()
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+                depth, f = 0, sys._getframe()
+                while f is not None:
+                    depth, f = depth + 1, f.f_back
+                self.depths.append(depth)
+                if len(self.builds) == 1:
+                    return self.d
+                return defer.succeed(None)
+        
+        e = Emitter()
+        e.queueLimit = 5000
+        o = Observer()
+        e.addObserver(o)
+        
+        for i in xrange(5000):
+            e.emit(i)
+        self.assertEqual(len(o.builds), 1)
+        o.d.callback(None)
+        self.assertEqual(o.builds, range(5000))
+        self.assertEqual(min(o.depths[1:]), max(o.depths[1:]),
+            "The stack should not grow with each build")
+        self.assertFalse(e._subscriptions[0].busy)
+        
+        e.emit('a')
+        self.assertEqual(o.builds[-1], 'a')
+    
+    
+    def test_emit_dropOldest(self):
+        """
+        When an observer's queue is full the oldest build is dropped and
+        counted.
+        """
+        class StalledObserver:
+            def __init__(self):
+                self.builds = []
+            def buildReceived(self, buildDict):
+                self.builds.append(buildDict)
+                return defer.Deferred()
+        
+        e = Emitter()
+        e.queueLimit = 2
+        o = StalledObserver()
+        e.addObserver(o)
+        
+        for x in 'abcde':
+            e.emit(x)
+        self.assertEqual(o.builds, ['a'])
+        self.assertEqual(list(e._subscriptions[0].pending), ['d', 'e'])
+        self.assertEqual(e.getDropped(o), 2)
+    
+    
+    def test_emit_disconnect(self):
+        """
+        An observer using the DISCONNECT policy is removed (and told to
+        disconnect) when its queue overflows.
+        """
+        class StalledObserver:
+            def __init__(self):
+                self.disconnected = False
+            def buildReceived(self, buildDict):
+                return defer.Deferred()
+            def disconnectMe(self):
+                self.disconnected = True
+        
+        e = Emitter()
+        e.queueLimit = 2
+        e.overflowPolicy = DISCONNECT
+        o = StalledObserver()
+        e.addObserver(o)
+        
+        for x in 'abc':
+            e.emit(x)
+        self.assertFalse(o.disconnected)
+        
+        e.emit('d')
+        self.assertTrue(o.disconnected)
+        self.assertFalse(o in e._observers)
+
+
+
+class SubscriptionTest(TestCase):
+
+
+    def test_push(self):
+        s = Subscription('observer', limit=2)
+        self.assertTrue(s.push('a'))
+        self.assertTrue(s.push('b'))
+        self.assertTrue(s.push('c'))
+        self.assertEqual(list(s.pending), ['b', 'c'])
+        self.assertEqual(s.dropped, 1)
+
+
+    def test_push_collapse(self):
+        """
+        When full, a new state replaces the latest queued state of the same
+        build.
+        """
+        s = Subscription('observer', limit=3, policy=COLLAPSE)
+        s.push(dict(uid='a', status=None))
+        s.push(dict(uid='b', status=None))
+        s.push(dict(uid='a', status=0))
+        s.push(dict(uid='b', status=1))
+        s.push(dict(uid='a', status=1))
+        self.assertEqual(list(s.pending), [
+            dict(uid='a', status=None),
+            dict(uid='b', status=1),
+            dict(uid='a', status=1),
+        ])
+        self.assertEqual(s.dropped, 2)
+        
+        self.assertEqual(s.pop(), dict(uid='a', status=None))
+        s.push(dict(uid='c'))
+        s.push(dict(uid='a', status=2))
+        self.assertEqual(s.popAll(), [
+            dict(uid='b', status=1),
+            dict(uid='a', status=2),
+            dict(uid='c'),
+        ])
+        self.assertEqual(s.queued(), 0)
+
+
+    def test_push_collapseFull(self):
+        """
+        If collapsing doesn't make room, the oldest is dropped.
+        """
+        s = Subscription('observer', limit=2, policy=COLLAPSE)
+        s.push(dict(uid='a'))
+        s.push(dict(uid='b'))
+        s.push(dict(uid='c'))
+        self.assertEqual(list(s.pending), [dict(uid='b'), dict(uid='c')])
+        self.assertEqual(s.dropped, 1)
+
+
+    def test_push_disconnect(self):
+        s = Subscription('observer', limit=1, policy=DISCONNECT)
+        self.assertTrue(s.push('a'))
+        self.assertFalse(s.push('b'))
+        self.assertEqual(s.dropped, 1)
+
+
+    def test_default(self):
+        s = Subscription('observer')
+        self.assertEqual(s.policy, DROP_OLDEST)
+        self.assertEqual(s.dropped, 0)
+
+
+
+class matchesTest(TestCase):
+
+
+    def test_empty(self):
+        """
+        No filter matches everything.
+        """
+        self.assertTrue(matches(None, 'anything'))
+        self.assertTrue(matches({}, dict(project='foo')))
+
+
+    def test_notDict(self):
+        """
+        A filter never matches something that isn't a build dictionary.
+        """
+        self.assertFalse(matches(dict(project='foo'), 'foo'))
+
+
+    def test_project(self):
+        self.assertTrue(matches(dict(project='foo'), dict(project='foo')))
+        self.assertFalse(matches(dict(project='foo'), dict(project='bar')))
+
+
+    def test_test_path(self):
+        """
+        test_path filters match on prefix.
+        """
+        f = dict(test_path='unit/')
+        self.assertTrue(matches(f, dict(test_path='unit/foo')))
+        self.assertFalse(matches(f, dict(test_path='func/foo')))
+        self.assertFalse(matches(f, dict(test_path=None)))
+
+
+    def test_status(self):
+        f = dict(status='failure')
+        self.assertTrue(matches(f, dict(status=1)))
+        self.assertFalse(matches(f, dict(status=0)))
+        self.assertFalse(matches(f, dict(status=None)))
+        self.assertTrue(matches(f, dict(status=None, state='done')),
+            "Builds that are done without a status have failed")
+        self.assertFalse(matches(dict(status='pending'),
+                                 dict(status=None, state='done')))
+
+
+    def test_final(self):
+        f = dict(final=True)
+        self.assertTrue(matches(f, dict(status=0)))
+        self.assertFalse(matches(f, dict(status=None)))
+        self.assertTrue(matches(f, dict(status=None, state='done')),
+            "Killed by a signal")
+        self.assertFalse(matches(f, dict(status=None, state='running')))
+
+
+    def test_logs(self):
+        """
+        Log chunks can be filtered out.
+        """
+        chunk = dict(event='log', status=None)
+        self.assertTrue(matches(dict(status='pending'), chunk))
+        self.assertFalse(matches(dict(logs=False), chunk))
+        self.assertTrue(matches(dict(logs=False), dict(status=None)))
+
+
+    def test_statusClass(self):
+        self.assertEqual(statusClass(None), 'pending')
+        self.assertEqual(statusClass(0), 'success')
+        self.assertEqual(statusClass(12), 'failure')
+        self.assertEqual(statusClass(None, done=True), 'failure')
+
+
+
+class eventKeyTest(TestCase):
+
+
+    def test_buildDict(self):
+        """
+        Build dictionaries are keyed by uid and status.
+        """
+        self.assertEqual(eventKey(dict(uid='foo', status=2, project='bar')),
+                         ('foo', 2, None, None))
+
+
+    def test_logChunk(self):
+        """
+        Log chunks of a build are keyed by their sequence number too.
+        """
+        a = eventKey(dict(uid='foo', status=None, event='log', seq=1))
+        b = eventKey(dict(uid='foo', status=None, event='log', seq=2))
+        self.assertNotEqual(a, b)
+        self.assertNotEqual(a, eventKey(dict(uid='foo', status=None)))
+
+
+
+    def test_state(self):
+        """
+        Each state of a build gets its own key.
+        """
+        self.assertNotEqual(eventKey(dict(uid='foo', state='queued')),
+                            eventKey(dict(uid='foo', state='running')))
+
+
+    def test_other(self):
+        """
+        Other things are keyed by their text.
+        """
+        self.assertEqual(eventKey(dict(project='foo')),
+                         eventKey(dict(project='foo')))
+        self.assertNotEqual(eventKey('foo'), eventKey('bar'))
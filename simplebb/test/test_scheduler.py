@@ -0,0 +1,263 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+
+from simplebb.scheduler import Scheduler, cpuCount
+from simplebb.build import Build, ERROR
+
+
+
+class cpuCountTest(TestCase):
+
+
+    def test_positive(self):
+        self.assertTrue(cpuCount() >= 1)
+
+
+
+class SchedulerTest(TestCase):
+
+
+    def setUp(self):
+        self.started = []
+
+
+    def runner(self, build):
+        self.started.append(build)
+        return build.done
+
+
+    def build(self, project='foo'):
+        b = Build()
+        b.project = project
+        return b
+
+
+    def test_init(self):
+        """
+        Defaults to one slot per CPU and no project limits.
+        """
+        s = Scheduler(self.runner)
+        self.assertEqual(s.slots, cpuCount())
+        self.assertEqual(s.projectLimits, {})
+
+
+    def test_submit(self):
+        """
+        Builds start right away while there are free slots.
+        """
+        s = Scheduler(self.runner, slots=2)
+        a, b, c = self.build(), self.build(), self.build()
+        for x in (a, b, c):
+            s.submit(x)
+        self.assertEqual(self.started, [a, b])
+        self.assertEqual(s.running, 2)
+        self.assertEqual(s.queued(), 1)
+        self.assertEqual([x.state for x in (a, b, c)],
+                         ['running', 'running', 'queued'])
+
+
+    def test_fifo(self):
+        """
+        Waiting builds start in the order they were submitted as slots free
+        up.
+        """
+        s = Scheduler(self.runner, slots=1)
+        a, b, c = self.build(), self.build(), self.build()
+        for x in (a, b, c):
+            s.submit(x)
+        a._finish(0)
+        self.assertEqual(self.started, [a, b])
+        b._finish(0)
+        self.assertEqual(self.started, [a, b, c])
+        c._finish(0)
+        self.assertEqual(s.running, 0)
+
+
+    def test_projectLimits(self):
+        """
+        A project at its limit doesn't hold up other projects.
+        """
+        s = Scheduler(self.runner, slots=3, projectLimits={'foo': 1})
+        a, b, c = self.build('foo'), self.build('foo'), self.build('bar')
+        for x in (a, b, c):
+            s.submit(x)
+        self.assertEqual(self.started, [a, c])
+        a._finish(0)
+        self.assertEqual(self.started, [a, c, b])
+
+
+    def test_syncFinish(self):
+        """
+        Builds that finish as soon as they are run don't use up the stack.
+        """
+        def runner(build):
+            build._finish(0)
+            return build.done
+        s = Scheduler(runner, slots=1)
+        builds = [self.build() for i in xrange(5000)]
+        for b in builds:
+            s.submit(b)
+        self.assertEqual(s.running, 0)
+        self.assertEqual(s.queued(), 0)
+
+
+    def test_runnerError(self):
+        """
+        If the runner raises, the build is finished with ERROR and its slot
+        is freed for the next one.
+        """
+        def runner(build):
+            self.started.append(build)
+            if len(self.started) == 1:
+                raise ValueError('bad header')
+            return build.done
+        s = Scheduler(runner, slots=1)
+        a, b = self.build(), self.build()
+        s.submit(a)
+        s.submit(b)
+        self.assertEqual(a.state, 'done')
+        self.assertEqual(a.status, ERROR)
+        self.assertEqual(self.started, [a, b])
+        self.assertEqual(s.running, 1)
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+    def test_priority(self):
+        """
+        Builds with a higher priority start first.
+        """
+        s = Scheduler(self.runner, slots=1)
+        running, low, high = self.build(), self.build(), self.build()
+        s.submit(running)
+        s.submit(low, priority=-1)
+        s.submit(high, priority=5)
+        running._finish(0)
+        self.assertEqual(self.started, [running, high])
+
+
+    def test_fair(self):
+        """
+        A request submitted behind a big one gets its turn after only a few
+        of the big one's builds.
+        """
+        s = Scheduler(self.runner, slots=1)
+        nightly = [self.build('big') for i in xrange(100)]
+        for b in nightly:
+            s.submit(b, submitter='cron')
+        small = [self.build('small') for i in xrange(2)]
+        for b in small:
+            s.submit(b, submitter='alice')
+        for i in xrange(5):
+            self.started[-1]._finish(0)
+        self.assertEqual(self.started, [nightly[0], nightly[1], small[0],
+                                        nightly[2], small[1], nightly[3]])
+
+
+    def test_fairSubmitters(self):
+        """
+        Submitters of the same project share it fairly.
+        """
+        s = Scheduler(self.runner, slots=1)
+        first = self.build()
+        s.submit(first, submitter='bob')
+        bob = [self.build() for i in xrange(3)]
+        alice = [self.build() for i in xrange(3)]
+        for b in bob:
+            s.submit(b, submitter='bob')
+        for b in alice:
+            s.submit(b, submitter='alice')
+        for i in xrange(4):
+            self.started[-1]._finish(0)
+        self.assertEqual(self.started, [first, bob[0], alice[0], bob[1],
+                                        alice[1]])
+
+
+    def test_weights(self):
+        """
+        Projects with a bigger weight get more of the slots.
+        """
+        s = Scheduler(self.runner, slots=1)
+        s.weights['heavy'] = 2
+        first = self.build('light')
+        s.submit(first)
+        heavy = [self.build('heavy') for i in xrange(4)]
+        light = [self.build('light') for i in xrange(2)]
+        for b in heavy + light:
+            s.submit(b)
+        for i in xrange(4):
+            self.started[-1]._finish(0)
+        started = [x.project for x in self.started[1:]]
+        self.assertEqual(started.count('heavy'), 3)
+        self.assertEqual(started.count('light'), 1)
+
+
+    def test_position(self):
+        """
+        The position of a request is how many builds will start before its
+        next one.
+        """
+        s = Scheduler(self.runner, slots=1)
+        s.submit(self.build(), request='a')
+        s.submit(self.build(), request='a')
+        s.submit(self.build(), request='a')
+        s.submit(self.build('other'), request='b')
+        self.assertEqual(s.position('a'), 0)
+        self.assertEqual(s.position('b'), 1)
+        self.assertEqual(s.position('c'), None)
+        self.started[-1]._finish(0)
+        self.assertEqual(s.position('b'), 0)
+
+
+    def test_remove(self):
+        """
+        Waiting builds can be taken out of the queue.
+        """
+        s = Scheduler(self.runner, slots=1)
+        a, b, c = self.build(), self.build(), self.build()
+        for x in (a, b, c):
+            s.submit(x)
+        self.assertEqual(s.remove(b), True)
+        self.assertEqual(s.remove(b), False)
+        self.assertEqual(s.remove(a), False, "a is running")
+        self.assertEqual(s.queued(), 1)
+        a._finish(0)
+        self.assertEqual(self.started, [a, c])
+
+
+    def test_removeMany(self):
+        """
+        Removed builds are skipped when they come up, and don't pile up in
+        the queue.
+        """
+        s = Scheduler(self.runner, slots=1)
+        builds = [self.build() for i in xrange(10)]
+        for x in builds:
+            s.submit(x)
+        for x in builds[1:8]:
+            s.remove(x)
+        self.assertEqual(s.queued(), 2)
+        self.assertTrue(len(s._queue) <= 2 * s.queued())
+        builds[0]._finish(0)
+        builds[8]._finish(0)
+        self.assertEqual(self.started, [builds[0], builds[8], builds[9]])
+        self.assertEqual(s._removed, set())
+
+
+    def test_admit(self):
+        """
+        Builds wait while admit says no, and it is asked again after a
+        while.
+        """
+        s = Scheduler(self.runner, slots=2)
+        s.clock = task.Clock()
+        room = [False]
+        s.admit = lambda: room[0]
+        a = self.build()
+        s.submit(a)
+        self.assertEqual(self.started, [])
+        self.assertEqual(a.state, 'queued')
+
+        room[0] = True
+        s.clock.advance(s.recheckInterval)
+        self.assertEqual(self.started, [a])
+        self.assertEqual(s.clock.getDelayedCalls(), [])
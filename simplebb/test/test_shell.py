@@ -307,8 +307,11 @@ class FakeHub:
         return self.returns.get('stopServer', None)
     
     
-    def connect(self, description):
-        self.called.append(('connect', description))
+    def connect(self, description, persistent=False):
+        if persistent:
+            self.called.append(('connect', description, persistent))
+        else:
+            self.called.append(('connect', description))
         return self.returns.get('connect', None)
 
 
@@ -316,6 +319,11 @@ class FakeHub:
         self.called.append(('disconnect', description))
         return self.returns.get('disconnect', None)
 
+
+    def queuePosition(self, uid):
+        self.called.append(('queuePosition', uid))
+        return self.returns.get('queuePosition', None)
+
         
 
 
@@ -343,6 +351,26 @@ class CommandsTest(TestCase):
         ])
 
 
+    def test_position(self):
+        """
+        position should go through to hub.queuePosition
+        """
+        shell = ShellProtocol()
+        shell.hub = FakeHub(queuePosition=defer.succeed(3))
+        sendLine = []
+        shell.sendLine = sendLine.append
+        
+        shell.cmd_position('something')
+        
+        self.assertEqual(shell.hub.called, [('queuePosition', 'something')])
+        self.assertEqual(len(sendLine), 1)
+        self.assertTrue('3' in sendLine[0])
+        
+        shell.hub = FakeHub(queuePosition=defer.succeed(None))
+        shell.cmd_position('something')
+        self.assertEqual(sendLine[-1], 'No builds of something are waiting')
+
+
     def test_start(self):
         """
         start should go through to startServer
@@ -407,6 +435,20 @@ class CommandsTest(TestCase):
                             "should be notified.")
 
 
+    def test_connect_persistent(self):
+        """
+        connect can ask for a persistent connection
+        """
+        shell = ShellProtocol()
+        shell.hub = FakeHub(connect=defer.Deferred())
+        shell.sendLine = lambda x: None
+        
+        shell.cmd_connect('my endpoint', 'persistent')
+        
+        self.assertEqual(shell.hub.called,
+                         [('connect', 'my endpoint', True)])
+
+
     def test_disconnect(self):
         """
         should go through to hub.disconnect
@@ -1,6 +1,10 @@
 from twisted.trial.unittest import TestCase
 
-from simplebb.util import generateId
+import time
+import threading
+
+from simplebb import util
+from simplebb.util import generateId, idTime, LRUSet, LRUCache, RotatingSet, monotonic
 
 
 
@@ -50,3 +54,226 @@ class generateIdTest(TestCase):
         self.assertNotEqual(a, b)
 
 
+    def test_format(self):
+        """
+        Ids are 32 hex digits.
+        """
+        a = generateId()
+        self.assertEqual(len(a), 32)
+        int(a, 16)
+
+
+    def test_sorted(self):
+        """
+        Ids sort in the order they were generated, even many to a
+        millisecond.
+        """
+        ids = [generateId() for i in xrange(10000)]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(len(set(ids)), len(ids))
+
+
+    def test_threads(self):
+        """
+        Ids generated in several threads at once are unique, and each
+        thread's sort in the order it generated them.
+        """
+        results = [[] for i in xrange(4)]
+        def generate(ids):
+            for i in xrange(10000):
+                ids.append(generateId())
+        threads = [threading.Thread(target=generate, args=(ids,))
+                   for ids in results]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        allIds = set()
+        for ids in results:
+            self.assertEqual(sorted(ids), ids)
+            allIds.update(ids)
+        self.assertEqual(len(allIds), 40000)
+
+
+    def test_clockBack(self):
+        """
+        Ids still sort in order if the clock goes backwards.
+        """
+        a = generateId()
+        now = time.time()
+        self.patch(time, 'time', lambda: now - 60)
+        b = generateId()
+        self.assertTrue(b > a)
+
+
+    def test_idTime(self):
+        """
+        The time an id was generated can be read back from it.
+        """
+        before = time.time()
+        t = idTime(generateId())
+        self.assertTrue(before - 0.01 <= t <= time.time() + 0.01)
+
+
+
+class monotonicTest(TestCase):
+
+
+    def test_forward(self):
+        """
+        Should never go backwards
+        """
+        a = monotonic()
+        b = monotonic()
+        self.assertTrue(b >= a)
+
+
+    def test_resolution(self):
+        """
+        Should count in steps much finer than os.times' 10ms.
+        """
+        a = monotonic()
+        b = monotonic()
+        while b == a:
+            b = monotonic()
+        self.assertTrue(b - a < 0.001, b - a)
+
+    if not hasattr(time, 'monotonic') and util._clock is None:
+        test_resolution.skip = "No clock_gettime here"
+
+
+
+class LRUSetTest(TestCase):
+
+
+    def test_add(self):
+        """
+        Added items are members.
+        """
+        s = LRUSet(10)
+        s.add('foo')
+        self.assertTrue('foo' in s)
+        self.assertFalse('bar' in s)
+        self.assertEqual(len(s), 1)
+
+
+    def test_size(self):
+        """
+        The oldest item is forgotten when the set is full.
+        """
+        s = LRUSet(2)
+        s.add('a')
+        s.add('b')
+        s.add('c')
+        self.assertEqual(len(s), 2)
+        self.assertFalse('a' in s)
+        self.assertTrue('b' in s)
+        self.assertTrue('c' in s)
+
+
+    def test_readd(self):
+        """
+        Adding an item again makes it the most recent.
+        """
+        s = LRUSet(2)
+        s.add('a')
+        s.add('b')
+        s.add('a')
+        s.add('c')
+        self.assertTrue('a' in s)
+        self.assertFalse('b' in s)
+
+
+
+class LRUCacheTest(TestCase):
+
+
+    def test_get(self):
+        c = LRUCache(10)
+        c['foo'] = 'bar'
+        self.assertEqual(c.get('foo'), 'bar')
+        self.assertEqual(c.get('baz'), None)
+        self.assertEqual(c.get('baz', 1), 1)
+        self.assertTrue('foo' in c)
+
+
+    def test_size(self):
+        """
+        The least recently used item is forgotten when full.
+        """
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        c.get('a')
+        c['c'] = 3
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('c'), 3)
+
+
+    def test_threads(self):
+        """
+        Several threads can use the same cache at once.
+        """
+        c = LRUCache(4)
+        errors = []
+        def use():
+            try:
+                for i in xrange(20000):
+                    key = i % 7
+                    if c.get(key) is None:
+                        c[key] = i
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=use) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(c), 4)
+
+
+
+class RotatingSetTest(TestCase):
+
+
+    def setUp(self):
+        self.now = 0
+        self.clock = lambda: self.now
+
+
+    def test_window(self):
+        """
+        Items are remembered for at least one window and forgotten after
+        two.
+        """
+        s = RotatingSet(10, 100, self.clock)
+        s.add('a')
+        self.now = 9
+        s.add('b')
+        self.assertTrue('a' in s)
+        self.now = 15
+        s.add('c')
+        self.assertTrue('a' in s)
+        self.assertTrue('b' in s)
+        self.now = 25
+        s.add('d')
+        self.assertFalse('a' in s)
+        self.assertFalse('b' in s)
+        self.assertTrue('c' in s)
+        self.assertEqual(len(s), 2)
+
+
+    def test_size(self):
+        """
+        No more than twice size items are held, however quickly they come.
+        """
+        s = RotatingSet(10, 100, self.clock)
+        for i in xrange(1000):
+            s.add(i)
+            self.assertTrue(len(s) <= 200)
+        self.assertTrue(999 in s)
+        self.assertTrue(900 in s)
+        self.assertFalse(0 in s)
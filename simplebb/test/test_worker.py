@@ -0,0 +1,243 @@
+from twisted.trial.unittest import TestCase
+from twisted.python.filepath import FilePath
+from twisted.internet import defer
+
+import os
+
+from simplebb.worker import WorkerPool, exitCode
+from simplebb.build import FileBuild, TIMEOUT, ERROR
+
+
+
+class exitCodeTest(TestCase):
+
+
+    def test_exited(self):
+        self.assertEqual(exitCode(3 << 8), 3)
+        self.assertEqual(exitCode(0), 0)
+
+
+    def test_signaled(self):
+        self.assertEqual(exitCode(9), None)
+
+
+
+class WorkerPoolTest(TestCase):
+
+
+    timeout = 10
+
+
+    def pool(self, *args, **kwargs):
+        pool = WorkerPool(*args, **kwargs)
+        self.addCleanup(pool.stop)
+        return pool
+
+
+    def build(self, pool, content):
+        f = FilePath(self.mktemp())
+        f.setContent('# simplebb-runner: python\n' + content)
+        b = FileBuild(f)
+        b.version = 'version'
+        b.workers = pool
+        return b
+
+
+    def test_workerDied(self):
+        """
+        A build whose worker dies finishes with ERROR, and a new worker
+        takes its place.
+        """
+        pool = self.pool(1)
+        b = self.build(pool, 'import os, signal\n'
+                             'os.kill(os.getppid(), signal.SIGKILL)\n')
+        b.run()
+        
+        def check(build):
+            self.assertEqual(build.status, ERROR)
+            again = self.build(pool, 'print "ok"\n')
+            again.run()
+            return again.done
+        b.done.addCallback(check)
+        b.done.addCallback(lambda build: self.assertEqual(build.status, 0))
+        return b.done
+
+
+    def test_defaults(self):
+        pool = WorkerPool()
+        self.assertEqual(pool.maxRuns, 100)
+        self.assertEqual(pool.maxRSS, None)
+        self.assertEqual(pool.workers(), [])
+
+
+    def test_run(self):
+        """
+        Scripts run in a worker with their version as an argument, and their
+        output, exit status and resource usage are given to the build.
+        """
+        pool = self.pool(1, modules=['xml.dom.minidom'])
+        b = self.build(pool, 'import sys\n'
+            'print sys.argv[1:], "xml.dom.minidom" in sys.modules\n'
+            'sys.stderr.write("err")\n'
+            'sys.exit(3)\n')
+
+        def check(build):
+            self.assertEqual(build.status, 3)
+            self.assertEqual(dict(build.log), {
+                'stdout': "['version'] True\n",
+                'stderr': 'err',
+            })
+            self.assertNotEqual(build.max_rss, None)
+            self.assertNotEqual(build.cpu_user, None)
+            self.assertEqual(len(pool.workers()), 1)
+        b.done.addCallback(check)
+        b.run()
+        return b.done
+
+
+    def test_exitStatus(self):
+        """
+        Scripts exit the way they would have run on their own.
+        """
+        pool = self.pool(2)
+        scripts = [
+            ('pass\n', 0),
+            ('import sys\nsys.exit()\n', 0),
+            ('import sys\nsys.exit("bad")\n', 1),
+            ('raise ValueError("bad")\n', 1),
+            ('import os\nos.kill(os.getpid(), 9)\n', None),
+        ]
+        builds = [self.build(pool, x[0]) for x in scripts]
+        for b in builds:
+            b.run()
+
+        def check(ign):
+            self.assertEqual([x.status for x in builds],
+                             [x[1] for x in scripts])
+            self.assertEqual(builds[2].getLog(), 'bad\n')
+            self.assertTrue('ValueError: bad' in builds[3].getLog())
+        return defer.gatherResults([x.done for x in builds]).addCallback(check)
+
+
+    def test_recycle(self):
+        """
+        Workers are replaced after maxRuns scripts.
+        """
+        pool = self.pool(1, maxRuns=2)
+        pool.start()
+        first = pool.workers()
+        pids = []
+
+        def runNext(ign, remaining):
+            # pids of the workers that aren't being retired
+            pids.extend(pool.workers() or [None])
+            if not remaining:
+                return
+            b = self.build(pool, 'pass\n')
+            b.done.addCallback(runNext, remaining - 1)
+            b.run()
+            return b.done
+
+        def check(ign):
+            self.assertEqual(pids[:3], first * 2 + [None])
+            self.assertEqual(len(pids), 4)
+            self.assertNotEqual(pids[3], first[0])
+        return runNext(None, 3).addCallback(check)
+
+
+    def test_recycleRSS(self):
+        """
+        Workers are replaced once they grow past maxRSS.
+        """
+        pool = self.pool(1, maxRSS=1)
+        b = self.build(pool, 'pass\n')
+
+        def check(build):
+            self.assertEqual(build.status, 0)
+            self.assertEqual(pool.workers(), [])
+        b.done.addCallback(check)
+        b.run()
+        return b.done
+
+
+    def test_timeout(self):
+        """
+        Scripts run by workers are killed after their timeout like other
+        builds, and the worker lives on.
+        """
+        pool = self.pool(1)
+        b = self.build(pool, 'import time\ntime.sleep(30)\n')
+        b.timeout = 0.2
+
+        def check(build):
+            self.assertEqual(build.status, TIMEOUT)
+            after = self.build(pool, 'pass\n')
+            after.run()
+            return after.done
+        b.done.addCallback(check)
+        b.done.addCallback(lambda build: self.assertEqual(build.status, 0))
+        b.run()
+        return b.done
+
+
+    def test_timeoutQueued(self):
+        """
+        A script still waiting for a worker when its timeout passes is never
+        run.
+        """
+        pool = self.pool(1)
+        busy = self.build(pool, 'import time\ntime.sleep(30)\n')
+        busy.timeout = 1
+        waiting = self.build(pool, 'print "ran"\n')
+        waiting.timeout = 0.1
+        busy.run()
+        waiting.run()
+
+        def check(build):
+            self.assertEqual(build.status, TIMEOUT)
+            self.assertEqual(build.getLog(), '')
+            self.assertEqual(busy.status, None, "Still running")
+            return busy.done
+        waiting.done.addCallback(check)
+        waiting.done.addCallback(
+            lambda build: self.assertEqual(build.status, TIMEOUT))
+        return waiting.done
+
+
+    def test_timeoutStarting(self):
+        """
+        A script killed before its worker has said it started is killed
+        once it does.
+        """
+        pool = self.pool(1)
+        pool.start()
+        b = self.build(pool, 'import time\ntime.sleep(30)\n')
+        b.run()
+        self.assertEqual(b._process.pid, None)
+        self.assertTrue(b._process.starting)
+        b.kill(TIMEOUT)
+
+        def check(build):
+            self.assertEqual(build.status, TIMEOUT)
+            self.assertEqual(len(pool.workers()), 1)
+        return b.done.addCallback(check)
+
+
+    def test_untagged(self):
+        """
+        Files that aren't tagged as Python are run the usual way.
+        """
+        pool = self.pool(1)
+        f = FilePath(self.mktemp())
+        f.setContent('#!/bin/bash\nexit 4')
+        f.chmod(0755)
+        b = FileBuild(f)
+        b.version = 'version'
+        b.workers = pool
+
+        def check(build):
+            self.assertEqual(build.status, 4)
+            self.assertEqual(pool.workers(), [])
+        b.done.addCallback(check)
+        b.run()
+        return b.done
@@ -2,21 +2,229 @@
 Utility functions
 """
 
+import os
 import random
-import hashlib
+import sys
+import threading
 import time
-import datetime
+from collections import OrderedDict
 
 
-_idcount = 0
+_random = random.Random()
+_lastMillis = 0
+_counter = 0
+_idLock = threading.Lock()
 
 def generateId():
     """
-    Returns a uniqueish id.
+    Returns a unique id that sorts after the ids generated before it.
+    
+    It is 32 hex digits: the time in milliseconds (48 bits), a count of
+    the ids already generated in that millisecond (16 bits) and 64 random
+    bits.  It is safe to call from more than one thread.
     """
-    global _idcount
-    _idcount += 1
-    random_part = hashlib.sha256(str(random.getrandbits(256))).hexdigest()
-    time_part = datetime.datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-    num_part = str(_idcount)
-    return hashlib.sha256(num_part + time_part + random_part).hexdigest()
\ No newline at end of file
+    global _lastMillis, _counter
+    with _idLock:
+        millis = int(time.time() * 1000)
+        if millis <= _lastMillis:
+            # the same millisecond, or the clock went back
+            millis = _lastMillis
+            _counter += 1
+            if _counter > 0xffff:
+                millis += 1
+                _counter = 0
+        else:
+            _counter = 0
+        _lastMillis = millis
+        counter = _counter
+    return '%012x%04x%016x' % (millis, counter, _random.getrandbits(64))
+
+
+
+def idTime(uid):
+    """
+    Returns the time (in seconds since the epoch) at which the id C{uid}
+    was generated.
+    """
+    return int(uid[:12], 16) / 1000.0
+
+
+
+# CLOCK_MONOTONIC, which isn't the same everywhere
+_CLOCK_IDS = {'linux': 1, 'darwin': 6, 'freebsd': 4}
+
+def _clockGettime():
+    """
+    Returns a function reading CLOCK_MONOTONIC with clock_gettime, or
+    C{None} if it isn't available.
+    """
+    clockId = None
+    for prefix, value in _CLOCK_IDS.items():
+        if sys.platform.startswith(prefix):
+            clockId = value
+    if clockId is None:
+        return None
+    try:
+        import ctypes
+    except ImportError:
+        return None
+    
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    
+    # older glibc keeps it in librt
+    for name in (None, 'librt.so.1'):
+        try:
+            clock_gettime = ctypes.CDLL(name).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        def read():
+            ts = timespec()
+            if clock_gettime(clockId, ctypes.byref(ts)) != 0:
+                raise OSError('clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        try:
+            read()
+        except OSError:
+            return None
+        return read
+    return None
+
+_clock = None
+if not hasattr(time, 'monotonic'):
+    _clock = _clockGettime()
+
+
+def monotonic():
+    """
+    Returns the number of seconds on a clock that never goes backwards.
+
+    On Python 2 this is C{clock_gettime(CLOCK_MONOTONIC)} where it can be
+    found, since C{os.times} only counts in 10ms steps.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic()
+    if _clock is not None:
+        return _clock()
+    return os.times()[4]
+
+
+
+class LRUSet:
+    """
+    I am a set that remembers at most C{size} items.  When full, the least
+    recently added (or re-added) item is forgotten first.
+    """
+
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+
+
+    def __contains__(self, item):
+        return item in self._items
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def add(self, item):
+        """
+        Remember C{item}, making it the most recently used item.
+        """
+        if item in self._items:
+            del self._items[item]
+        self._items[item] = True
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+
+
+class RotatingSet:
+    """
+    I am a set that remembers each item until C{window} seconds have
+    passed or C{size} more items have been added, whichever is first, and
+    holds at most C{2 * size} items.
+
+    Items are added to a current generation.  Once it is C{window} seconds
+    old, or holds C{size} items, it becomes the previous generation and the
+    generation before that is forgotten all at once.
+    """
+
+
+    def __init__(self, window, size, clock=monotonic):
+        self.window = window
+        self.size = size
+        self.clock = clock
+        self._current = set()
+        self._previous = set()
+        self._started = clock()
+
+
+    def __contains__(self, item):
+        return item in self._current or item in self._previous
+
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+
+    def add(self, item):
+        """
+        Remember C{item}.
+        """
+        if (len(self._current) >= self.size or
+            self.clock() - self._started >= self.window):
+            self._previous = self._current
+            self._current = set()
+            self._started = self.clock()
+        self._current.add(item)
+
+
+
+class LRUCache:
+    """
+    I am a dictionary that holds at most C{size} items.  When full, the
+    least recently used item is forgotten first.
+    
+    I may be used from several threads at once.
+    """
+
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def get(self, key, default=None):
+        """
+        Return the value for C{key} (making it the most recently used), or
+        C{default}.
+        """
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
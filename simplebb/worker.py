@@ -0,0 +1,265 @@
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+
+from collections import deque
+import json
+import os
+import sys
+
+from simplebb.build import RUNNER, ERROR
+from simplebb.scheduler import cpuCount
+
+
+
+class Job:
+    """
+    I am a Python script run by a worker on behalf of a L{FileBuild}.
+
+    C{pid} is the pid of the process running the script while it runs.
+    C{starting} is True once it has been sent to a worker until the worker
+    says it has started it.
+    """
+
+    pid = None
+    starting = False
+
+    def __init__(self, build, path, args, env):
+        self.build = build
+        self.path = path
+        self.args = args
+        self.env = env
+
+
+    def toJSON(self):
+        return json.dumps(dict(path=self.path, args=self.args, env=self.env))
+
+
+
+def exitCode(status):
+    """
+    Return the exit code for the wait C{status} the way
+    L{twisted.internet.error.ProcessTerminated} has it: C{None} if the
+    process was killed by a signal.
+    """
+    if os.WIFSIGNALED(status):
+        return None
+    return os.WEXITSTATUS(status)
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    I talk to a worker process (L{RUNNER} run with C{--worker}), giving it
+    one L{Job} at a time and passing what it reports on to the job's build.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None
+        self.runs = 0
+        self.rss = 0
+        self._buffer = ''
+
+
+    def send(self, job):
+        """
+        Have my worker run C{job}.
+        """
+        self.job = job
+        job.starting = True
+        self.transport.write(job.toJSON() + '\n')
+
+
+    def childDataReceived(self, childFD, data):
+        if childFD != 1:
+            log.msg('worker %s: %s' % (self.transport.pid, data.rstrip()))
+            return
+        self._buffer += data
+        while True:
+            i = self._buffer.find('\n')
+            if i == -1:
+                return
+            kind, size = self._buffer[:i].split()
+            end = i + 1 + int(size)
+            if len(self._buffer) < end:
+                return
+            payload = self._buffer[i+1:end]
+            self._buffer = self._buffer[end:]
+            self.frameReceived(kind, payload)
+
+
+    def frameReceived(self, kind, data):
+        job = self.job
+        if kind == 'start':
+            job.pid = int(data)
+            job.starting = False
+            if job.build._killStatus is not None:
+                # killed while it was starting
+                job.build._killPid(job.pid)
+        elif kind == 'exit':
+            status, utime, stime, maxrss, rss = data.split()
+            job.pid = None
+            job.starting = False
+            self.job = None
+            self.runs += 1
+            self.rss = int(rss)
+            job.build.usageReceived(' '.join([utime, stime, maxrss]))
+            self.pool._jobDone(self)
+            job.build._finish(exitCode(int(status)))
+        else:
+            job.build.outputReceived(kind, data)
+
+
+    def processEnded(self, reason):
+        job = self.job
+        self.job = None
+        self.pool._workerEnded(self)
+        if job is not None:
+            log.msg('worker %s died running %s' % (self.transport.pid,
+                                                   job.path))
+            job.pid = None
+            job.starting = False
+            job.build._finish(ERROR)
+
+
+
+class WorkerPool:
+    """
+    I keep up to C{size} warm Python processes with C{modules} already
+    imported and run Python build scripts in them, which saves starting an
+    interpreter and importing for each build.
+
+    Each script runs in a fresh child forked from a worker, in its own
+    process group, and exits with the same status it would have exited
+    with when run on its own.  If the worker itself dies, the build
+    finishes with L{ERROR}.
+
+    A worker is replaced after it has run C{maxRuns} scripts or once its
+    maximum resident set size passes C{maxRSS} kilobytes.
+    """
+
+    reactor = reactor
+
+    maxRuns = 100
+    maxRSS = None
+
+    def __init__(self, size=None, modules=(), maxRuns=None, maxRSS=None):
+        if size is None:
+            size = cpuCount()
+        self.size = size
+        self.modules = list(modules)
+        if maxRuns is not None:
+            self.maxRuns = maxRuns
+        if maxRSS is not None:
+            self.maxRSS = maxRSS
+        self._workers = []
+        self._idle = []
+        self._live = []
+        self._queue = deque()
+        self._stopped = []
+
+
+    def start(self):
+        """
+        Start all my workers now instead of as they are needed.
+        """
+        while len(self._workers) < self.size:
+            self._idle.append(self._spawn())
+
+
+    def stop(self):
+        """
+        Stop my workers once they are done with their current script.
+
+        Returns a Deferred that fires when they have all exited.
+        """
+        for worker in self._workers:
+            worker.transport.closeStdin()
+        self._workers = []
+        self._idle = []
+        if not self._live:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._stopped.append(d)
+        return d
+
+
+    def run(self, build, path, args, env):
+        """
+        Run the Python script at C{path} with C{args} and the environment
+        C{env} for C{build}, which is given its output and finished.
+
+        Returns the L{Job}.
+        """
+        job = Job(build, path, args, env)
+        self._queue.append(job)
+        self._pump()
+        return job
+
+
+    def cancel(self, job):
+        """
+        Forget C{job} if it is still waiting for a worker.  Returns True if
+        it was.
+        """
+        if job in self._queue:
+            self._queue.remove(job)
+            return True
+        return False
+
+
+    def workers(self):
+        """
+        Returns the pids of my workers.
+        """
+        return [x.transport.pid for x in self._workers]
+
+
+    def _spawn(self):
+        worker = WorkerProtocol(self)
+        args = [sys.executable, RUNNER, '--worker'] + self.modules
+        self.reactor.spawnProcess(worker, sys.executable, args, os.environ,
+                                  childFDs={0: 'w', 1: 'r', 2: 'r'})
+        self._workers.append(worker)
+        self._live.append(worker)
+        return worker
+
+
+    def _pump(self):
+        while self._queue:
+            if self._idle:
+                worker = self._idle.pop()
+            elif len(self._workers) < self.size:
+                worker = self._spawn()
+            else:
+                break
+            worker.send(self._queue.popleft())
+
+
+    def _retire(self, worker):
+        self._workers.remove(worker)
+        worker.transport.closeStdin()
+
+
+    def _jobDone(self, worker):
+        if worker not in self._workers:
+            return
+        if (worker.runs >= self.maxRuns or
+            (self.maxRSS is not None and worker.rss > self.maxRSS)):
+            self._retire(worker)
+        else:
+            self._idle.append(worker)
+        self._pump()
+
+
+    def _workerEnded(self, worker):
+        self._live.remove(worker)
+        if worker in self._workers:
+            self._workers.remove(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        if not self._live:
+            stopped, self._stopped = self._stopped, []
+            for d in stopped:
+                d.callback(None)
+        self._pump()